@@ -2,10 +2,12 @@
 __version__ = '0.6'
 tagline = 'sentry is dns for fun and profit!'
 
-from sentry import counter
+from sentry import counter, topk
 
 stats = counter.Counter()
-domain_stats = counter.Counter()
+
+# only the busiest domains, memory stays fixed
+domain_stats = topk.TopK()
 
 # default log format
 LOG_FORMAT = '[%(asctime)s] [%(name)s] %(levelname)s: %(message)s'
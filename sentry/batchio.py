@@ -0,0 +1,211 @@
+import logging, socket, struct, errno, os
+import ctypes, ctypes.util
+
+from sentry import stats
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 32
+
+# biggest query we accept, EDNS clients may send more than the classic 512
+MAX_DATAGRAM = 4096
+
+# room for a sockaddr_in6, we only ever get sockaddr_in
+SOCKADDR_SIZE = 28
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class _IOVec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(_IOVec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', _MsgHdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    _recvmmsg = _libc.recvmmsg
+    _recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    _recvmmsg.restype = ctypes.c_int
+
+    _sendmmsg = _libc.sendmmsg
+    _sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    _sendmmsg.restype = ctypes.c_int
+
+except (OSError, AttributeError, TypeError):
+    _recvmmsg = _sendmmsg = None
+
+# recvmmsg needs MSG_DONTWAIT so a short batch doesn't block
+HAVE_MMSG = _recvmmsg is not None and MSG_DONTWAIT != 0
+
+
+def _decode_sockaddr(raw):
+    return socket.inet_ntoa(raw[4:8]), struct.unpack('!H', raw[2:4])[0]
+
+
+def _encode_sockaddr(addr):
+    return struct.pack('=H', socket.AF_INET) + struct.pack('!H', addr[1]) + socket.inet_aton(addr[0]) + '\0' * 8
+
+
+def _raise_errno():
+    err = ctypes.get_errno()
+    raise socket.error(err, os.strerror(err))
+
+
+def record(kind, size, counter=stats):
+    """
+    counts batch sizes in power of two buckets: net.<kind>_batch.le_<n>
+    """
+    bucket = 1
+    while bucket < size:
+        bucket <<= 1
+
+    counter.add('net.%s_batch.le_%d' % (kind, bucket), 1)
+    counter.add_avg('net.%s_batch' % kind, size)
+
+
+class DatagramBatch(object):
+    """
+    moves up to `size` datagrams per syscall. receiving drains whatever is
+    queued on the socket into preallocated buffers without blocking, sending
+    flushes a list of (response, addr) pairs.
+
+    uses recvmmsg/sendmmsg where libc has them, plain recvfrom_into/sendto
+    loops otherwise.
+    """
+
+    def __init__(self, size=DEFAULT_BATCH_SIZE, buffer_size=MAX_DATAGRAM, native=True):
+        self.size = size
+        self.buffer_size = buffer_size
+        self.native = native and HAVE_MMSG
+
+        if self.native:
+            self._buffers = [ctypes.create_string_buffer(buffer_size) for _ in xrange(size)]
+            self._names = [ctypes.create_string_buffer(SOCKADDR_SIZE) for _ in xrange(size)]
+            self._iovecs = (_IOVec * size)()
+            self._headers = (_MMsgHdr * size)()
+
+            for i in xrange(size):
+                self._iovecs[i].iov_base = ctypes.cast(self._buffers[i], ctypes.c_void_p)
+                self._iovecs[i].iov_len = buffer_size
+                self._headers[i].msg_hdr.msg_iov = ctypes.pointer(self._iovecs[i])
+                self._headers[i].msg_hdr.msg_iovlen = 1
+                self._headers[i].msg_hdr.msg_name = ctypes.cast(self._names[i], ctypes.c_void_p)
+        else:
+            self._buffers = [bytearray(buffer_size) for _ in xrange(size)]
+
+    def recv(self, sock):
+        """
+        returns a list of (data, addr) with everything queued on sock, up to
+        the batch size. never blocks, an empty list means nothing was there.
+        """
+        if self.native:
+            return self._recv_native(sock)
+
+        received = []
+
+        # without MSG_DONTWAIT only the first read on a blocking socket is safe
+        batch = self._buffers if MSG_DONTWAIT or sock.gettimeout() == 0.0 else self._buffers[:1]
+
+        for buf in batch:
+            try:
+                size, addr = sock.recvfrom_into(buf, 0, MSG_DONTWAIT)
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+
+            received.append((str(buf[:size]), addr))
+
+        return received
+
+    def _recv_native(self, sock):
+        headers = self._headers
+        for i in xrange(self.size):
+            headers[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+
+        count = _recvmmsg(sock.fileno(), headers, self.size, MSG_DONTWAIT, None)
+
+        if count < 0:
+            if ctypes.get_errno() in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            _raise_errno()
+
+        return [
+            (ctypes.string_at(self._buffers[i], headers[i].msg_len), _decode_sockaddr(self._names[i].raw))
+            for i in xrange(count)
+        ]
+
+    def send(self, sock, messages):
+        """
+        sends every (response, addr) in messages, returns the bytes sent
+        """
+        if self.native and len(messages) > 1:
+            return self._send_native(sock, messages)
+
+        return self._send_each(sock, messages)
+
+    def _send_each(self, sock, messages):
+        sent = 0
+        for response, addr in messages:
+            try:
+                sent += sock.sendto(response, addr)
+            except socket.error as e:
+                log.error('could not send response to %s:%s - %s' % (addr[0], addr[1], e))
+        return sent
+
+    def _send_native(self, sock, messages):
+        count = len(messages)
+        headers = (_MMsgHdr * count)()
+        iovecs = (_IOVec * count)()
+
+        # the kernel reads straight out of these, they must outlive the call
+        keep = []
+
+        for i, (response, addr) in enumerate(messages):
+            name = ctypes.create_string_buffer(_encode_sockaddr(addr), 16)
+            data = ctypes.c_char_p(response)
+            keep.append((name, data))
+
+            iovecs[i].iov_base = ctypes.cast(data, ctypes.c_void_p)
+            iovecs[i].iov_len = len(response)
+            headers[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+            headers[i].msg_hdr.msg_iovlen = 1
+            headers[i].msg_hdr.msg_name = ctypes.cast(name, ctypes.c_void_p)
+            headers[i].msg_hdr.msg_namelen = 16
+
+        done = 0
+        while done < count:
+            n = _sendmmsg(sock.fileno(), ctypes.addressof(headers) + done * ctypes.sizeof(_MMsgHdr), count - done, 0)
+
+            if n < 0:
+                if ctypes.get_errno() == errno.EINTR:
+                    continue
+
+                # whatever is left goes out one at a time, logging failures
+                return sum(headers[i].msg_len for i in xrange(done)) + self._send_each(sock, messages[done:])
+
+            done += n
+
+        return sum(headers[i].msg_len for i in xrange(count))
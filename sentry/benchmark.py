@@ -1,32 +1,264 @@
-import logging, tempfile, zipfile, csv, StringIO, os.path
-import time, prettytable, threading
+import logging, time, prettytable, threading, socket, select, struct, errno
 
-from Queue import Queue
+from collections import deque
 
 import futures
-import requests
-import dns.query, dns.reversename, dns.exception
+import dns.query, dns.reversename, dns.exception, dns.name, dns.rdatatype
 
-from sentry import counter
+from sentry import counter, wire
 
 log = logging.getLogger(__name__)
 DEFAULT_TIMEOUT = 1.0 # 1 seconds query timeout
 
+# queries a closed loop run of made up queries sends without a limit
+DEFAULT_QUERIES = 10000
 
-class SentryBenchmark(object):
+# seconds every step of an open loop load profile lasts
+DEFAULT_DURATION = 10
+
+# ramps are reported in this many slices, each with the rate it ended at
+RAMP_SLICES = 10
+
+# a stage is saturated once fewer than this share of its queries get answered
+SATURATED = 0.99
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def query_packet(name, rdtype='A'):
+    """
+    a wire format query for name with id 0, senders put their own ids in
+    """
+    return (wire.HEADER.pack(0, wire.RD, 1, 0, 0, 0) + dns.name.from_text(name).to_wire() +
+            wire.TYPE_CLASS.pack(dns.rdatatype.from_text(rdtype), wire.IN))
+
+
+def load_profile(rate=None, step=None, ramp=None, duration=DEFAULT_DURATION):
+    """
+    the stages of an open loop run as (start rate, end rate, seconds):
+
+    - rate: a constant rate for duration seconds
+    - step: 'start:end:increment', every rate for duration seconds
+    - ramp: 'start:end', climbing linearly over duration seconds
     """
-    Fairly repeatable benchmark using Alexa's TOP 1M sites
+    if rate:
+        return [(float(rate), float(rate), duration)]
+
+    if step:
+        start, end, increment = [float(x) for x in step.split(':')]
+        stages = []
+        while start <= end:
+            stages.append((start, start, duration))
+            start += increment
+        return stages
+
+    if ramp:
+        start, end = [float(x) for x in ramp.split(':')]
+        size = (end - start) / RAMP_SLICES
+        return [(start + size * i, start + size * (i + 1), float(duration) / RAMP_SLICES) for i in range(RAMP_SLICES)]
+
+    return None
+
+
+class OpenLoop(object):
     """
+    sends queries on a fixed schedule whether or not earlier ones got
+    answered, so a slow server can't lower the load it's offered. latency is
+    measured from when a query was due to go out rather than when we got to
+    send it, which keeps our own hiccups from hiding the server's tail
+    (coordinated omission).
+
+    packets is an iterable of query packets, their ids get replaced. the run
+    ends early if it runs out of them.
+    """
+
+    def __init__(self, server, port, packets, stages, timeout=DEFAULT_TIMEOUT):
+        self.address = (server, int(port))
+        self.packets = iter(packets)
+        self.stages = stages
+        self.timeout = timeout
+
+        # id -> (due, stage counter)
+        self.pending = {}
+
+        # (due, id) in the order queries went out, oldest time out first
+        self.order = deque()
+
+        self.next_id = 0
+        self.exhausted = False
+
+    def run(self):
+        """
+        runs every stage, returns [(stage, counter, seconds it took)]
+        """
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 22)
+        except socket.error:
+            pass
+        self.sock.connect(self.address)
+        self.sock.setblocking(False)
+
+        results = []
+        due = clock()
+
+        try:
+            for stage in self.stages:
+                begin, end, duration = stage
+                stats = counter.Counter()
+                started = due
+                finish = started + duration
+
+                while due < finish and not self.exhausted:
+                    self._wait(due)
+                    self._send(due, stats)
+
+                    rate = begin + (end - begin) * (due - started) / duration
+                    due += 1.0 / max(rate, 1.0)
+
+                results.append((stage, stats, clock() - started))
+
+                if self.exhausted:
+                    log.info('ran out of queries to send')
+                    break
+
+            # whatever is still out gets answered or times out
+            while self.pending:
+                self._wait(clock() + 0.01)
+
+        finally:
+            self.sock.close()
+
+        return results
+
+    def _send(self, due, stats):
+        packet = next(self.packets, None)
+        if packet is None:
+            self.exhausted = True
+            return
+
+        stats.add('scheduled')
+
+        # every id is taken by a query we're still waiting on
+        if len(self.pending) > 0xffff:
+            stats.add('unsent')
+            return
+
+        while self.next_id in self.pending:
+            self.next_id = (self.next_id + 1) & 0xffff
+
+        qid = self.next_id
+        self.next_id = (qid + 1) & 0xffff
+
+        try:
+            self.sock.send(struct.pack('!H', qid) + packet[2:])
+        except socket.error as e:
+            log.debug('could not send query: %s' % e)
+            stats.add('send_errors')
+            return
+
+        stats.add('sent')
+        self.pending[qid] = (due, stats)
+        self.order.append((due, qid))
+
+    def _wait(self, until):
+        """
+        reads responses and times queries out until it's time to send again
+        """
+        while True:
+            self._receive()
 
-    ALEXA_URL = 'http://s3.amazonaws.com/alexa-static/top-1m.csv.zip'
-    FILENAME = 'top-1m.csv'
+            now = clock()
+            self._expire(now)
 
-    def __init__(self, server, workers, limit):
+            if now >= until:
+                return
+
+            select.select([self.sock], [], [], until - now)
+
+    def _receive(self):
+        while True:
+            try:
+                response = self.sock.recv(65535)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    log.debug('could not read response: %s' % e)
+                return
+
+            now = clock()
+            if len(response) < wire.HEADER.size:
+                continue
+
+            qid, flags = struct.unpack_from('!HH', response)
+            entry = self.pending.pop(qid, None)
+
+            # already timed out
+            if entry is None:
+                continue
+
+            due, stats = entry
+            stats.add_histogram('latency_msec', (now - due) * 1000)
+
+            if flags & wire.RCODE:
+                stats.add('errors')
+            else:
+                stats.add('answered')
+
+    def _expire(self, now):
+        order, pending = self.order, self.pending
+
+        while order and order[0][0] + self.timeout <= now:
+            due, qid = order.popleft()
+            entry = pending.get(qid)
+            if entry is not None and entry[0] == due:
+                del pending[qid]
+                entry[1].add('timeouts')
+
+
+def report(results):
+    """
+    a table with a row per open loop stage and the first saturated one, if any
+    """
+    x = prettytable.PrettyTable(['offered_qps', 'sent_qps', 'answered_qps', 'p50_msec', 'p90_msec',
+                                 'p99_msec', 'p999_msec', 'timeouts', 'errors'])
+    x.align = 'r'
+    saturated = None
+
+    for (begin, end, duration), stats, elapsed in results:
+        metrics = dict((m['name'], m['value']) for m in stats.get_metrics(include_uptime=False))
+        scheduled = metrics.get('scheduled', 0)
+        answered = metrics.get('answered', 0)
+
+        # a ramp stage climbs linearly, compare what we sent with its mean rate
+        offered = (begin + end) / 2.0
+
+        x.add_row(['%.0f' % offered, '%.0f' % (metrics.get('sent', 0) / elapsed), '%.0f' % (answered / elapsed)] +
+                  ['%.2f' % metrics.get('latency_msec_%s' % p, 0) for p in ('p50', 'p90', 'p99', 'p999')] +
+                  [metrics.get('timeouts', 0), metrics.get('errors', 0)])
+
+        if saturated is None and scheduled and answered < scheduled * SATURATED:
+            saturated = offered
+
+    return str(x), saturated
+
+
+class SentryBenchmark(object):
+    """
+    Fairly repeatable benchmark, workload is an iterable of (name, rdtype)
+    pairs such as sentry.workload.corpus() or sentry.workload.synthetic()
+    """
+
+    def __init__(self, server, workers, workload, stages=None, timeout=DEFAULT_TIMEOUT):
         log.info('starting benchmark')
 
 
         self.server, self.port = server.split(':')
-        self.limit = limit
+        self.workers = workers
+        self.workload = workload
+
+        # an open loop load profile, see load_profile()
+        self.stages = stages
+        self.timeout = timeout
 
         log.info('using %d workers' % workers)
 
@@ -44,45 +276,28 @@ class SentryBenchmark(object):
 
     def start(self):
 
-        # step 1 download alexas site list:
-        path = os.path.join(tempfile.gettempdir(), 'alexas-cache')
-
-        # seeing if the cache is still around
-        if not os.path.exists(path):
-            with open(path, 'wb') as fd:
-                log.info('downloading Alexas sites from %s to %s so it can be reused later' % (self.ALEXA_URL,path))
-                r = requests.get(self.ALEXA_URL, stream=True)
-                for chunk in iter(lambda: r.raw.read(1024),''):
-                    fd.write(chunk)
-
-
-            log.debug('downloading done')
-
-        else:
-            log.info('using local cache...')
-
-        # loading all sites into dispatch queue
-        processed_queries = 0
-
-        if self.limit >0:
-            log.info('limiting run to %d entries' % self.limit)
-
+        if self.stages:
+            self.open_loop()
+            return
 
         log.info('starting processing...')
         self.stats = counter.Counter()
 
-        processed_entries = 0
-
         start_time = time.time()
 
-        def fire(item):
+        # workers take their next query off the workload as they go, so
+        # there's never more than one query per worker in flight
+        queries = iter(self.workload)
+        lock = threading.Lock()
+
+        def fire(item, rdtype):
             # performing query:
             log.debug('resolving %s' % item )
 
             try:
                 response_start_time = time.time()
-                message = dns.message.make_query(item, 'A')
-                response = dns.query.udp(message, self.server, port=int(self.port),timeout=DEFAULT_TIMEOUT)
+                message = dns.message.make_query(item, rdtype)
+                response = dns.query.udp(message, self.server, port=int(self.port),timeout=self.timeout)
                 log.debug(response.answer)
 
                 assert len(response.answer) >0
@@ -91,33 +306,28 @@ class SentryBenchmark(object):
 
                 log.debug('query in %d msec' % response_elapsed_time)
                 self.stats.add_avg('response_time_msec', response_elapsed_time  )
+                self.stats.add_histogram('response_time_msec', response_elapsed_time)
                 self.stats.add('queries_successful')
 
             except Exception as e:
-                log.exception(e)
+                log.debug(e)
                 self.stats.add('queries_failed')
 
+        def worker():
+            while True:
+                with lock:
+                    query = next(queries, None)
+                if query is None:
+                    return
+                fire(*query)
 
-        fs = []
-
-        with open(path, 'r') as fd:
-            zfd = zipfile.ZipFile(fd)
-            data = StringIO.StringIO(zfd.read(self.FILENAME))
-            reader = csv.reader(data)
-
-            for row in reader:
-                if self.limit > 0 and processed_entries == self.limit:
-                    log.info('limited reached, breaking')
-                    break
-
-                item = row[1]
-                fs.append(self.executor.submit(fire, item))
-                processed_entries +=1
-
+        for _ in range(self.workers):
+            self.executor.submit(worker)
 
         self.executor.shutdown()
 
         log.info('benchmark done')
+        processed_entries = sum(m['value'] for m in self.stats.get_metrics() if m['name'] in ('queries_successful', 'queries_failed'))
         elapsed_time_seconds = int(time.time() - start_time)
         elapsed_time_seconds = elapsed_time_seconds if elapsed_time_seconds > 0 else 1
         self.stats.add('elapsed_time_seconds', elapsed_time_seconds )
@@ -132,3 +342,14 @@ class SentryBenchmark(object):
 
         log.info('results: \n' + str(x) )
 
+    def open_loop(self):
+        packets = (query_packet(name, rdtype) for name, rdtype in self.workload)
+
+        log.info('sending queries open loop through %d stages' % len(self.stages))
+        results = OpenLoop(self.server, self.port, packets, self.stages, self.timeout).run()
+
+        table, saturated = report(results)
+        log.info('results: \n' + table)
+
+        if saturated is not None:
+            log.info('saturated at %.0f queries per second' % saturated)
@@ -0,0 +1,197 @@
+import logging, os, struct, mmap, hashlib, zlib
+
+log = logging.getLogger(__name__)
+
+# prebuilt index files: magic, source mtime, source size, number of names,
+# followed by the offsets and names of a NameSet
+MAGIC = 'SBL1'
+INDEX_HEADER = struct.Struct('!4sdQI')
+
+OFFSET = struct.Struct('!I')
+SPAN = struct.Struct('!II')
+
+# bits per name in the filter that spares most lookups the binary search,
+# 8 lets about one in eight names that aren't there through
+FILTER_BITS = 8
+
+# names hosts files map to themselves rather than block
+IGNORED = set(['localhost', 'localhost.localdomain', 'local', 'broadcasthost',
+               'ip6-localhost', 'ip6-loopback', '0.0.0.0'])
+
+
+def key(name):
+    """
+    the form names are stored in: labels reversed, each followed by a dot.
+    ads.example.com. -> com.example.ads.
+    """
+    labels = name.lower().rstrip('.').split('.')
+    labels.reverse()
+    return '.'.join(labels) + '.'
+
+
+def read_names(path):
+    """
+    yields the names in a hosts file ("0.0.0.0 ads.example.com") or a plain
+    list of names, one per line, skipping comments and localhost entries
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].split()
+            if not line:
+                continue
+
+            # hosts files lead with the address names map to
+            names = line[1:] if len(line) > 1 else line
+
+            for name in names:
+                name = name.lower().rstrip('.')
+                if name and name not in IGNORED:
+                    yield name
+
+
+def version(path):
+    """ what tells us a list changed: its mtime and size """
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+
+
+class NameSet(object):
+    """
+    a sorted, deduplicated set of names packed into one buffer: count + 1
+    offsets, the names back to back and a one hash bloom filter over them.
+    a million names take about as much memory as the file they came from
+    instead of a python object each, and the buffer can just as well be a
+    memory-mapped index file.
+    """
+
+    def __init__(self, data, count, base=0):
+        self.data = data
+        self.count = count
+        self.offsets = base
+        self.names = base + (count + 1) * OFFSET.size
+        self.size = OFFSET.unpack_from(data, base + count * OFFSET.size)[0]
+        self.filter = self.names + self.size
+        self.filter_bits = _filter_bits(count)
+
+    @classmethod
+    def build(cls, names):
+        keys = [key(name) for name in names]
+        keys.sort()
+
+        # sorted, so duplicates sit next to each other
+        keys = [k for i, k in enumerate(keys) if i == 0 or keys[i - 1] != k]
+
+        offsets = [0]
+        bits = _filter_bits(len(keys))
+        bloom = bytearray(bits >> 3)
+
+        for k in keys:
+            offsets.append(offsets[-1] + len(k))
+            bit = (zlib.crc32(k) & 0xffffffff) % bits
+            bloom[bit >> 3] |= 1 << (bit & 7)
+
+        data = struct.pack('!%dI' % len(offsets), *offsets) + ''.join(keys) + str(bloom)
+        return cls(data, len(keys))
+
+    def __contains__(self, k):
+        data, offsets, names = self.data, self.offsets, self.names
+
+        bit = (zlib.crc32(k) & 0xffffffff) % self.filter_bits
+        if not ord(data[self.filter + (bit >> 3)]) & (1 << (bit & 7)):
+            return False
+
+        lo, hi = 0, self.count
+
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start, end = SPAN.unpack_from(data, offsets + mid * OFFSET.size)
+            probe = data[names + start:names + end]
+
+            if probe < k:
+                lo = mid + 1
+            elif probe > k:
+                hi = mid
+            else:
+                return True
+
+        return False
+
+    def search(self, name):
+        """
+        the listed name that name is or falls under, None if there's none.
+        same contract as a regex's search() so rules can use it as their RE.
+        """
+        labels = name.lower().rstrip('.').split('.')
+        labels.reverse()
+
+        k = ''
+        for label in labels:
+            k += label + '.'
+            if k in self:
+                return k
+
+        return None
+
+    def __len__(self):
+        return self.count
+
+
+def _filter_bits(count):
+    # whole bytes, and a few of them for tiny lists
+    return max(64, count * FILTER_BITS + 7 & ~7)
+
+
+def _index_path(path, index_dir):
+    return os.path.join(index_dir, hashlib.sha1(os.path.abspath(path)).hexdigest() + '.idx')
+
+
+def _open_index(path, source):
+    try:
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError, mmap.error):
+        return None
+
+    if len(data) < INDEX_HEADER.size:
+        return None
+
+    magic, mtime, size, count = INDEX_HEADER.unpack_from(data)
+    if magic != MAGIC or (mtime, size) != source:
+        data.close()
+        return None
+
+    return NameSet(data, count, INDEX_HEADER.size)
+
+
+def _write_index(path, source, names):
+    temp = '%s.%d' % (path, os.getpid())
+    try:
+        with open(temp, 'wb') as f:
+            f.write(INDEX_HEADER.pack(MAGIC, source[0], source[1], names.count))
+            f.write(names.data)
+        os.rename(temp, path)
+    except (IOError, OSError) as e:
+        log.error('could not write blocklist index %s: %s' % (path, e))
+
+
+def load(path, index_dir=None):
+    """
+    the names listed in path. with an index_dir the packed set is kept there
+    and memory-mapped on later loads for as long as the list doesn't change.
+    """
+    source = version(path)
+
+    if index_dir is not None:
+        index = _index_path(path, index_dir)
+        names = _open_index(index, source)
+        if names is not None:
+            log.debug('using blocklist index %s for %s' % (index, path))
+            return names
+
+    names = NameSet.build(read_names(path))
+    log.info('loaded %d names from %s' % (len(names), path))
+
+    if index_dir is not None:
+        _write_index(index, source, names)
+
+    return names
@@ -0,0 +1,213 @@
+import logging, threading, time, struct
+
+from collections import OrderedDict
+
+from sentry import stats, wire
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 10000
+DEFAULT_MAX_TTL = 86400
+
+# RFC 8767: expired answers can stand in for fresh ones, with a short ttl,
+# for up to a day or so
+STALE_TTL = 30
+
+# answers asked for at least PREFETCH_HITS times get refreshed once they are
+# into the last PREFETCH_FRACTION of their ttl
+PREFETCH_HITS = 2
+PREFETCH_FRACTION = 0.1
+
+# what lookup() says about an answer
+MISS, FRESH, PREFETCH, STALE, EXPIRED = range(5)
+
+NOERROR = 0
+NXDOMAIN = 3
+
+
+def key_of(query):
+    """
+    what answers are filed under. answers to EDNS queries carry an OPT record
+    and may be bigger than plain clients take, with DO set they carry DNSSEC
+    records too, so those get answers of their own.
+    """
+    edns = query.edns()
+    if edns is None:
+        return (query.qname.lower(), query.qtype, query.qclass, False, False)
+    return (query.qname.lower(), query.qtype, query.qclass, True, bool(edns[1] & wire.DO))
+
+
+def ttl_of(response):
+    """
+    how long a wire format upstream response may be cached for, or None if
+    it can't be.
+
+    RFC 2308: negative answers live for the lesser of the SOA's TTL and its
+    MINIMUM field, without a SOA they can't be cached.
+    """
+    flags = wire.HEADER.unpack_from(response)[1]
+
+    if flags & wire.TC:
+        return None
+
+    rcode = flags & wire.RCODE
+    if rcode not in (NOERROR, NXDOMAIN):
+        return None
+
+    ttls = []
+    negative = None
+    answers = 0
+
+    for section, rdtype, ttl_offset, rdata_offset, rdlength in wire.records(response):
+        # the OPT record's "ttl" holds EDNS flags
+        if rdtype == wire.OPT:
+            continue
+
+        ttl = wire.TTL.unpack_from(response, ttl_offset)[0]
+        ttls.append(ttl)
+
+        if section == wire.ANSWER:
+            answers += 1
+        elif section == wire.AUTHORITY and rdtype == wire.SOA and negative is None:
+            minimum = wire.TTL.unpack_from(response, rdata_offset + rdlength - 4)[0]
+            negative = min(ttl, minimum)
+
+    if rcode == NXDOMAIN or not answers:
+        return negative
+
+    return min(ttls)
+
+
+class _Entry(object):
+
+    def __init__(self, response, ttl, stored, ttl_offsets):
+        self.response = response
+        self.ttl = ttl
+        self.stored = stored
+        self.expires = stored + ttl
+        self.ttl_offsets = ttl_offsets
+        self.hits = 0
+        self.prefetching = False
+
+
+class ResponseCache(object):
+    """
+    LRU cache of upstream answers keyed on (qname, qtype, qclass) and the
+    client's EDNS, see key_of().
+
+    entries are kept in wire format and expire after the smallest TTL in the
+    answer. hits are patched in place with the client's query id and question
+    and TTLs counted down by the time they spent in the cache, no dnspython
+    involved.
+
+    expired entries stick around for max_stale seconds (RFC 8767), the first
+    stale_window seconds of that they are fine to hand out while a fresh copy
+    is fetched, after that only when upstream can't give us one.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, max_ttl=DEFAULT_MAX_TTL, max_stale=0, stale_window=0, prefetch=True):
+        self.size = size
+        self.max_ttl = max_ttl
+        self.max_stale = max_stale
+        self.stale_window = min(stale_window, max_stale)
+        self.prefetch = prefetch
+        self.clock = time.time
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, query):
+        """
+        returns (response, state) for a wire.Query. state is FRESH, PREFETCH
+        when it's time to refresh a popular answer, STALE for an expired one
+        that can be handed out while refreshing, EXPIRED for one that should
+        only stand in when upstream fails, or MISS with a None response.
+        """
+        key = key_of(query)
+        now = self.clock()
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is not None and entry.expires + self.max_stale > now:
+                self._entries[key] = entry
+            else:
+                entry = None
+
+        if entry is None:
+            stats.add('cache.misses', 1)
+            return None, MISS
+
+        if entry.expires <= now:
+            state = STALE if now - entry.expires < self.stale_window else EXPIRED
+            return self._render(entry, query, None), state
+
+        entry.hits += 1
+        stats.add('cache.hits', 1)
+
+        state = FRESH
+        if self.prefetch and not entry.prefetching and entry.hits >= PREFETCH_HITS \
+                and entry.expires - now < entry.ttl * PREFETCH_FRACTION:
+            entry.prefetching = True
+            state = PREFETCH
+
+        return self._render(entry, query, int(now - entry.stored)), state
+
+    def _render(self, entry, query, elapsed):
+        # same name up to case, so the question is the same length
+        response = bytearray(entry.response)
+        response[0:2] = query.packet[0:2]
+        response[wire.HEADER.size:query.end] = query.question
+
+        for offset in entry.ttl_offsets:
+            if elapsed is None:
+                ttl = STALE_TTL
+            else:
+                ttl = max(wire.TTL.unpack_from(response, offset)[0] - elapsed, 0)
+            wire.TTL.pack_into(response, offset, ttl)
+
+        return str(response)
+
+    def get(self, query):
+        """
+        returns the fresh wire format answer for a wire.Query or None
+        """
+        response, state = self.lookup(query)
+        return response if state in (FRESH, PREFETCH) else None
+
+    def put(self, query, response):
+        """
+        stores a wire format response as the answer to query if its TTLs
+        allow it
+        """
+        try:
+            ttl = ttl_of(response)
+        except (wire.FormError, struct.error) as e:
+            log.debug('not caching malformed response: %s' % e)
+            return
+
+        if not ttl or ttl <= 0:
+            return
+
+        ttl = min(ttl, self.max_ttl)
+
+        # nothing in the answer should outlive the entry itself
+        ttl_offsets = [r[2] for r in wire.records(response) if r[1] != wire.OPT]
+
+        response = bytearray(response)
+        for offset in ttl_offsets:
+            wire.TTL.pack_into(response, offset, min(wire.TTL.unpack_from(response, offset)[0], ttl))
+
+        entry = _Entry(str(response), ttl, self.clock(), ttl_offsets)
+        key = key_of(query)
+
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = entry
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                stats.add('cache.evictions', 1)
+
+    def __len__(self):
+        return len(self._entries)
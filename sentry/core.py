@@ -1,79 +1,251 @@
-import sys, logging, re, time, signal, os
-
-import dns
-import dns.message
-import dns.query
+import sys, logging, re, time, signal, os, json, threading
 
+import futures
 import prettytable
 
 import sentry.parser
-from sentry.network import Server
-from sentry import rules, errors, stats, domain_stats
+from sentry.network import Server, AsyncServer, DEFAULT_TCP_TIMEOUT, DEFAULT_TCP_CONNECTIONS
+from sentry.batchio import DEFAULT_BATCH_SIZE
+from sentry.supervisor import Supervisor
+from sentry.metrics import MetricsServer, start_rates, DEFAULT_HOST as DEFAULT_METRICS_HOST, DEFAULT_RATE_INTERVAL
+from sentry import rules, errors, stats, domain_stats, wire, topk, profile, querylog
 from sentry.counter import count_calls
 
 log = logging.getLogger(__name__)
 
-def _pprint_message(message):
-    return 'M{ id: %s, flags: %s question: %s }' % (message.id, message.flags, message.question)
-
 class Sentry(object):
     """
     sentry is dns for fun and profit
     """
     REQUIRED_CONFIG_ENTRIES = ['port', 'rules', 'host', 'catchall_address']
+    ENGINES = ['threaded', 'async']
 
-    def __init__(self, settings):
+    def __init__(self, settings, path=None):
         self.settings = settings
-        signal.signal(30, self.usr1_signal_handler)
+        self.path = path
+        self.metrics = None
+
+        # reloads are serialized, queries never wait on them
+        self.reload_lock = threading.Lock()
+
+        signal.signal(signal.SIGUSR1, self.usr1_signal_handler)
+        signal.signal(signal.SIGUSR2, self.usr2_signal_handler)
+        signal.signal(signal.SIGHUP, self.hup_signal_handler)
+
+        querylog.configure(settings.get('query_log'), settings.get('query_log_queue_size', querylog.DEFAULT_QUEUE_SIZE))
+
+        if settings.get('profile', False):
+            profile.enable(settings.get('profile_sample_every', profile.DEFAULT_SAMPLE_EVERY))
+
+        self.ruleset = sentry.parser.build(settings)
 
-        self.ruleset = sentry.parser.parse(settings)
+        domain_stats.configure(
+            size=settings.get('domain_stats_size', topk.DEFAULT_SIZE),
+            rollup=settings.get('domain_stats_rollup', False),
+            decay_interval=settings.get('domain_stats_decay_interval', topk.DEFAULT_DECAY_INTERVAL))
 
         stats.set_type('response_time', 'int')
 
-    def process(self, packet, context):
+    def process(self, packet, context, loop=None):
+        """
+        runs a packet through the rules and returns the wire response. when
+        given an event loop, rules may return a future of the response instead.
+        """
         stats.inc_ops('requests')
         start_time = time.time()
 
-        message = dns.message.from_wire(packet)
-        message.__class__.__str__ = _pprint_message
+        # only the header and question, rules parse the rest if they need it
+        query = wire.parse(packet)
 
-        log.debug(message)
-        log.debug(context)
+        log.debug('query: %s context: %s', query, context)
 
-        for rule in self.ruleset:
-            m = rule.RE.search(str(message.question[0].name))
-            if m is not None:
-                log.debug('resolving query: %s using : %s ' % (message,rule) )
-                response = rule.dispatch(message, context=context)
+        # a reload may swap the rules out under us, this query sticks with these
+        ruleset = self.ruleset
 
-                # updating stats for this rule being called
-                stats.add(rule.__class__,1)
+        name = query.qname
+        position, rule = ruleset.match(name)
 
-                # rules that return none ignored
-                if response is None:
-                    continue
+        while rule is not None:
+            log.debug('resolving query: %s using : %s ', query, rule)
+            response = rule.dispatch(query, context=context, loop=loop)
 
-                # updating stats
-                stats.dec_ops('requests')
-                stats.add_avg('response_time_msec', (time.time() - start_time)*1000 )
-                domain_stats.add( str(message.question[0].name).strip(), 1)
+            # updating stats for this rule being called
+            stats.add(rule.__class__,1)
 
-                # sending rule response back to client
-                return response
+            # rules that return none ignored, rewrites may have changed the name
+            if response is None:
+                name = query.qname
+                position, rule = ruleset.match(name, position + 1)
+                continue
+
+            if isinstance(response, futures.Future):
+                def _done(future, name=name, rule=rule):
+                    if future.exception() is None:
+                        self._answered(name, rule, start_time)
+
+                response.add_done_callback(_done)
+            else:
+                self._answered(name, rule, start_time)
+
+            # sending rule response back to client
+            return response
 
         stats.add('requests_failed',1)
-        raise errors.Error('No matching rule for %s found' % message)
+        raise errors.Error('No matching rule for %s found' % query)
+
+    def _answered(self, name, rule, start_time):
+        elapsed = (time.time() - start_time)*1000
+
+        # updating stats
+        stats.dec_ops('requests')
+        stats.add_avg('response_time_msec', elapsed)
+        stats.add_histogram('response_time_msec', elapsed)
+        stats.add_histogram('rules.%s.response_time_msec' % rule.__class__.__name__, elapsed)
+        domain_stats.add( name.strip(), 1)
 
     def start(self):
         log.info('starting, %d known rules' % (len(self.ruleset)))
-        server = Server(self.settings['host'], self.settings['port'], self.process, self.settings.get('threadpool_size',1) )
-        server.start()
+
+        workers = self.settings.get('workers', 1)
+
+        if workers > 1:
+            supervisor = Supervisor(self, workers)
+
+            # threads only once the workers are forked, respawns take care of their locks
+            def ready():
+                self.start_metrics(supervisor.collect)
+                self.watch(supervisor.reload)
+
+            supervisor.start(ready)
+        else:
+            self.start_metrics(lambda: (stats, domain_stats))
+            self.watch(self.reload)
+            self.serve()
 
         log.info('shutting down, dumping stats:')
 
         self.usr1_signal_handler(None, None)
 
+    def start_metrics(self, source):
+        """
+        serves the stats source returns over http when metrics_port is set
+        """
+        port = self.settings.get('metrics_port')
+        if port is None:
+            return
+
+        self.metrics = MetricsServer(self.settings.get('metrics_host', DEFAULT_METRICS_HOST), port, source)
+        self.metrics.start()
+
+    def reload(self):
+        """
+        re-reads the config file and swaps in its rules, returns whether it did
+        """
+        if self.path is None:
+            log.error('no config file to reload rules from')
+            return False
+
+        try:
+            with open(self.path) as f:
+                settings = json.load(f)
+        except (IOError, ValueError) as e:
+            log.error('could not reload %s, keeping the current rules: %s' % (self.path, e))
+            stats.add('config.reload_errors', 1)
+            return False
+
+        self.update(settings)
+        return True
+
+    def update(self, settings):
+        """
+        builds the rules for settings and swaps them in for the current ones.
+        rules whose config line didn't change are kept as they are, along with
+        their caches and upstream state, unless other settings changed too.
+        """
+        with self.reload_lock:
+            current = self.ruleset
+            previous = None
+
+            if _without_rules(settings) == _without_rules(self.settings):
+                previous = sentry.parser.by_line(current)
+            else:
+                log.info('settings changed, rebuilding every rule. listener settings only apply after a restart')
+
+            ruleset = sentry.parser.build(settings, previous)
+
+            # a single assignment, queries pick the new rules up as they come in
+            self.ruleset = ruleset
+            self.settings = settings
+
+        kept = set(id(rule) for rule in current)
+        reused = len([rule for rule in ruleset if id(rule) in kept])
+
+        stats.add('config.reloads', 1)
+        log.info('reloaded config, %d known rules (%d reused)' % (len(ruleset), reused))
+
+    def watch(self, reload):
+        """
+        calls reload whenever the config file changes, when watch_config is set
+        to the number of seconds between looks at the file
+        """
+        interval = self.settings.get('watch_config', 0)
+        if not interval or self.path is None:
+            return
+
+        def poll():
+            seen = _file_version(self.path)
+            while True:
+                time.sleep(interval)
+                current = _file_version(self.path)
+                if current is not None and current != seen:
+                    seen = current
+                    log.info('%s changed, reloading rules' % self.path)
+                    try:
+                        reload()
+                    except Exception as e:
+                        log.exception(e)
+
+        t = threading.Thread(None, poll, name='config-watch')
+        t.setDaemon(True)
+        t.start()
+
+    def serve(self, reuse_port=False):
+        """
+        runs the configured network engine until it is stopped
+        """
+        engine = self.settings.get('engine', 'threaded')
+
+        start_rates(stats, self.settings.get('metrics_rate_interval', DEFAULT_RATE_INTERVAL))
+
+        options = {
+            'tcp_timeout' : self.settings.get('tcp_idle_timeout', DEFAULT_TCP_TIMEOUT),
+            'tcp_connections' : self.settings.get('tcp_max_connections', DEFAULT_TCP_CONNECTIONS),
+            'reuse_port' : reuse_port,
+            'batch_size' : self.settings.get('udp_batch_size', DEFAULT_BATCH_SIZE)
+        }
+
+        if engine == 'async':
+            server = AsyncServer(self.settings['host'], self.settings['port'], self.process, **options)
+        elif engine == 'threaded':
+            server = Server(self.settings['host'], self.settings['port'], self.process, self.settings.get('threadpool_size',1), **options)
+        else:
+            raise errors.Error('unknown engine %s, pick one of: %s' % (engine, ', '.join(self.ENGINES)))
+
+        server.start()
+
     def usr1_signal_handler(self,num, frame):
+        self.dump_stats(stats, domain_stats)
+
+    def usr2_signal_handler(self, num, frame):
+        profile.toggle(self.settings.get('profile_sample_every', profile.DEFAULT_SAMPLE_EVERY))
+
+    def hup_signal_handler(self, num, frame):
+        # parsing can take a while, the signal handler shouldn't
+        t = threading.Thread(None, self.reload, name='config-reload')
+        t.setDaemon(True)
+        t.start()
+
+    def dump_stats(self, stats, domain_stats):
         log.debug('dumping stats:')
         x = prettytable.PrettyTable(['metric', 'value'])
         x.align = 'l'
@@ -92,9 +264,14 @@ class Sentry(object):
         log.info('domain stats: \n ' + y.get_string(sortby='queries', reversesort=True) )
 
 
+def _without_rules(settings):
+    return dict((key, value) for key, value in settings.iteritems() if key != 'rules')
 
 
-
-
-
-
+def _file_version(path):
+    """ what we compare to tell a file changed, None if it's not there """
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime, st.st_size, st.st_ino
@@ -14,7 +14,7 @@
 #  limitations under the License.
 #
 
-import time
+import time, threading, math
 
 from functools import wraps
 from collections import defaultdict
@@ -22,6 +22,20 @@ from collections import defaultdict
 DEFAULT_TYPE = 'float'
 DEFAULT_GAUGE = 'gauge'
 
+# histograms keep SUB_BUCKETS log-linear buckets per power of two, so a
+# percentile is off by at most ~3% of its value. values outside
+# 2^MIN_EXP..2^MAX_EXP land in the first/last bucket.
+SUB_BUCKETS = 16
+MIN_EXP = -20
+MAX_EXP = 40
+MIN_BUCKET = MIN_EXP * SUB_BUCKETS
+MAX_BUCKET = MAX_EXP * SUB_BUCKETS - 1
+
+# zero and negative values get a bucket of their own
+ZERO_BUCKET = MIN_BUCKET - 1
+
+PERCENTILES = (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p999', 0.999))
+
 
 def count_calls(counter=None):
     def wrapper(f):
@@ -35,6 +49,50 @@ def count_calls(counter=None):
     return wrapper
 
 
+def bucket_of(value):
+    """
+    histogram bucket for value, O(1)
+    """
+    if value <= 0:
+        return ZERO_BUCKET
+
+    mantissa, exponent = math.frexp(value)
+    index = exponent * SUB_BUCKETS + int((mantissa - 0.5) * 2 * SUB_BUCKETS)
+
+    return min(max(index, MIN_BUCKET), MAX_BUCKET)
+
+
+def bucket_value(index):
+    """
+    the value a bucket stands for, the middle of its range
+    """
+    if index == ZERO_BUCKET:
+        return 0
+
+    exponent, sub = divmod(index, SUB_BUCKETS)
+    low = math.ldexp(0.5 + sub / (2.0 * SUB_BUCKETS), exponent)
+    high = math.ldexp(0.5 + (sub + 1) / (2.0 * SUB_BUCKETS), exponent)
+
+    return (low + high) / 2
+
+
+def percentile(buckets, q):
+    """
+    the q-th (0..1) percentile of a {bucket: count} histogram
+    """
+    total = sum(buckets.itervalues())
+    if not total:
+        return None
+
+    rank = max(int(math.ceil(q * total)), 1)
+    seen = 0
+
+    for index in sorted(buckets):
+        seen += buckets[index]
+        if seen >= rank:
+            return bucket_value(index)
+
+
 class Health:
     OK = 1
     WARN = 2
@@ -59,21 +117,107 @@ class CounterEnum:
     MAX = 3
 
 
+class _Shard(object):
+    """
+    the values one thread wrote. only its owner thread ever writes to it,
+    averages and ops are stored as tuples so readers never see half an update.
+    """
+
+    def __init__(self, thread=None):
+        self.thread = thread
+        self.count = defaultdict(int)
+        self.avg = {}
+        self.ops = {}
+        self.hist = {}
+
+    def fold(self, count, avg, ops, hist):
+        """
+        adds this shard's values to the count, avg, ops and hist dicts
+        """
+        for key, value in self.count.items():
+            count[key] += value
+
+        for key, (n, sumval, minval, maxval) in self.avg.items():
+            if key in avg:
+                val = avg[key]
+                avg[key] = (val[CounterEnum.COUNTER] + n,
+                            val[CounterEnum.SUM] + sumval,
+                            min(minval, val[CounterEnum.MIN]),
+                            max(maxval, val[CounterEnum.MAX]))
+            else:
+                avg[key] = (n, sumval, minval, maxval)
+
+        for key, (pending, total) in self.ops.items():
+            val = ops.get(key, (0, 0))
+            ops[key] = (val[OpsEnum.PENDING] + pending, val[OpsEnum.TOTAL] + total)
+
+        for key, buckets in self.hist.items():
+            merged = hist.setdefault(key, defaultdict(int))
+            for index, n in buckets.items():
+                merged[index] += n
+
+
 class Counter(object):
+    """
+    every thread writes into its own shard without taking a lock, shards are
+    summed up whenever the values are read. shards of threads that have died
+    are folded into a retired shard so thread churn doesn't pile them up.
+    """
 
     def __init__(self, time_started=None):
-        self._dcount = defaultdict(int)
-        self._davg = {}
-        self._dops = {}
+        self._time_started = time_started or time.time()
+        self._lock = threading.Lock()
+        self.reset()
         self._bound = {}
         self._fvals = {}
         self._health_evaluator = []
         self._health_status = ""
         self._health = Health.OK
         self._dt = {}
-        self._time_started = time_started or time.time()
         self._per_sec = {}
 
+    def reset(self):
+        """
+        drops every value collected so far
+        """
+        with self._lock:
+            self._local = threading.local()
+            self._shards = []
+            self._retired = _Shard()
+
+    def _shard(self):
+        shard = getattr(self._local, 'shard', None)
+
+        if shard is None:
+            shard = _Shard(threading.current_thread())
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+
+        return shard
+
+    def _collect(self):
+        """
+        returns the (count, avg, ops, hist) dicts summed over every shard
+        """
+        count, avg, ops, hist = defaultdict(int), {}, {}, {}
+
+        with self._lock:
+            live = []
+            for shard in self._shards:
+                if shard.thread.is_alive():
+                    live.append(shard)
+                else:
+                    # nobody writes to a dead thread's shard anymore
+                    shard.fold(self._retired.count, self._retired.avg, self._retired.ops, self._retired.hist)
+            self._shards = live
+
+            self._retired.fold(count, avg, ops, hist)
+            for shard in live:
+                shard.fold(count, avg, ops, hist)
+
+        return count, avg, ops, hist
+
     def set_per_sec(self, key):
         """
         Keep track of specific keys per second
@@ -103,40 +247,97 @@ class Counter(object):
         self._dt[key] = type
 
     def add(self, key, value=1, type=None):
-        self._dcount[key] += value
+        self._shard().count[key] += value
 
         if type:
             self._dt[key] = type
 
     def inc_ops(self, key):
-        if key in self._dops:
-            val = self._dops[key]
-            val[OpsEnum.TOTAL] += 1
-            val[OpsEnum.PENDING] += 1
-        else:
-            self._dops[key] = [1, 1]
+        ops = self._shard().ops
+        pending, total = ops.get(key, (0, 0))
+        ops[key] = (pending + 1, total + 1)
 
     def dec_ops(self, key):
-        if key in self._dops:
-            val = self._dops[key]
-            val[OpsEnum.PENDING] -= 1
+        # ops often finish on another thread than the one that started them,
+        # a shard's pending count may go negative but the sum comes out right
+        ops = self._shard().ops
+        pending, total = ops.get(key, (0, 0))
+        ops[key] = (pending - 1, total)
 
     def add_avg(self, key, value, type=None):
-        if key in self._davg:
-            val = self._davg[key]
-            val[CounterEnum.COUNTER] += 1
-            val[CounterEnum.SUM] += value
-
-            # Easily extendable
-            for en, func in ((CounterEnum.MIN, min), (CounterEnum.MAX, max)):
-                val[en] = func(value, val[en])
+        avg = self._shard().avg
 
+        if key in avg:
+            count, sumval, minval, maxval = avg[key]
+            avg[key] = (count + 1, sumval + value, min(value, minval), max(value, maxval))
         else:
-            self._davg[key] = [1, value, value, value]
+            avg[key] = (1, value, value, value)
+
+        if type:
+            self._dt[key] = type
+
+    def add_histogram(self, key, value, type=None):
+        """
+        records value in the key histogram, reported as percentiles
+        """
+        hist = self._shard().hist
+        buckets = hist.get(key)
+
+        if buckets is None:
+            buckets = hist[key] = defaultdict(int)
+
+        buckets[bucket_of(value)] += 1
 
         if type:
             self._dt[key] = type
 
+    def counters(self):
+        """
+        names of the metrics that only ever go up, everything else is a gauge
+        """
+        count, avg, ops, hist = self._collect()
+        names = set(count)
+        names.update('_'.join([key, 'count']) for key in hist)
+        names.update('_'.join([key, 'total']) for key in ops)
+        return names
+
+    def snapshot(self):
+        """
+        raw copy of the counters, can be handed to merge() on another Counter
+        """
+        count, avg, ops, hist = self._collect()
+        return {
+            'count': dict(count),
+            'avg': dict((k, list(v)) for k, v in avg.items()),
+            'ops': dict((k, list(v)) for k, v in ops.items()),
+            'hist': dict((k, dict(v)) for k, v in hist.items()),
+            'fvals': dict(self._fvals),
+            'types': dict(self._dt),
+            'started': self._time_started,
+        }
+
+    def merge(self, snapshot):
+        """
+        folds a snapshot taken from another Counter into this one
+        """
+        other = _Shard()
+        other.count.update(snapshot['count'])
+        other.avg = dict((k, tuple(v)) for k, v in snapshot['avg'].iteritems())
+        other.ops = dict((k, tuple(v)) for k, v in snapshot['ops'].iteritems())
+        other.hist = snapshot.get('hist', {})
+
+        with self._lock:
+            other.fold(self._retired.count, self._retired.avg, self._retired.ops, self._retired.hist)
+
+        # rates of separate processes add up
+        for key, value in snapshot.get('fvals', {}).iteritems():
+            self._fvals[key] = self._fvals.get(key, 0) + value
+
+        for key, type in snapshot['types'].iteritems():
+            self._dt.setdefault(key, type)
+
+        self._time_started = min(self._time_started, snapshot['started'])
+
     def set_health(self, health):
         if health not in (Health.OK, Health.WARN, Health.ERR):
             raise ValueError('Invalid health state: %s' % (health))
@@ -150,7 +351,9 @@ class Counter(object):
     def get_metrics(self, include_uptime=True):
         metrics = []
         m_keys = {}
-        for key, stat in self._dcount.iteritems():
+        dcount, davg, dops, dhist = self._collect()
+
+        for key, stat in dcount.iteritems():
             m_keys[key] = stat
             _new_metric = {
                 "type": self._dt.get(key, DEFAULT_TYPE),
@@ -171,7 +374,7 @@ class Counter(object):
             m_keys[name] = val
             metrics.append(uptime_metric)
 
-        for key, stat in self._davg.iteritems():
+        for key, stat in davg.iteritems():
             count, sumval, minval, maxval = stat
             type = self._dt.get(key, DEFAULT_TYPE)
 
@@ -190,7 +393,31 @@ class Counter(object):
                   }
                 m_keys[k] = val
                 metrics.append(_new_metric)
-        for key, (pen_cnt, total_cnt) in self._dops.iteritems():
+        for key, buckets in dhist.iteritems():
+            type = self._dt.get(key, DEFAULT_TYPE)
+
+            for suffix, q in PERCENTILES:
+                val = percentile(buckets, q)
+                if type == "int":
+                    val = int(val)
+
+                k = "_".join([key, suffix])
+                m_keys[k] = val
+                metrics.append({
+                    "type": type,
+                    "name": k,
+                    "value": val,
+                })
+
+            k = "_".join([key, "count"])
+            m_keys[k] = sum(buckets.itervalues())
+            metrics.append({
+                "type": "int",
+                "name": k,
+                "value": m_keys[k],
+            })
+
+        for key, (pen_cnt, total_cnt) in dops.iteritems():
             for suffix, type, val in (('pending', 'int', pen_cnt),
                                       ('total', 'gauge', total_cnt)):
                 k = "_".join([key, suffix])
@@ -246,16 +473,17 @@ class Counter(object):
     def per_sec(self):
         """
         called once every X secs.
-        Diffs the values versus the previous values, add as a new key
-        to a seperate dictionary
+        Diffs the values of the keys given to set_per_sec versus the previous
+        call and keeps the rate as a new <key>_per_sec metric
         """
-        metrics = self.get_metrics()
-        for metric in metrics:
-            result = self._per_sec.get(metric['name'])
-            if result:
-                last_val, last_time = result
-                if last_time:
-                    self._fval[metric['value']] - last_val
+        now = time.time()
+        values = dict((m['name'], m['value']) for m in self.get_metrics())
+
+        for key, (last_val, last_time) in self._per_sec.items():
+            val = values.get(key, 0)
+            if last_time is not None and now > last_time:
+                self._fvals[key + '_per_sec'] = (val - last_val) / (now - last_time)
+            self._per_sec[key] = (val, now)
 
     def to_stats(self, include_uptime=True):
         # Get metrics first, evaluate status later
@@ -0,0 +1,289 @@
+import re, logging
+
+log = logging.getLogger(__name__)
+
+# regex tokens that stand for "any run of characters"
+GAPS = ['(.*?)', '(.+?)', '(.*)', '(.+)', '.*?', '.+?', '.*', '.+']
+
+# characters that turn a pattern into something we can't index
+SPECIAL = '[](){}|?*+^$'
+
+# quantifiers that can't follow a literal character
+QUANTIFIERS = '*+?{'
+
+# patterns that can't share a regex with others: an inline flag like (?i)
+# or (?x) applies to the whole regex it sits in, and combining patterns
+# renumbers their groups, breaking back references
+STANDALONE = re.compile(r'\(\?[iLmsux]+\)|\\[1-9]|\(\?P=')
+
+
+def _tokenize(pattern):
+    """
+    breaks a rule regex into literal characters, single wildcards ('.') and
+    gaps ('.*' and friends). returns None if the pattern uses anything else.
+    """
+    tokens = []
+    anchored_start = pattern.startswith('^')
+    anchored_end = False
+
+    i = 1 if anchored_start else 0
+    size = len(pattern)
+
+    while i < size:
+        gap = None
+        for g in GAPS:
+            if pattern.startswith(g, i):
+                gap = g
+                break
+
+        if gap is not None:
+            tokens.append(None)
+            i += len(gap)
+            continue
+
+        c = pattern[i]
+
+        if c == '$' and i == size - 1:
+            anchored_end = True
+            i += 1
+            continue
+
+        if c == '\\':
+            if i + 1 >= size or pattern[i + 1].isalnum():
+                return None
+            tokens.append(pattern[i + 1])
+            i += 2
+
+        elif c == '.':
+            tokens.append('')
+            i += 1
+
+        elif c in SPECIAL:
+            return None
+
+        else:
+            tokens.append(c)
+            i += 1
+
+        if i < size and pattern[i] in QUANTIFIERS:
+            return None
+
+    return anchored_start, anchored_end, tokens
+
+
+def _anchor(pattern):
+    """
+    finds the longest literal every match of pattern must contain and where
+    it sits. returns (kind, offset, literal) with kind one of 'start', 'end',
+    'contains' or 'always', or None if the pattern is too complex to index.
+    """
+    parsed = _tokenize(pattern)
+
+    if parsed is None:
+        return None
+
+    anchored_start, anchored_end, tokens = parsed
+
+    best_start, best_size = 0, 0
+    run_start = 0
+
+    for i, token in enumerate(tokens + [None]):
+        if token:
+            continue
+        if i - run_start > best_size:
+            best_start, best_size = run_start, i - run_start
+        run_start = i + 1
+
+    if best_size == 0:
+        return 'always', 0, ''
+
+    literal = ''.join(tokens[best_start:best_start + best_size])
+    before = tokens[:best_start]
+    after = tokens[best_start + best_size:]
+
+    if anchored_start and None not in before:
+        return 'start', len(before), literal
+
+    if anchored_end and None not in after:
+        return 'end', len(after), literal
+
+    return 'contains', 0, literal
+
+
+class RuleIndex(object):
+    """
+    compiled view of a ruleset that finds the first matching rule without
+    running every rule's regex.
+
+    every indexable rule is filed under the longest literal its regex requires
+    (and that literal's fixed offset when the regex is anchored), so a lookup
+    costs a handful of hash probes over the query name no matter how many
+    rules are loaded. candidates are confirmed with the rule's own regex, so
+    matching behaves exactly like the old linear scan.
+    """
+
+    # the lookup tables, what state() hands out
+    TABLES = ('_always', '_fallback', '_start', '_end', '_contains',
+              '_start_probes', '_end_probes', '_contains_sizes')
+
+    def __init__(self, ruleset, state=None):
+        """
+        indexes ruleset, or takes the tables from state (as returned by
+        state() for the same ruleset) instead of working them out again
+        """
+        self.rules = list(ruleset)
+
+        if state is not None:
+            self._restore(state)
+        else:
+            self._build()
+
+        self._prefilter = self._build_prefilter()
+
+        log.debug('indexed %d rules, %d need a full regex scan', len(self.rules), len(self._fallback))
+
+    def _build(self):
+        self._always = []
+        self._fallback = []
+        self._start = {}
+        self._end = {}
+        self._contains = {}
+
+        start_probes = set()
+        end_probes = set()
+        contains_sizes = set()
+
+        # plenty of rules share a domain
+        anchors = {}
+
+        for position, rule in enumerate(self.rules):
+            # rules with their own matchers get checked on every lookup
+            if not rule.INDEXABLE:
+                self._always.append(position)
+                continue
+
+            if rule.domain not in anchors:
+                anchors[rule.domain] = _anchor(rule.domain)
+            anchor = anchors[rule.domain]
+
+            if anchor is None:
+                self._fallback.append(position)
+                continue
+
+            kind, offset, literal = anchor
+
+            if kind == 'always':
+                self._always.append(position)
+
+            elif kind == 'start':
+                self._start.setdefault((offset, literal), []).append(position)
+                start_probes.add((offset, len(literal)))
+
+            elif kind == 'end':
+                self._end.setdefault((offset, literal), []).append(position)
+                end_probes.add((offset, len(literal)))
+
+            else:
+                self._contains.setdefault(literal, []).append(position)
+                contains_sizes.add(len(literal))
+
+        self._start_probes = sorted(start_probes)
+        self._end_probes = sorted(end_probes)
+        self._contains_sizes = sorted(contains_sizes)
+
+    def state(self):
+        """
+        the lookup tables as lists and string keyed dicts, so they can go
+        through json, to hand back to RuleIndex along with the same rules
+        """
+        state = dict((name, getattr(self, name)) for name in self.TABLES)
+
+        for name in ('_start', '_end'):
+            state[name] = [[offset, literal, positions] for (offset, literal), positions in state[name].iteritems()]
+
+        return state
+
+    def _restore(self, state):
+        for name in self.TABLES:
+            setattr(self, name, state[name])
+
+        for name in ('_start', '_end'):
+            setattr(self, name, dict(((offset, literal), positions) for offset, literal, positions in state[name]))
+
+        for name in ('_start_probes', '_end_probes'):
+            setattr(self, name, [tuple(probe) for probe in state[name]])
+
+    def _build_prefilter(self):
+        """
+        one regex that tells us whether any of the unindexable rules in
+        _filtered can match, the ones in _unfiltered are checked every time
+        """
+        self._filtered, self._unfiltered = [], []
+
+        for position in self._fallback:
+            if STANDALONE.search(self.rules[position].domain):
+                self._unfiltered.append(position)
+            else:
+                self._filtered.append(position)
+
+        if not self._filtered:
+            return None
+
+        try:
+            return re.compile('|'.join('(?:%s)' % self.rules[p].domain for p in self._filtered))
+        except (re.error, AssertionError, OverflowError):
+            self._filtered, self._unfiltered = [], self._fallback
+            return None
+
+    def candidates(self, name):
+        """
+        positions of the rules that might match name, in rule order
+        """
+        found = set(self._always)
+        found.update(self._unfiltered)
+
+        if self._prefilter is not None and self._prefilter.search(name):
+            found.update(self._filtered)
+
+        size = len(name)
+
+        for offset, length in self._start_probes:
+            if offset + length <= size:
+                found.update(self._start.get((offset, name[offset:offset + length]), ()))
+
+        for offset, length in self._end_probes:
+            begin = size - offset - length
+            if begin >= 0:
+                found.update(self._end.get((offset, name[begin:begin + length]), ()))
+
+        contains = self._contains
+        for length in self._contains_sizes:
+            for begin in xrange(size - length + 1):
+                hits = contains.get(name[begin:begin + length])
+                if hits:
+                    found.update(hits)
+
+        return sorted(found)
+
+    def match(self, name, start=0):
+        """
+        returns (position, rule) for the first rule at or after start that
+        matches name, or (None, None)
+        """
+        for position in self.candidates(name):
+            if position < start:
+                continue
+            rule = self.rules[position]
+            if rule.RE.search(name) is not None:
+                return position, rule
+
+        return None, None
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __iter__(self):
+        return iter(self.rules)
+
+    def __getitem__(self, position):
+        return self.rules[position]
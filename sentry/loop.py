@@ -0,0 +1,200 @@
+import logging, select, time, heapq, itertools, threading, errno, os, fcntl
+
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# longest we sleep in the poller when nothing is scheduled
+MAX_WAIT = 1.0
+
+
+class Timer(object):
+    """
+    handle for a callback scheduled with EventLoop.call_later
+    """
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _EpollPoller(object):
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def register(self, fd, readable, writable):
+        mask = (select.EPOLLIN if readable else 0) | (select.EPOLLOUT if writable else 0)
+        try:
+            self.epoll.modify(fd, mask)
+        except IOError:
+            self.epoll.register(fd, mask)
+
+    def unregister(self, fd):
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        events = []
+        for fd, mask in self.epoll.poll(timeout):
+            events.append((fd, bool(mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP)), bool(mask & select.EPOLLOUT)))
+        return events
+
+
+class _SelectPoller(object):
+
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, readable, writable):
+        (self.readers.add if readable else self.readers.discard)(fd)
+        (self.writers.add if writable else self.writers.discard)(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        r, w, _ = select.select(self.readers, self.writers, [], timeout)
+        r, w = set(r), set(w)
+        return [(fd, fd in r, fd in w) for fd in r | w]
+
+
+class EventLoop(object):
+    """
+    single threaded reactor: fd readiness callbacks, timers and a queue of
+    callbacks other threads can hand over with call_soon_threadsafe.
+    """
+
+    def __init__(self):
+        self._poller = _EpollPoller() if hasattr(select, 'epoll') else _SelectPoller()
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._ready = deque()
+        self._sequence = itertools.count()
+        self._thread = None
+        self.running = False
+
+        # self pipe so other threads can wake up the poller
+        self._waker_r, self._waker_w = os.pipe()
+        for fd in (self._waker_r, self._waker_w):
+            _set_nonblocking(fd)
+        self.add_reader(self._waker_r, self._drain_waker)
+
+    def time(self):
+        return time.time()
+
+    def _update(self, fd):
+        readable, writable = fd in self._readers, fd in self._writers
+        if readable or writable:
+            self._poller.register(fd, readable, writable)
+        else:
+            self._poller.unregister(fd)
+
+    def add_reader(self, fd, callback, *args):
+        self._readers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_reader(self, fd):
+        if self._readers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def add_writer(self, fd, callback, *args):
+        self._writers[fd] = (callback, args)
+        self._update(fd)
+
+    def remove_writer(self, fd):
+        if self._writers.pop(fd, None) is not None:
+            self._update(fd)
+
+    def call_soon(self, callback, *args):
+        self._ready.append((callback, args))
+
+    def call_soon_threadsafe(self, callback, *args):
+        self._ready.append((callback, args))
+        if self._thread is not threading.current_thread():
+            try:
+                os.write(self._waker_w, 'x')
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+
+    def call_later(self, delay, callback, *args):
+        timer = Timer(self.time() + delay, callback, args)
+        heapq.heappush(self._timers, (timer.when, next(self._sequence), timer))
+        return timer
+
+    def _drain_waker(self):
+        try:
+            while os.read(self._waker_r, 4096):
+                pass
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+
+    def _run(self, callback, args):
+        try:
+            callback(*args)
+        except Exception as e:
+            log.exception(e)
+
+    def run_once(self):
+        if self._ready:
+            timeout = 0
+        elif self._timers:
+            timeout = min(max(self._timers[0][0] - self.time(), 0), MAX_WAIT)
+        else:
+            timeout = MAX_WAIT
+
+        try:
+            events = self._poller.poll(timeout)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+
+        for fd, readable, writable in events:
+            if readable and fd in self._readers:
+                callback, args = self._readers[fd]
+                self._run(callback, args)
+            if writable and fd in self._writers:
+                callback, args = self._writers[fd]
+                self._run(callback, args)
+
+        now = self.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                self._run(timer.callback, timer.args)
+
+        # only what was queued so far, callbacks may queue more
+        for _ in xrange(len(self._ready)):
+            callback, args = self._ready.popleft()
+            self._run(callback, args)
+
+    def run_forever(self):
+        self.running = True
+        self._thread = threading.current_thread()
+        try:
+            while self.running:
+                self.run_once()
+        finally:
+            self._thread = None
+
+    def stop(self):
+        self.running = False
+        self.call_soon_threadsafe(lambda: None)
+
+
+def _set_nonblocking(fd):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
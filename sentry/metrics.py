@@ -0,0 +1,151 @@
+import logging, json, math, re, threading, time
+
+import BaseHTTPServer, SocketServer
+
+log = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+
+# how often rate metrics (<key>_per_sec) are refreshed
+DEFAULT_RATE_INTERVAL = 10.0
+
+# counters we keep rates for
+RATES = ['requests_total', 'cache.hits', 'cache.misses', 'upstream.errors', 'upstream.timeouts']
+
+PROMETHEUS_PREFIX = 'sentry_'
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+
+def _prometheus_name(name):
+    return PROMETHEUS_PREFIX + re.sub('[^a-zA-Z0-9_:]+', '_', str(name)).strip('_')
+
+
+def _prometheus_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _prometheus_value(value):
+    if isinstance(value, (int, long)):
+        return '%d' % value
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def prometheus(stats, domain_stats):
+    """
+    stats and domain_stats in the prometheus text exposition format
+    """
+    lines, seen = [], set()
+    counters = stats.counters()
+
+    for metric in stats.get_metrics():
+        if not isinstance(metric['value'], (int, long, float)):
+            continue
+
+        # two keys may sanitize to the same name, prometheus takes one of them
+        name = _prometheus_name(metric['name'])
+        if name in seen:
+            continue
+        seen.add(name)
+
+        lines.append('# TYPE %s %s' % (name, 'counter' if metric['name'] in counters else 'gauge'))
+        lines.append('%s %s' % (name, _prometheus_value(metric['value'])))
+
+    lines.append('# TYPE %sdomain_queries gauge' % PROMETHEUS_PREFIX)
+    for metric in domain_stats.get_metrics(include_uptime=False):
+        lines.append('%sdomain_queries{domain="%s"} %d' % (PROMETHEUS_PREFIX, _prometheus_label(metric['name']), metric['value']))
+
+    return '\n'.join(lines) + '\n'
+
+
+def to_json(stats, domain_stats):
+    payload = stats.to_stats()
+    payload['metrics'] = [dict(m, name=str(m['name'])) for m in payload['metrics']]
+    payload['domains'] = domain_stats.get_metrics(include_uptime=False)
+    return json.dumps(payload)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+
+        try:
+            stats, domain_stats = self.server.source()
+
+            if path == '/metrics':
+                body, content_type = prometheus(stats, domain_stats), PROMETHEUS_CONTENT_TYPE
+            elif path in ('/', '/stats', '/stats.json'):
+                body, content_type = to_json(stats, domain_stats), 'application/json'
+            else:
+                self.send_error(404)
+                return
+
+        except Exception as e:
+            log.exception(e)
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug('metrics request from %s: %s' % (self.client_address[0], format % args))
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(object):
+    """
+    serves stats over http: /metrics in prometheus text format, /stats.json
+    as json. source returns the (stats, domain_stats) pair to export, counters
+    are summed up per request so the query path never waits on us.
+    """
+
+    def __init__(self, host, port, source):
+        self.httpd = _HTTPServer((host, port), _Handler)
+        self.httpd.source = source
+        self.host, self.port = self.httpd.server_address
+
+    def start(self):
+        t = threading.Thread(None, self.httpd.serve_forever, name='metrics-http')
+        t.setDaemon(True)
+        t.start()
+        log.info('serving metrics on http://%s:%d/metrics' % (self.host, self.port))
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def close(self):
+        """ drops the listening socket without waiting on the server thread """
+        self.httpd.server_close()
+
+
+def start_rates(stats, interval=DEFAULT_RATE_INTERVAL):
+    """
+    refreshes stats' rate metrics every interval seconds in the background
+    """
+    for key in RATES:
+        stats.set_per_sec(key)
+
+    def tick():
+        while True:
+            try:
+                stats.per_sec()
+            except Exception as e:
+                log.exception(e)
+            time.sleep(interval)
+
+    t = threading.Thread(None, tick, name='metrics-rates')
+    t.setDaemon(True)
+    t.start()
@@ -0,0 +1,241 @@
+import logging, time, platform, tempfile, os
+
+import dns.message
+import dns.rrset
+
+import prettytable
+
+import sentry
+from sentry import parser, rules, wire
+from sentry.core import Sentry
+from sentry.index import RuleIndex
+from sentry.benchmark import query_packet
+from sentry.stub import StubServer
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SIZES = [10, 1000, 100000]
+
+# every measurement runs for at least this long, best of REPEAT runs is kept
+MIN_TIME = 0.2
+REPEAT = 3
+
+# names matched and processed per ruleset size
+SAMPLE = 100
+
+CONTEXT = {'client' : '127.0.0.1:5300', 'server' : '127.0.0.1:53', 'transport' : 'udp'}
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def make_rules(size):
+    """
+    size rules that look like a real config: mostly blocks, some conditional
+    blocks, logs, redirects and unanchored patterns, and a catch all at the end
+    """
+    lines = []
+
+    for i in xrange(size - 1):
+        kind = i % 10
+        if kind < 6:
+            lines.append('block ^(.*)domain%d.com' % i)
+        elif kind == 6:
+            lines.append('block ^(.*)domain%d.com if type is MX' % i)
+        elif kind == 7:
+            lines.append('log ^(.*)domain%d.com' % i)
+        elif kind == 8:
+            lines.append('redirect ^(.*)domain%d.com to example.org' % i)
+        else:
+            lines.append('block tracker%d\\.' % i)
+
+    lines.append('block ^(.*)')
+    return lines
+
+
+def sample_names(size, count=SAMPLE):
+    """
+    names spread across a ruleset of size rules, one in ten matching nothing
+    but the catch all
+    """
+    names = []
+    for i in xrange(count):
+        if i % 10 == 9:
+            names.append('www.nowhere%d.example.' % i)
+        else:
+            names.append('www.domain%d.com.' % ((i * 7919) % max(size - 1, 1)))
+    return names
+
+
+def measure(func, items):
+    """
+    nanoseconds per call of func over items, cycling through them until
+    MIN_TIME has gone by. best of REPEAT runs.
+    """
+    best = None
+
+    for _ in xrange(REPEAT):
+        calls = 0
+        started = clock()
+        elapsed = 0
+
+        while elapsed < MIN_TIME:
+            for item in items:
+                func(item)
+            calls += len(items)
+            elapsed = clock() - started
+
+        result = elapsed * 1e9 / calls
+        best = result if best is None else min(best, result)
+
+    return best
+
+
+def _timed(func, *args):
+    started = clock()
+    result = func(*args)
+    return result, clock() - started
+
+
+def bench_ruleset(size):
+    """
+    parse, index, match and process costs for a ruleset of size rules
+    """
+    settings = {'rules' : make_rules(size), 'cache_size' : 0}
+
+    ruleset, parse_seconds = _timed(parser.parse, settings)
+    index, index_seconds = _timed(RuleIndex, ruleset)
+
+    names = sample_names(size)
+
+    engine = Sentry({'rules' : []})
+    engine.ruleset = index
+    packets = [query_packet(name) for name in names]
+
+    return [
+        {'name' : 'parse', 'rules' : size, 'seconds' : parse_seconds},
+        {'name' : 'index', 'rules' : size, 'seconds' : index_seconds},
+        {'name' : 'match', 'rules' : size, 'ns_per_op' : measure(index.match, names)},
+        {'name' : 'process', 'rules' : size, 'ns_per_op' : measure(lambda packet: engine.process(packet, CONTEXT), packets)},
+    ]
+
+
+def _cached_resolver(query):
+    rule = rules.ResolveRule({}, '^(.*)', {'resolvers' : '127.0.0.1:9'})
+
+    response = dns.message.make_response(query.message)
+    response.answer.append(dns.rrset.from_text(query.qname, 300, 'IN', 'A', '10.0.0.1'))
+    rule.cache.put(query, response.to_wire())
+
+    return rule
+
+
+def bench_dispatch(path=None):
+    """
+    what each rule type's dispatch costs on its own, resolves answered from cache
+    """
+    packet = query_packet('www.example.com')
+    query = wire.parse(packet)
+
+    hosts = path or tempfile.mkstemp()[1]
+    if path is None:
+        with open(hosts, 'w') as f:
+            f.write(''.join('0.0.0.0 ads%d.example.com\n' % i for i in xrange(1000)))
+
+    try:
+        subjects = [
+            rules.RedirectRule({}, '^(.*)', {'destination' : 'example.org'}),
+            rules.BlockRule({}, '^(.*)', {}),
+            rules.ConditionalBlockRule({}, '^(.*)', {'type' : 'A'}),
+            rules.LoggingRule({}, '^(.*)', {}),
+            rules.RewriteRule({}, '^(.*)', {'pattern' : 'www.example.com'}),
+            rules.BlockListRule({}, hosts, {}),
+            _cached_resolver(query),
+        ]
+    finally:
+        if path is None:
+            os.unlink(hosts)
+
+    results = []
+    for rule in subjects:
+        dispatch = lambda q: rule.dispatch(q, context=CONTEXT)
+        results.append({'name' : 'dispatch', 'rule' : rule.__class__.__name__, 'ns_per_op' : measure(dispatch, [query])})
+
+    return results
+
+
+def bench_resolve():
+    """
+    Sentry.process for resolve rules with a local stub server upstream,
+    every query going upstream and every query answered from cache
+    """
+    stub = StubServer().start()
+    names = sample_names(1000)
+    packets = [query_packet(name) for name in names]
+
+    results = []
+    try:
+        for cache_size in (0, len(names)):
+            engine = Sentry({'rules' : ['resolve ^(.*) using %s' % stub.address], 'cache_size' : cache_size})
+            results.append({'name' : 'resolve', 'rule' : 'cached' if cache_size else 'upstream',
+                            'ns_per_op' : measure(lambda packet: engine.process(packet, CONTEXT), packets)})
+    finally:
+        stub.stop()
+
+    return results
+
+
+def run(sizes=DEFAULT_SIZES):
+    """
+    every measurement, as a dict ready for json.dump
+    """
+    # rules log at warning level on every query, we want their cost without the io
+    sentry_log = logging.getLogger('sentry')
+    level = sentry_log.level
+    sentry_log.setLevel(logging.ERROR)
+
+    try:
+        results = bench_dispatch() + bench_resolve()
+        for size in sizes:
+            log.info('measuring a ruleset of %d rules' % size)
+            results.extend(bench_ruleset(size))
+    finally:
+        sentry_log.setLevel(level)
+
+    return {
+        'version' : sentry.__version__,
+        'python' : platform.python_version(),
+        'platform' : platform.platform(),
+        'timestamp' : time.time(),
+        'results' : results,
+    }
+
+
+def _key(result):
+    return result['name'], result.get('rules'), result.get('rule')
+
+
+def _value(result):
+    return result.get('ns_per_op', result.get('seconds'))
+
+
+def table(report, baseline=None):
+    """
+    report as a table, with the change from baseline (an earlier report) if given
+    """
+    before = dict((_key(r), _value(r)) for r in (baseline or {}).get('results', []))
+
+    x = prettytable.PrettyTable(['benchmark', 'value', 'unit', 'change'])
+    x.align = 'l'
+
+    for result in report['results']:
+        name = ' '.join(str(part) for part in _key(result) if part is not None)
+        unit = 'ns/op' if 'ns_per_op' in result else 'seconds'
+        value = _value(result)
+
+        change = ''
+        if before.get(_key(result)):
+            change = '%+.1f%%' % ((value / before[_key(result)] - 1) * 100)
+
+        x.add_row([name, '%.1f' % value if unit == 'ns/op' else '%.3f' % value, unit, change])
+
+    return str(x)
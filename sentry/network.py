@@ -1,23 +1,135 @@
+import logging, sys, os, socket, time, threading, futures, errno, struct, select
 
-import logging, sys, os, socket, time, threading, futures
+from collections import deque
 
-from sentry import errors, stats, profile
+from sentry import errors, stats, profile, batchio
+from sentry.loop import EventLoop
+from sentry.batchio import DatagramBatch, DEFAULT_BATCH_SIZE
 
 
 log = logging.getLogger(__name__)
 
+# how long a tcp client can sit idle before we hang up on it (RFC 7766)
+DEFAULT_TCP_TIMEOUT = 10.0
+
+# most tcp clients we serve at once, anyone past that gets disconnected
+DEFAULT_TCP_CONNECTIONS = 128
+
+TCP_BACKLOG = 128
+
+# a tcp client's unparsed input never needs more than one whole message plus
+# what one read brings in, anything over that and we hang up on it
+MAX_TCP_INBUF = 2 + 65535 + 65536
+
+# we stop reading from a tcp client with this many queries in flight, or
+# this many bytes of answers it hasn't read yet, until it catches up
+MAX_TCP_PIPELINE = 64
+MAX_TCP_OUTBUF = 256 * 1024
+
+LENGTH = struct.Struct('!H')
+
+# lets several processes bind the same port, python 2 doesn't name it on linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15 if sys.platform.startswith('linux') else None)
+
+
+def frame(response):
+    """ dns over tcp prefixes every message with its 2 byte length """
+    return struct.pack('!H', len(response)) + response
+
+
+def bind(sock, host, port, reuse_port):
+    if reuse_port:
+        if SO_REUSEPORT is None:
+            raise errors.NetworkError('SO_REUSEPORT is not supported on this platform')
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+    sock.bind((host, port))
+
+
+def _would_block(e):
+    return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class TCPConnection(object):
+    """
+    a tcp client served by the thread pool. queries are read one after the
+    other and answered as soon as each one is ready, so several can be in
+    flight at once (RFC 7766 pipelining)
+    """
+
+    def __init__(self, sock, addr, onclose):
+        self.sock = sock
+        self.addr = addr
+        self.onclose = onclose
+
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.reading = True
+        self.closed = False
+
+    def _recv_exactly(self, size):
+        data = ''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def read_message(self):
+        """
+        returns the next query sent by the client or None once it hangs up
+        """
+        header = self._recv_exactly(2)
+        if header is None:
+            return None
+
+        return self._recv_exactly(struct.unpack('!H', header)[0])
+
+    def send(self, response):
+        with self.lock:
+            if self.closed:
+                return 0
+            self.sock.sendall(frame(response))
+            return len(response) + 2
+
+    def started(self):
+        with self.lock:
+            self.pending += 1
+
+    def finished(self):
+        with self.lock:
+            self.pending -= 1
+            self._close_if_done()
+
+    def done_reading(self):
+        with self.lock:
+            self.reading = False
+            self._close_if_done()
+
+    def _close_if_done(self):
+        if self.closed or self.reading or self.pending > 0:
+            return
+
+        self.closed = True
+        try:
+            self.sock.close()
+        finally:
+            self.onclose()
+
 
 class Server(object):
     """
     Handles all network io
     """
-    def __init__(self, host, port, onreceive, threadpool_size):
+    def __init__(self, host, port, onreceive, threadpool_size, tcp_timeout=DEFAULT_TCP_TIMEOUT, tcp_connections=DEFAULT_TCP_CONNECTIONS, reuse_port=False, batch_size=DEFAULT_BATCH_SIZE):
 
         # udp socket binding
         self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
 
         # tcp socket binding
         self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
         self.host = host
         self.port = port
@@ -29,10 +141,24 @@ class Server(object):
         self.threadpool = futures.ThreadPoolExecutor(max_workers=threadpool_size)
         self.pollers = futures.ThreadPoolExecutor(max_workers=1)
 
+        # workers in the pool update this together
         self.active_threads = 0
+        self.active_lock = threading.Lock()
+
+        self.tcp_timeout = tcp_timeout
+        self.tcp_slots = threading.Semaphore(tcp_connections)
+
+        # udp datagrams move in batches, responses queue up in the outbox
+        # while another worker is busy sending
+        self.batch = DatagramBatch(batch_size)
+        self.outbox = deque()
+        self.sending = threading.Lock()
 
-        self.udp_socket.bind((host, port))
-        self.tcp_socket.bind((host, port))
+        bind(self.udp_socket, host, port, reuse_port)
+
+        # when asked for any port, tcp listens on the one udp got
+        self.port = self.udp_socket.getsockname()[1]
+        bind(self.tcp_socket, host, self.port, reuse_port)
 
         log.info("Server started on %s:%s" %  (self.host, self.port) )
 
@@ -40,17 +166,95 @@ class Server(object):
     def udp_poller(self):
         while not self.stopping:
             try:
-                data, addr = self.udp_socket.recvfrom(1024)
-                if not data:
-                    self.close()
-                    return
-                stats.add('net.packets_received', 1)
-                stats.add('net.bytes_received', len(data))
-                self.threadpool.submit(self.worker, (data, addr))
+                if not select.select([self.udp_socket], [], [], 1.0)[0]:
+                    continue
+
+                batch = self.batch.recv(self.udp_socket)
+                if not batch:
+                    continue
+
+                batchio.record('recv', len(batch))
+
+                for data, addr in batch:
+                    stats.add('net.packets_received', 1)
+                    stats.add('net.bytes_received', len(data))
+                    self.threadpool.submit(self.worker, (data, addr))
+
+            except select.error as ex:
+                if ex.args[0] != errno.EINTR:
+                    log.exception(ex)
 
             except Exception as ex:
                 log.exception(ex)
 
+    def sendto(self, response, addr):
+        """
+        queues a udp response, whichever worker gets to send first flushes
+        everything queued so far in one batch
+        """
+        self.outbox.append((response, addr))
+
+        while self.outbox and self.sending.acquire(False):
+            try:
+                messages = []
+                while self.outbox and len(messages) < self.batch.size:
+                    messages.append(self.outbox.popleft())
+
+                if messages:
+                    s = self.batch.send(self.udp_socket, messages)
+                    batchio.record('send', len(messages))
+                    stats.add('net.packets_sent', len(messages))
+                    stats.add('net.bytes_sent', s)
+            finally:
+                self.sending.release()
+
+    def tcp_acceptor(self):
+        self.tcp_socket.listen(TCP_BACKLOG)
+
+        while not self.stopping:
+            try:
+                sock, addr = self.tcp_socket.accept()
+            except Exception as ex:
+                log.exception(ex)
+                continue
+
+            if not self.tcp_slots.acquire(False):
+                log.warn('too many tcp connections, dropping %s:%s' % addr)
+                stats.add('net.tcp.connections_rejected', 1)
+                sock.close()
+                continue
+
+            stats.add('net.tcp.connections', 1)
+            connection = TCPConnection(sock, addr, self.tcp_slots.release)
+
+            t = threading.Thread(None, self.tcp_reader, name='tcp-%s:%s' % addr, args=(connection,))
+            t.setDaemon(True)
+            t.start()
+
+    def tcp_reader(self, connection):
+        connection.sock.settimeout(self.tcp_timeout)
+
+        try:
+            while not self.stopping:
+                data = connection.read_message()
+                if data is None:
+                    break
+
+                stats.add('net.packets_received', 1)
+                stats.add('net.bytes_received', len(data))
+
+                connection.started()
+                self.threadpool.submit(self.tcp_worker, (data, connection))
+
+        except socket.timeout:
+            stats.add('net.tcp.idle_timeouts', 1)
+
+        except socket.error as e:
+            log.debug('tcp connection from %s:%s failed: %s' % (connection.addr[0], connection.addr[1], e))
+
+        finally:
+            connection.done_reading()
+
 
     def start(self):
         self.stopping = False
@@ -58,6 +262,10 @@ class Server(object):
         self.udp_poller_thread.setDaemon(True)
         self.udp_poller_thread.start()
 
+        self.tcp_acceptor_thread = threading.Thread(None, self.tcp_acceptor, name='tcp-acceptor')
+        self.tcp_acceptor_thread.setDaemon(True)
+        self.tcp_acceptor_thread.start()
+
         while not self.stopping:
             try:
                 time.sleep(5)
@@ -71,28 +279,364 @@ class Server(object):
         log.debug('network node stopped.')
         return
 
+    def handle(self, data, addr, transport):
+        """
+        runs a query through sentry, returns the response or None on failure
+        """
+        with self.active_lock:
+            self.active_threads += 1
+            active = self.active_threads
+        stats.add_avg('net.active_threads', active)
+        try:
+            return self.onreceive(data, {
+                'client' : '%s:%s' % (addr),
+                'server' : '%s:%s' % (self.host, self.port),
+                'transport' : transport
+                })
+
+        except Exception as e:
+            log.exception(e)
+
+        finally:
+            with self.active_lock:
+                self.active_threads -= 1
+                active = self.active_threads
+            stats.add_avg('net.active_threads', active)
+
     @profile.howfast
     def worker(self, info):
         log.debug('starting to process request...')
         data, addr = info
-        self.active_threads += 1
-        stats.add_avg('net.active_threads', self.active_threads)
+
+        response = self.handle(data, addr, 'udp')
+        if response is None:
+            return
+
         try:
-            response = self.onreceive(data, {
-                'client' : '%s:%s' % (addr),
-                'server' : '%s:%s' % (self.host, self.port)
-                })
+            self.sendto(response, addr)
+            log.debug('finished to process request...')
 
-            s = self.udp_socket.sendto(response, addr)
+        except Exception as e:
+            log.exception(e)
+
+    @profile.howfast
+    def tcp_worker(self, info):
+        data, connection = info
+
+        try:
+            response = self.handle(data, connection.addr, 'tcp')
+            if response is None:
+                return
+
+            s = connection.send(response)
             stats.add('net.packets_sent', 1)
             stats.add('net.bytes_sent', s)
-            log.debug('finished to process request...')
 
         except Exception as e:
             log.exception(e)
 
-        self.active_threads -= 1
-        stats.add_avg('net.active_threads', self.active_threads)
+        finally:
+            connection.finished()
+
+
+class AsyncTCPConnection(object):
+    """
+    a tcp client served from the event loop, with the same pipelining and
+    idle timeout rules as TCPConnection
+    """
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.loop = server.loop
+        self.sock = sock
+        self.addr = addr
+
+        self.inbuf = ''
+        self.outbuf = ''
+        self.pending = 0
+        self.reading = True
+        self.paused = False
+        self.closed = False
+
+        self.sock.setblocking(0)
+        self.fd = sock.fileno()
+        self.last_active = self.loop.time()
+
+        self.loop.add_reader(self.fd, self.readable)
+        self.timer = self.loop.call_later(server.tcp_timeout, self.check_idle)
+
+    def readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if not _would_block(e):
+                self.close()
+            return
+
+        if not data:
+            self.reading = False
+            self.loop.remove_reader(self.fd)
+            self._close_if_done()
+            return
+
+        self.last_active = self.loop.time()
+        self.inbuf += data
+        self.parse()
+
+        if len(self.inbuf) > MAX_TCP_INBUF:
+            log.warn('tcp client %s:%s sent more than a message can hold, dropping it' % self.addr)
+            self.server.stats.add('net.tcp.oversized', 1)
+            self.close()
+
+    def parse(self):
+        """
+        hands every whole message in inbuf on, as long as we aren't throttled
+        """
+        inbuf, offset = self.inbuf, 0
+
+        while len(inbuf) - offset >= 2 and not self.closed and self.pending < MAX_TCP_PIPELINE:
+            end = offset + 2 + LENGTH.unpack_from(inbuf, offset)[0]
+            if len(inbuf) < end:
+                break
+
+            message = inbuf[offset + 2:end]
+            offset = end
+            self.pending += 1
+            self.server.tcp_message_received(self, message)
+
+        if offset:
+            self.inbuf = inbuf[offset:]
+
+        self._throttle()
+
+    def _throttle(self):
+        """
+        stops reading from clients that don't wait for or read their answers,
+        and starts again once they caught up
+        """
+        if self.closed or not self.reading:
+            return
+
+        busy = self.pending >= MAX_TCP_PIPELINE or len(self.outbuf) >= MAX_TCP_OUTBUF
+
+        if busy and not self.paused:
+            self.paused = True
+            self.loop.remove_reader(self.fd)
+            self.server.stats.add('net.tcp.throttled', 1)
+        elif self.paused and not busy:
+            self.paused = False
+            self.loop.add_reader(self.fd, self.readable)
+
+            # messages that came in while we weren't taking any
+            if self.inbuf:
+                self.loop.call_soon(self.parse)
+
+    def write(self, response):
+        self.pending -= 1
+
+        if self.closed:
+            return
+
+        if response is not None:
+            self.outbuf += frame(response)
+            self.server.stats.add('net.packets_sent', 1)
+            self.server.stats.add('net.bytes_sent', len(response) + 2)
+
+        self.flush()
+
+    def flush(self):
+        if self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except socket.error as e:
+                if not _would_block(e):
+                    self.close()
+                    return
+                sent = 0
+
+            self.outbuf = self.outbuf[sent:]
+            self.last_active = self.loop.time()
+
+        if self.outbuf:
+            self.loop.add_writer(self.fd, self.flush)
+        else:
+            self.loop.remove_writer(self.fd)
+            self._close_if_done()
+
+        self._throttle()
+
+    def check_idle(self):
+        idle = self.loop.time() - self.last_active
+
+        # answers the client doesn't read don't keep it around either
+        if idle >= self.server.tcp_timeout and self.pending == 0:
+            self.server.stats.add('net.tcp.idle_timeouts', 1)
+            self.close()
+            return
+
+        self.timer = self.loop.call_later(max(self.server.tcp_timeout - idle, 0.1), self.check_idle)
+
+    def _close_if_done(self):
+        if not self.reading and self.pending == 0 and not self.outbuf:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+
+        self.closed = True
+        self.timer.cancel()
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.sock.close()
+        self.server.tcp_closed(self)
+
+
+class AsyncServer(object):
+    """
+    Handles all network io from a single event loop thread
+
+    rules that need to wait on something (like upstream servers) hand back a
+    future instead of blocking, so one thread can keep many queries in flight
+    """
+
+    # most batches we read per wakeup before giving other events a turn
+    MAX_READS = 4
+
+    def __init__(self, host, port, onreceive, tcp_timeout=DEFAULT_TCP_TIMEOUT, tcp_connections=DEFAULT_TCP_CONNECTIONS, reuse_port=False, batch_size=DEFAULT_BATCH_SIZE, counter=stats):
+        self.host = host
+        self.port = port
+        self.onreceive = onreceive
+
+        # where network stats go, sentry's own unless someone wants them kept apart
+        self.stats = counter
+
+        self.loop = EventLoop()
+
+        # responses produced during one pass of the loop go out together
+        self.batch = DatagramBatch(batch_size)
+        self.outbox = []
+
+        self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp_socket.setblocking(0)
+        bind(self.udp_socket, host, port, reuse_port)
+
+        # when asked for any port, tcp listens on the one udp got
+        self.port = self.udp_socket.getsockname()[1]
+
+        self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp_socket.setblocking(0)
+        bind(self.tcp_socket, host, self.port, reuse_port)
+
+        self.tcp_timeout = tcp_timeout
+        self.tcp_max_connections = tcp_connections
+        self.tcp_connections = 0
+
+        self.context = {'server' : '%s:%s' % (self.host, self.port)}
+
+        log.info("Server started on %s:%s" %  (self.host, self.port) )
+
+    def start(self):
+        self.tcp_socket.listen(TCP_BACKLOG)
+
+        self.loop.add_reader(self.udp_socket.fileno(), self.udp_readable)
+        self.loop.add_reader(self.tcp_socket.fileno(), self.tcp_acceptable)
+
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            log.info('stopping')
+            self.stop()
+
+    def stop(self):
+        self.loop.stop()
+        log.debug('network node stopped.')
+
+    def udp_readable(self):
+        for _ in xrange(self.MAX_READS):
+            batch = self.batch.recv(self.udp_socket)
+            if not batch:
+                return
+
+            batchio.record('recv', len(batch), self.stats)
+
+            for data, addr in batch:
+                self.stats.add('net.packets_received', 1)
+                self.stats.add('net.bytes_received', len(data))
+                self.datagram_received(data, addr)
+
+            if len(batch) < self.batch.size:
+                return
+
+    def tcp_acceptable(self):
+        for _ in xrange(self.MAX_READS):
+            try:
+                sock, addr = self.tcp_socket.accept()
+            except socket.error as e:
+                if _would_block(e):
+                    return
+                raise
+
+            if self.tcp_connections >= self.tcp_max_connections:
+                log.warn('too many tcp connections, dropping %s:%s' % addr)
+                self.stats.add('net.tcp.connections_rejected', 1)
+                sock.close()
+                continue
+
+            self.stats.add('net.tcp.connections', 1)
+            self.tcp_connections += 1
+            AsyncTCPConnection(self, sock, addr)
+
+    def tcp_closed(self, connection):
+        self.tcp_connections -= 1
+
+    def _receive(self, data, addr, transport, respond):
+        context = dict(self.context)
+        context['client'] = '%s:%s' % (addr)
+        context['transport'] = transport
+
+        try:
+            response = self.onreceive(data, context, loop=self.loop)
+        except Exception as e:
+            log.exception(e)
+            respond(None)
+            return
+
+        if isinstance(response, futures.Future):
+            response.add_done_callback(lambda f: respond(self._result(f)))
+        else:
+            respond(response)
+
+    def _result(self, future):
+        if future.exception() is not None:
+            log.error(future.exception())
+            return None
+
+        return future.result()
+
+    def datagram_received(self, data, addr):
+        self._receive(data, addr, 'udp', lambda response: self.sendto(response, addr))
+
+    def tcp_message_received(self, connection, data):
+        self.stats.add('net.packets_received', 1)
+        self.stats.add('net.bytes_received', len(data))
+        self._receive(data, connection.addr, 'tcp', connection.write)
+
+    def sendto(self, response, addr):
+        if response is None:
+            return
+
+        if not self.outbox:
+            self.loop.call_soon(self.flush)
 
+        self.outbox.append((response, addr))
 
+    def flush(self):
+        while self.outbox:
+            messages, self.outbox = self.outbox[:self.batch.size], self.outbox[self.batch.size:]
 
+            s = self.batch.send(self.udp_socket, messages)
+            batchio.record('send', len(messages), self.stats)
+            self.stats.add('net.packets_sent', len(messages))
+            self.stats.add('net.bytes_sent', s)
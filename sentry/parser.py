@@ -1,59 +1,226 @@
+import re, sys, logging, os, stat, json, hashlib
 
-import re, sys, logging
-from sentry import rules, profile
+from sentry import rules, profile, __version__
+from sentry.index import RuleIndex
 
 log = logging.getLogger(__name__)
 
+# more specific syntaxes go first, the first rule that matches a line wins
 RULES = [
 	rules.RedirectRule,
-	rules.BlockRule,
+	rules.BlockListRule,
 	rules.ConditionalBlockRule,
+	rules.BlockRule,
 	rules.LoggingRule,
 	rules.ResolveRule,
 	rules.RewriteRule,
 
 ]
 
+# the rules every verb could be, in RULES order
+VERBS = {}
+for rule in RULES:
+	VERBS.setdefault(rule.VERB, []).append(rule)
+
+# bumped whenever what goes into the compiled ruleset cache changes
+CACHE_FORMAT = 2
+
+
+def compile_line(settings, line):
+	"""
+	the rule for a config line, None if it isn't one. only the syntaxes of
+	rules starting with the line's first word get tried.
+	"""
+	for rule in VERBS.get(line.split(' ', 1)[0], ()):
+
+		# for every syntax of that rule
+		for syntax in rule.SYNTAX:
+			match = syntax.search(line)
+
+			if match is None:
+				continue
+
+			try:
+				args = match.groupdict()
+				compiled = rule(settings, match.group('domain').strip(), args)
+
+				# bad regexes should show up now, not on the first query
+				compiled.RE
+
+			except Exception as e:
+				log.error('syntax error in line: %s - skipping' % line)
+				log.exception(e)
+				continue
+
+			compiled.line = line
+			compiled.args = args
+			return compiled
+
+	return None
+
+
 @profile.howfast
-def parse(settings):
+def parse(settings, previous=None):
 	"""
-	matches the syntax rules for every known rule against lines in the config
+	builds a rule for every line in the config. previous maps lines to rules
+	built earlier (see by_line), lines found there reuse those rules instead
+	of building new ones.
 	"""
 
 	ruleset = []
-	matched = False
+	kept = []
 
-	# breaking up ruleset
 	for line in settings['rules']:
-		log.debug('parsing: %s' % line)
 
-		# for every rule we known of:
-		for rule in RULES:
+		rule = previous.get(line) if previous is not None else None
 
-			# for every syntax of that rule
-			for re in rule.SYNTAX:
-				match = re.search(line)
+		if rule is not None and not rule.outdated():
+			kept.append(rule)
+		else:
+			rule = compile_line(settings, line)
 
-				if match is not None:
-					try:
-						log.debug('line %s matched by %s' % (line, re) )
-						domain = match.group('domain').strip()
-						ruleset.append(rule(settings, domain, match.groupdict() ))
+		if rule is None:
+			log.info('no rules match line [%s] ignoring it' % line)
+			continue
 
-						matched = True
-						# if we found a match, we don't keep looking
-						break
+		ruleset.append(rule)
 
-					except Exception as e:
-						log.error('syntax error in line: %s - skipping' % line)
-						log.exception(e)
+	# rules we kept hang on to their state, new ones share it
+	kept_ids = set(id(rule) for rule in kept)
+	share(kept + [rule for rule in ruleset if id(rule) not in kept_ids])
 
-		if not matched:
-			log.info('no rules match line [%s] ignoring it' % line)
+	log.debug('parsed %d rules, reused %d', len(ruleset), len(kept))
+	return ruleset
 
-		matched = False
 
-	log.debug(ruleset)
-	return ruleset
+def share(ruleset):
+	"""
+	rules in the same pool (such as resolve rules asking the same resolvers)
+	take over the state of the first one instead of keeping their own
+	"""
+	pools = {}
+
+	for rule in ruleset:
+		key = rule.pool()
+		if key is None:
+			continue
+
+		first = pools.setdefault((type(rule), key), rule)
+		if first is not rule:
+			rule.share(first)
+
 
+def by_line(ruleset):
+	"""
+	maps every config line to the rule built from it, for handing to parse()
+	"""
+	lines = {}
+	for rule in ruleset:
+		lines.setdefault(rule.line, rule)
+	return lines
+
+
+def build(settings, previous=None):
+	"""
+	the RuleIndex for settings. with ruleset_cache_dir set, rulesets built
+	from scratch are saved there, and the next start with the same settings
+	loads them instead of parsing and indexing every line again.
+	"""
+	cache_dir = settings.get('ruleset_cache_dir')
+
+	if cache_dir is None or previous is not None:
+		return RuleIndex(parse(settings, previous))
+
+	key = _cache_key(settings)
+	if key is None:
+		return RuleIndex(parse(settings))
+
+	path = os.path.join(cache_dir, 'ruleset-%s.json' % key)
+
+	# whoever can write the cache decides what our rules are
+	if not _trusted(cache_dir):
+		log.warn('not using ruleset cache %s, it has to be ours and writable by us alone' % cache_dir)
+		return RuleIndex(parse(settings))
+
+	index = _load(path, key, settings)
+	if index is not None:
+		log.info('loaded %d compiled rules from %s' % (len(index), path))
+		return index
+
+	index = RuleIndex(parse(settings))
+	_save(path, key, index)
+	return index
+
+
+def _trusted(path):
+	"""
+	whether path belongs to us and nobody else can write to it
+	"""
+	try:
+		st = os.stat(path)
+	except OSError:
+		return False
+	return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+
+def _cache_key(settings):
+	try:
+		text = json.dumps(settings, sort_keys=True)
+	except (TypeError, ValueError):
+		return None
+	return hashlib.sha1('%s %s %s' % (__version__, CACHE_FORMAT, text)).hexdigest()
+
+
+def _load(path, key, settings):
+	if not os.path.exists(path):
+		return None
+
+	if not _trusted(path):
+		log.warn('not loading compiled ruleset %s, it has to be ours and writable by us alone' % path)
+		return None
+
+	try:
+		with open(path, 'rb') as f:
+			cached = json.load(f)
+	except (IOError, OSError, ValueError) as e:
+		log.error('could not read compiled ruleset %s: %s' % (path, e))
+		return None
+
+	if not isinstance(cached, dict) or cached.get('format') != CACHE_FORMAT or cached.get('key') != key:
+		return None
+
+	classes = dict((rule.__name__, rule) for rule in RULES)
+	ruleset = []
 
+	try:
+		for name, domain, args, line in cached['rules']:
+			# regexes were checked when the cache was made, they compile once needed
+			rule = classes[name](settings, domain, args)
+			rule.line = line
+			rule.args = args
+			ruleset.append(rule)
+
+		index = RuleIndex(ruleset, cached['index'])
+	except Exception as e:
+		log.error('could not rebuild rules from %s, parsing the config: %s' % (path, e))
+		return None
+
+	share(ruleset)
+	return index
+
+
+def _save(path, key, index):
+	cached = {
+		'format' : CACHE_FORMAT,
+		'key' : key,
+		'rules' : [(rule.__class__.__name__, rule.domain, rule.args, rule.line) for rule in index],
+		'index' : index.state(),
+	}
+
+	temp = '%s.%d' % (path, os.getpid())
+	try:
+		with open(temp, 'wb') as f:
+			json.dump(cached, f)
+		os.rename(temp, path)
+	except (IOError, OSError) as e:
+		log.error('could not save compiled ruleset %s: %s' % (path, e))
@@ -0,0 +1,144 @@
+import logging, threading, time, json, os, atexit
+
+from Queue import Queue, Empty, Full
+
+from sentry import stats
+
+log = logging.getLogger(__name__)
+
+DEFAULT_QUEUE_SIZE = 10000
+
+# most records written per write() call
+BATCH_SIZE = 256
+
+# longest a record waits in the queue before it's written out
+FLUSH_INTERVAL = 1.0
+
+FIELDS = ('ts', 'action', 'name', 'type', 'class', 'client', 'transport', 'rule')
+
+_STOP = object()
+
+
+class QueryLog(object):
+    """
+    writes query records as json lines from a background thread. the query
+    path only drops a tuple in a bounded queue, when the writer can't keep up
+    records are dropped and counted in querylog.dropped instead of blocking.
+    """
+
+    def __init__(self, path, queue_size=DEFAULT_QUEUE_SIZE):
+        self.path = path
+        self.queue_size = queue_size
+        self.queue = Queue(queue_size)
+        self.pid = os.getpid()
+        self.fd = None
+        self.inode = None
+
+        self.thread = threading.Thread(None, self.writer, name='query-log')
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def record(self, action, query, rule, context):
+        try:
+            self.queue.put_nowait((time.time(), action, query.qname, query.qtype, query.qclass,
+                                   context.get('client'), context.get('transport'), rule.domain))
+        except Full:
+            stats.add('querylog.dropped', 1)
+
+    def _open(self):
+        # reopen once logrotate moved the file away
+        try:
+            inode = os.stat(self.path).st_ino
+        except OSError:
+            inode = None
+
+        if self.fd is None or inode != self.inode:
+            if self.fd is not None:
+                self.fd.close()
+            self.fd = open(self.path, 'a')
+            self.inode = os.fstat(self.fd.fileno()).st_ino
+
+        return self.fd
+
+    def writer(self):
+        while True:
+            try:
+                batch = [self.queue.get(True, FLUSH_INTERVAL)]
+            except Empty:
+                continue
+
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+
+            stop = any(r is _STOP for r in batch)
+            records = [r for r in batch if r is not _STOP]
+
+            if records:
+                try:
+                    fd = self._open()
+                    fd.write(''.join(json.dumps(dict(zip(FIELDS, r))) + '\n' for r in records))
+                    fd.flush()
+                    stats.add('querylog.written', len(records))
+                except (IOError, OSError) as e:
+                    log.error('could not write query log %s: %s' % (self.path, e))
+                    stats.add('querylog.dropped', len(records))
+
+            if stop:
+                return
+
+    def close(self, timeout=FLUSH_INTERVAL):
+        """
+        writes out whatever is queued and stops the writer
+        """
+        try:
+            self.queue.put(_STOP, True, timeout)
+        except Full:
+            pass
+        self.thread.join(timeout)
+
+        if self.fd is not None:
+            self.fd.close()
+            self.fd = None
+
+
+_log = None
+
+
+def configure(path, queue_size=DEFAULT_QUEUE_SIZE):
+    """
+    starts logging queries to path, None turns it off
+    """
+    global _log
+
+    if _log is not None:
+        _log.close()
+
+    _log = QueryLog(path, queue_size) if path else None
+
+
+def record(action, query, rule, context):
+    """
+    queues a record of rule acting on query, False when there's no query log
+    so callers can fall back to plain logging
+    """
+    global _log
+
+    if _log is None:
+        return False
+
+    # forked workers get the queue but not the writer thread
+    if _log.pid != os.getpid():
+        _log = QueryLog(_log.path, _log.queue_size)
+
+    _log.record(action, query, rule, context)
+    return True
+
+
+def _close():
+    if _log is not None:
+        _log.close()
+
+atexit.register(_close)
@@ -1,4 +1,4 @@
-import sys, logging, re, random
+import sys, logging, re, random, weakref
 
 import futures
 
@@ -7,37 +7,108 @@ import dns.rrset
 import dns.query
 import dns.name
 
-from sentry import stats, errors, profile
+from sentry import stats, errors, profile, upstream, wire, querylog, blocklist
+from sentry import cache
+from sentry.cache import ResponseCache, DEFAULT_SIZE as DEFAULT_CACHE_SIZE
 
 log = logging.getLogger(__name__)
 RETRIES = 3
 DEFAULT_TTL = 300
 DEFAULT_TIMEOUT = 1.0
 
+# expired answers are kept for a day in case upstream goes away, the first
+# minute of that they are handed out right away while we fetch a fresh one
+DEFAULT_MAX_STALE = 86400
+DEFAULT_STALE_WINDOW = 60
+
+# compiled domain regexes, rules with the same domain share one
+_patterns = weakref.WeakValueDictionary()
+
+def pattern(domain):
+    """ the compiled regex for domain """
+    compiled = _patterns.get(domain)
+    if compiled is None:
+        compiled = _patterns[domain] = re.compile(domain)
+    return compiled
+
+class _Pattern(object):
+    """
+    a rule's RE: its domain, compiled the first time it's used. rules loaded
+    from the compiled ruleset cache only pay for the regexes queries need.
+    """
+
+    def __get__(self, rule, owner):
+        if rule is None:
+            return self
+        rule.RE = compiled = pattern(rule.domain)
+        return compiled
+
 class Rule(object):
     """
     Parent class for all rules.
 
     - rules can return either None or a valid response. None responses are ignored.
+    - rules get a wire.Query, its full dns message is only parsed when a rule asks for query.message
+    - rules with fixed answers build a wire.ResponseTemplate once and render it per query
 
     """
 
+    # whether the rule index can file this rule under its domain regex
+    INDEXABLE = True
+
+    # the word the rule's lines start with, the parser only tries rules with the line's
+    VERB = None
+
+    # the config line the rule was built from and what the parser got out
+    # of it, set by the parser
+    line = None
+    args = None
+
+    RE = _Pattern()
+
     def __init__(self, settings, domain, args):
         self.domain = domain
-        self.RE = re.compile(domain)
         self.settings = settings
 
-    def dispatch(self, message, *args, **extras):
+    def dispatch(self, query, *args, **extras):
         log.info('dummy act being called, nothing will happen')
         pass
 
+    def outdated(self):
+        """
+        whether a reload should rebuild the rule even though its line didn't change
+        """
+        return False
+
+    def pool(self):
+        """
+        rules with the same pool (when not None) can share state, see share()
+        """
+        return None
+
+    def share(self, other):
+        """
+        takes over the state of an earlier rule in the same pool
+        """
+        pass
+
     def __str__(self):
         return 'rule [%s] domain [%s]' % (self.__class__, self.domain)
 
+def _copy(source, destination, transform=None):
+    """ hands the outcome of one future over to another """
+    if source.exception() is not None:
+        destination.set_exception(source.exception())
+    elif transform is not None:
+        destination.set_result(transform(source.result()))
+    else:
+        destination.set_result(source.result())
+
 class RedirectRule(Rule):
     """
     redirects a query using a CNAME
     """
+    VERB = 'redirect'
     SYNTAX = [
         # redirect ^(.*)google.com to nytimes.com
         re.compile(r'^redirect (?P<domain>.*) to (?P<destination>.*)$',flags=re.MULTILINE)
@@ -48,38 +119,75 @@ class RedirectRule(Rule):
         if not self.dst.endswith('.'):
             self.dst += '.'
 
+        # the answer never changes, only the id and question around it do
+        self.template = wire.ResponseTemplate([
+            wire.record(wire.CNAME, DEFAULT_TTL, dns.name.from_text(self.dst).to_wire())
+        ])
+
         super(RedirectRule,self).__init__(settings, domain, args)
 
     @profile.howfast
-    def dispatch(self, message, *args, **extras):
-        response = dns.message.make_response(message)
-        response.answer.append(
-            dns.rrset.from_text(message.question[0].name, DEFAULT_TTL, dns.rdataclass.IN, dns.rdatatype.CNAME, self.dst)
-        )
-
-        return response.to_wire()
+    def dispatch(self, query, *args, **extras):
+        return self.template.render(query)
 
 class BlockRule(Rule):
     """
     blocks the request by simply returning an empty response
     """
+    VERB = 'block'
     SYNTAX = [
         # block ^(.*)exmaple.xxx
         re.compile(r'^block (?P<domain>.*)$',flags=re.MULTILINE)
     ]
 
     @profile.howfast
-    def dispatch(self, message, *args, **extras):
+    def dispatch(self, query, *args, **extras):
         context = extras.pop('context', {})
-        log.warn('blocking query: %s matched by rule: %s with context: %s' % (message.question[0].name, self.domain, context) )
-        response = dns.message.make_response(message)
-        return response.to_wire()
+        if not querylog.record('block', query, self, context):
+            log.warn('blocking query: %s matched by rule: %s with context: %s', query.qname, self.domain, context)
+        return wire.EMPTY.render(query)
+
+class BlockListRule(Rule):
+    """
+    blocks every name listed in a hosts style file, and every name under them
+    """
+    VERB = 'block'
+    SYNTAX = [
+        # block list /etc/sentry/hosts.txt
+        re.compile(r'^block list (?P<domain>\S+)$',flags=re.MULTILINE)
+    ]
+
+    # a regex can't help finding these, the list is checked on every query
+    INDEXABLE = False
+
+    def __init__(self, settings, domain, args):
+        self.domain = domain
+        self.settings = settings
+        self.version = blocklist.version(domain)
+        self.names = blocklist.load(domain, settings.get('blocklist_index_dir'))
+
+        # the rule index matches names through RE, the list stands in for a regex
+        self.RE = self.names
+
+    def outdated(self):
+        try:
+            return blocklist.version(self.domain) != self.version
+        except OSError:
+            return False
+
+    @profile.howfast
+    def dispatch(self, query, *args, **extras):
+        context = extras.pop('context', {})
+        if not querylog.record('block', query, self, context):
+            log.warn('blocking query: %s listed in: %s with context: %s', query.qname, self.domain, context)
+        return wire.EMPTY.render(query)
 
 class ConditionalBlockRule(Rule):
     """
     blocks the request based upon some simple if logic
     """
 
+    VERB = 'block'
     SYNTAX = [
         #block ^(.*).xxx if type is MX and class is ANY
         re.compile(r'^block (?P<domain>.*) if type is (?P<type>.*) and class is (?P<class>.*)$',flags=re.MULTILINE),
@@ -104,38 +212,36 @@ class ConditionalBlockRule(Rule):
         super(ConditionalBlockRule,self).__init__(settings, domain, args)
 
     @profile.howfast
-    def dispatch(self, message, *args, **extras):
+    def dispatch(self, query, *args, **extras):
         context = extras.pop('context', {})
 
-        q = message.question[0]
-
-
-        if self.rdtype is not None and q.rdtype != self.rdtype:
+        if self.rdtype is not None and query.qtype != self.rdtype:
             return None
 
-        if self.rdclass is not None and q.rdclass != self.rdclass:
+        if self.rdclass is not None and query.qclass != self.rdclass:
             return None
 
-        log.warn('conditionally blocking query: %s matched by rule: %s with context: %s' % (message.question[0].name, self.domain, context) )
+        if not querylog.record('conditional_block', query, self, context):
+            log.warn('conditionally blocking query: %s matched by rule: %s with context: %s', query.qname, self.domain, context)
 
-        response = dns.message.make_response(message)
-
-        return response.to_wire()
+        return wire.EMPTY.render(query)
 
 
 class LoggingRule(Rule):
     """
     logs the query and nothing else
     """
+    VERB = 'log'
     SYNTAX = [
         # log ^(.*)example.com
         re.compile(r'^log (?P<domain>.*)$',flags=re.MULTILINE)
     ]
 
     @profile.howfast
-    def dispatch(self,message, *args, **extras):
+    def dispatch(self, query, *args, **extras):
         context = extras.pop('context', {})
-        log.info('logging query: %s matched by rule: %s with context: %s' % (message.question[0].name, self.domain, context) )
+        if not querylog.record('log', query, self, context):
+            log.info('logging query: %s matched by rule: %s with context: %s', query.qname, self.domain, context)
         return None
 
 
@@ -144,6 +250,7 @@ class ResolveRule(Rule):
     resolves a query using a specific DNS Server
     """
 
+    VERB = 'resolve'
     SYNTAX = [
         # resolve ^(.*)example using 8.8.4.4, 8.8.8.8
         re.compile(r'^resolve (?P<domain>.*) using (?P<resolvers>.*)$',flags=re.MULTILINE)
@@ -155,33 +262,189 @@ class ResolveRule(Rule):
         self.resolvers =  map(lambda x: x.strip(), resolvers.split(','))
         log.debug('resolvers: %s' % self.resolvers)
 
+        # resolvers can be given as host, host:port or [ipv6 address]:port
+        self.upstreams = [upstream.parse_address(resolver) for resolver in self.resolvers]
+
         # how long we wait on upstream dns servers before puking
         self.timeout = settings.get('resolution_timeout', DEFAULT_TIMEOUT)
         log.debug('timeout: %d' % self.timeout)
 
-        self.pool = futures.ThreadPoolExecutor(max_workers=len(self.resolvers))
+        # which resolvers get asked and when
+        strategy = settings.get('upstream_strategy', upstream.DEFAULT_STRATEGY)
+        if strategy not in upstream.STRATEGIES:
+            raise errors.Error('unknown upstream strategy %s, pick one of: %s' % (strategy, ', '.join(upstream.STRATEGIES)))
+        self.strategy = getattr(upstream, strategy)
 
-        super(ResolveRule,self).__init__(settings, domain, args)
+        # answers we already got from upstream, a size of 0 turns caching off
+        cache_size = settings.get('cache_size', DEFAULT_CACHE_SIZE)
+        self.cache = ResponseCache(cache_size,
+            max_stale=settings.get('cache_max_stale', DEFAULT_MAX_STALE),
+            stale_window=settings.get('cache_stale_window', DEFAULT_STALE_WINDOW),
+            prefetch=settings.get('cache_prefetch', True)) if cache_size > 0 else None
 
-    @profile.howfast
-    def dispatch(self, message, *args, **extras):
+        # resolutions on their way, identical queries wait on them
+        self.inflight = {}
 
-        # used for querying dns servers in parallel:
-        @profile.howfast
-        def _resolver(message, resolver):
-            log.debug('sending %s to %s ' % (message,resolver))
-            return dns.query.udp(message, resolver, timeout=self.timeout).to_wire()
+        super(ResolveRule,self).__init__(settings, domain, args)
 
-        fs = [ self.pool.submit( _resolver, message, resolver) for resolver in self.resolvers ]
-        result = futures.wait(fs,return_when=futures.FIRST_COMPLETED).done.pop()
+    def pool(self):
+        # the same resolvers give the same answers, one cache will do
+        return tuple(self.upstreams)
 
-        if not result.exception():
-            return result.result()
+    def share(self, other):
+        self.cache = other.cache
+        self.inflight = other.inflight
 
+    @profile.howfast
+    def dispatch(self, query, *args, **extras):
+        tcp = extras.get('context', {}).get('transport') == 'tcp'
+        response = self.answer(query, extras.get('loop'), tcp)
+
+        if tcp:
+            return response
+
+        # answers fetched over tcp may not fit in a udp one
+        if isinstance(response, futures.Future):
+            result = futures.Future()
+            response.add_done_callback(lambda f: _copy(f, result, lambda r: wire.truncate(r, query)))
+            return result
+
+        return wire.truncate(response, query)
+
+    def answer(self, query, loop, tcp=False):
+        """
+        the answer to query from the cache or upstream, over tcp if the
+        client asked over tcp
+        """
+        stale = None
+
+        if self.cache is not None:
+            response, state = self.cache.lookup(query)
+
+            if state == cache.FRESH:
+                return response
+
+            if state in (cache.PREFETCH, cache.STALE):
+                if state == cache.STALE:
+                    stats.add('cache.stale_served', 1)
+                self.refresh(query, loop)
+                return response
+
+            # an expired answer we only fall back to
+            stale = response
+
+        if loop is not None:
+            return self.resolve_or_stale(query, loop, stale, tcp)
+
+        # engines without a loop of their own wait on the shared upstream loop
+        loop = upstream.background_loop()
+        result = futures.Future()
+
+        def _start():
+            self.resolve_or_stale(query, loop, stale, tcp).add_done_callback(lambda f: _copy(f, result))
+
+        loop.call_soon_threadsafe(_start)
+
+        try:
+            return result.result(self.budget(tcp) + 1)
+        except futures.TimeoutError:
+            if stale is not None:
+                stats.add('cache.stale_served', 1)
+                return stale
+            raise errors.NetworkError('timed out resolving query %s using %s' % (query, self.resolvers))
+
+    def budget(self, tcp=False):
+        """
+        the longest a resolution can take: one try over tcp, or one over udp
+        and another over tcp when the udp answer comes back truncated
+        """
+        return self.timeout if tcp else 2 * self.timeout
+
+    def refresh(self, query, loop=None):
+        """
+        resolves query in the background so the cache gets a fresh answer
+        """
+        stats.add('cache.refreshes', 1)
+
+        if loop is None:
+            loop = upstream.background_loop()
+            loop.call_soon_threadsafe(self.resolve, query, loop)
         else:
-            log.error(result.exception())
-
-        raise errors.NetworkError('could not resolve query %s using %s' % (message, self.resolvers))
+            self.resolve(query, loop)
+
+    def resolve_or_stale(self, query, loop, stale, tcp=False):
+        """
+        resolve(), answering with the stale response if upstream fails
+        """
+        future = self.resolve(query, loop, tcp)
+        if stale is None:
+            return future
+
+        result = futures.Future()
+
+        def _done(f):
+            if f.exception() is not None:
+                stats.add('cache.stale_served', 1)
+                result.set_result(stale)
+            else:
+                result.set_result(f.result())
+
+        future.add_done_callback(_done)
+        return result
+
+    def resolve(self, query, loop, tcp=False):
+        """
+        queries the resolvers through the upstream pools on loop and returns a
+        future of the first good answer. queries for a question that's already
+        being resolved wait on that instead of asking upstream again.
+        """
+        key = cache.key_of(query) + (query.flags & (wire.RD | wire.CD), tcp)
+        flight = self.inflight.get(key)
+
+        if flight is not None:
+            stats.add('upstream.coalesced', 1)
+            result = futures.Future()
+            flight.add_done_callback(lambda f: _copy(f, result, lambda response: wire.readdress(response, query)))
+            return result
+
+        flight = self._resolve(query, loop, tcp)
+        self.inflight[key] = flight
+
+        def _land(f):
+            if self.inflight.get(key) is flight:
+                del self.inflight[key]
+
+        flight.add_done_callback(_land)
+        return flight
+
+    def _resolve(self, query, loop, tcp=False):
+        result = futures.Future()
+
+        def _done(f, tcp=tcp):
+            if f.exception() is not None:
+                log.error(f.exception())
+                result.set_exception(errors.NetworkError('could not resolve query %s using %s' % (query, self.resolvers)))
+                return
+
+            response = f.result()
+
+            # truncated over udp, the whole answer takes tcp
+            if not tcp and wire.HEADER.unpack_from(response)[1] & wire.TC:
+                stats.add('upstream.truncated', 1)
+                self._ask(query, loop, True).add_done_callback(lambda f: _done(f, True))
+                return
+
+            if self.cache is not None:
+                self.cache.put(query, response)
+            result.set_result(response)
+
+        self._ask(query, loop, tcp).add_done_callback(_done)
+
+        return result
+
+    def _ask(self, query, loop, tcp):
+        upstreams = [upstream.get(host, port, loop, self.settings, tcp) for host, port in self.upstreams]
+        return self.strategy(upstreams, query, self.timeout)
 
 class RewriteRule(Rule):
     """
@@ -190,6 +453,7 @@ class RewriteRule(Rule):
     # note: rewrite rules are experimental and might not work with all DNS clients
     """
 
+    VERB = 'rewrite'
     SYNTAX = [
         # rewrite ^www.google.com to google.com
         re.compile(r'^rewrite (?P<domain>.*) to (?P<pattern>.*)$',flags=re.MULTILINE)
@@ -200,8 +464,10 @@ class RewriteRule(Rule):
         super(RewriteRule,self).__init__(settings, domain, args)
 
     @profile.howfast
-    def dispatch(self, message, *args, **extras):
-        log.debug('domain: %s pattern: %s message: %s' % (self.domain, self.pattern, message))
-        message.question[0].name = dns.name.from_text(self.pattern)
+    def dispatch(self, query, *args, **extras):
+        context = extras.get('context', {})
+        log.debug('domain: %s pattern: %s query: %s', self.domain, self.pattern, query)
+        querylog.record('rewrite', query, self, context)
+        query.rename(self.pattern)
 
         return None
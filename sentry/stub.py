@@ -0,0 +1,241 @@
+import logging, random, threading, zlib, sys, subprocess, argparse, StringIO
+
+import futures
+import dns.name
+import dns.rdata
+import dns.rdataclass
+import dns.rdatatype
+
+from sentry import wire, LOG_FORMAT
+from sentry.network import AsyncServer
+from sentry.counter import Counter
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PORT = 5353
+DEFAULT_TTL = 300
+
+NXDOMAIN = 3
+SERVFAIL = 2
+
+# answers are built once per name and type, this many are kept around
+MAX_TEMPLATES = 100000
+
+SERVFAIL_RESPONSE = wire.ResponseTemplate(rcode=SERVFAIL)
+NXDOMAIN_RESPONSE = wire.ResponseTemplate(rcode=NXDOMAIN)
+
+
+def read_zone(path):
+    """
+    yields (name, ttl, rdtype, rdata) for every record in a zone file with
+    one record per line: name [ttl] [class] type rdata. comments start with
+    ; or #, names are taken as absolute.
+    """
+    with open(path) as f:
+        for line in f:
+            line = line.split(';', 1)[0].split('#', 1)[0].strip()
+            if not line:
+                continue
+
+            tokens = line.split()
+            name, tokens = tokens[0], tokens[1:]
+
+            ttl = DEFAULT_TTL
+            if tokens[0].isdigit():
+                ttl, tokens = int(tokens[0]), tokens[1:]
+
+            if tokens[0].upper() in ('IN', 'CH', 'HS', 'ANY'):
+                tokens = tokens[1:]
+
+            yield name, ttl, tokens[0].upper(), ' '.join(tokens[1:])
+
+
+def _rdata(rdtype, text):
+    """ wire format rdata for a record written out as text """
+    rdata = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.from_text(rdtype), text, dns.name.root)
+    f = StringIO.StringIO()
+    rdata.to_wire(f, None, dns.name.root)
+    return f.getvalue()
+
+
+def synthesize(name, rdtype):
+    """
+    made up but stable rdata for any name: A, AAAA, MX, NS and TXT records,
+    None for other types
+    """
+    h = zlib.crc32(name) & 0xffffffff
+
+    if rdtype == 'A':
+        return '10.%d.%d.%d' % ((h >> 16) & 0xff, (h >> 8) & 0xff, h & 0xff)
+    if rdtype == 'AAAA':
+        return 'fd00::%x:%x' % (h >> 16, h & 0xffff)
+    if rdtype == 'MX':
+        return '10 mail.%s' % name
+    if rdtype == 'NS':
+        return 'ns1.%s' % name
+    if rdtype == 'TXT':
+        return '"sentry stub"'
+    return None
+
+
+class StubServer(object):
+    """
+    an authoritative stand in for upstream dns servers, for tests and
+    benchmarks that can't (or shouldn't) reach the internet. answers come
+    from a zone file, or are made up for any name when synthesizing, and
+    responses can be slowed down, jittered, dropped or turned into SERVFAILs
+    at configurable rates. the same seed misbehaves the same way every run.
+
+    runs on the async engine, in a thread of its own with start() or in the
+    foreground with serve().
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, zone=None, synthesize=True, ttl=DEFAULT_TTL,
+                 latency=0, jitter=0, loss=0, servfail=0, seed=None):
+        self.synthesize = synthesize
+        self.ttl = ttl
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.servfail = servfail
+        self.rand = random.Random(seed)
+
+        # name -> rdtype -> [wire records]
+        self.records = {}
+        if zone is not None:
+            self.load(zone)
+
+        self.templates = {}
+
+        self.queries = 0
+        self.dropped = 0
+        self.servfails = 0
+
+        # our traffic isn't the sentry under test's, keep it out of its stats
+        self.stats = Counter()
+        self.server = AsyncServer(host, port, self.answer, counter=self.stats)
+        self.host, self.port = host, self.server.port
+        self.address = '%s:%d' % (self.host, self.port)
+
+    def load(self, path):
+        count = 0
+        for name, ttl, rdtype, text in read_zone(path):
+            name = name.lower().rstrip('.') + '.'
+            record = wire.record(dns.rdatatype.from_text(rdtype), ttl, _rdata(rdtype, text))
+            self.records.setdefault(name, {}).setdefault(rdtype, []).append(record)
+            count += 1
+
+        self.templates = {}
+        log.info('loaded %d records from %s' % (count, path))
+
+    def start(self):
+        t = threading.Thread(None, self.serve, name='stub-%d' % self.port)
+        t.setDaemon(True)
+        t.start()
+        return self
+
+    def serve(self):
+        self.server.start()
+
+    def stop(self):
+        self.server.stop()
+
+    def template(self, name, rdtype):
+        """ the canned response for name and rdtype """
+        key = (name, rdtype)
+        template = self.templates.get(key)
+
+        if template is not None:
+            return template
+
+        rdtype_text = dns.rdatatype.to_text(rdtype)
+        known = self.records.get(name)
+
+        if known is not None:
+            # names with a CNAME answer every type with it, we don't chase it
+            template = wire.ResponseTemplate(known.get(rdtype_text) or known.get('CNAME', []))
+        elif self.synthesize:
+            text = synthesize(name, rdtype_text)
+            answers = [] if text is None else [wire.record(rdtype, self.ttl, _rdata(rdtype_text, text))]
+            template = wire.ResponseTemplate(answers)
+        else:
+            template = NXDOMAIN_RESPONSE
+
+        if len(self.templates) >= MAX_TEMPLATES:
+            self.templates = {}
+        self.templates[key] = template
+
+        return template
+
+    def answer(self, packet, context, loop=None):
+        self.queries += 1
+        query = wire.parse(packet)
+
+        if self.loss and self.rand.random() < self.loss:
+            self.dropped += 1
+            return None
+
+        if self.servfail and self.rand.random() < self.servfail:
+            self.servfails += 1
+            response = SERVFAIL_RESPONSE.render(query)
+        else:
+            response = self.template(query.qname.lower(), query.qtype).render(query)
+
+        delay = self.latency
+        if self.jitter:
+            delay += self.rand.uniform(-self.jitter, self.jitter)
+
+        if delay <= 0 or loop is None:
+            return response
+
+        future = futures.Future()
+        loop.call_later(delay, future.set_result, response)
+        return future
+
+
+def spawn(**options):
+    """
+    runs a StubServer in a child process, returns (process, host:port).
+    options are StubServer's, the port defaults to any free one.
+    """
+    args = [sys.executable, '-m', 'sentry.stub', '--port', str(options.pop('port', 0))]
+
+    for option, value in sorted(options.items()):
+        if option == 'synthesize':
+            if not value:
+                args.append('--no-synthesize')
+            continue
+        args += ['--%s' % option, str(value)]
+
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    return process, process.stdout.readline().strip()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='stub upstream dns server for testing and benchmarking sentry')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=DEFAULT_PORT, type=int, help='defaults to %d, 0 picks a free one' % DEFAULT_PORT)
+    parser.add_argument('--zone', help='zone file to answer from, one record per line')
+    parser.add_argument('--no-synthesize', action='store_true', help='NXDOMAIN for names not in the zone instead of making records up')
+    parser.add_argument('--ttl', default=DEFAULT_TTL, type=int, help='ttl of made up records')
+    parser.add_argument('--latency', default=0, type=float, help='seconds every response is held back')
+    parser.add_argument('--jitter', default=0, type=float, help='up to this many seconds more or less latency')
+    parser.add_argument('--loss', default=0, type=float, help='share of queries never answered')
+    parser.add_argument('--servfail', default=0, type=float, help='share of queries answered with SERVFAIL')
+    parser.add_argument('--seed', type=int)
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.WARN)
+
+    stub = StubServer(options.host, options.port, options.zone, not options.no_synthesize, options.ttl,
+                      options.latency, options.jitter, options.loss, options.servfail, options.seed)
+
+    # whoever started us reads the address off the first line
+    sys.stdout.write('%s\n' % stub.address)
+    sys.stdout.flush()
+
+    stub.serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,298 @@
+import logging, os, signal, socket, struct, threading, time, errno
+import cPickle as pickle
+
+from sentry import counter, topk, stats, domain_stats
+
+log = logging.getLogger(__name__)
+
+# workers that die faster than this after starting get restarted with a pause
+RESPAWN_DELAY = 1.0
+
+# how long we wait on a worker to hand over its stats
+STATS_TIMEOUT = 2.0
+
+# stats replies are prefixed with their length, anything longer than this is garbage
+SIZE = struct.Struct('!I')
+MAX_STATS_SIZE = 64 * 1024 * 1024
+
+
+def stats_responder(sock):
+    """
+    runs in every worker, answers the supervisor's requests for stats
+    """
+    while True:
+        try:
+            if not sock.recv(1):
+                return
+            payload = pickle.dumps((stats.snapshot(), domain_stats.snapshot()), pickle.HIGHEST_PROTOCOL)
+            sock.sendall(SIZE.pack(len(payload)) + payload)
+        except socket.error as e:
+            log.debug('stats channel closed: %s' % e)
+            return
+
+
+class StatsChannel(object):
+    """
+    the supervisor's end of a worker's stats socket. workers answer requests
+    in order, so replies to requests that timed out are read and thrown away
+    before the next one, and a reply cut off by a timeout is picked up where
+    it stopped.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = ''
+        self.outstanding = 0
+
+    def request(self, timeout=STATS_TIMEOUT):
+        """ asks the worker for its stats, returns the pickled reply """
+        deadline = time.time() + timeout
+
+        self.sock.settimeout(timeout)
+        self.sock.sendall('s')
+        self.outstanding += 1
+
+        while self.outstanding > 1:
+            self._reply(deadline)
+
+        return self._reply(deadline)
+
+    def _reply(self, deadline):
+        while True:
+            if len(self.buffer) >= SIZE.size:
+                size = SIZE.unpack_from(self.buffer)[0]
+                if size > MAX_STATS_SIZE:
+                    self.reset()
+                    raise socket.error('stats reply of %d bytes' % size)
+
+                end = SIZE.size + size
+                if len(self.buffer) >= end:
+                    reply, self.buffer = self.buffer[SIZE.size:end], self.buffer[end:]
+                    self.outstanding -= 1
+                    return reply
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout('timed out')
+
+            self.sock.settimeout(remaining)
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise socket.error('worker hung up')
+            self.buffer += chunk
+
+    def reset(self):
+        """ throws away whatever the worker sent, after a reply made no sense """
+        self.buffer = ''
+        self.outstanding = 0
+
+        self.sock.setblocking(0)
+        try:
+            while self.sock.recv(65536):
+                pass
+        except socket.error:
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+class Supervisor(object):
+    """
+    forks worker processes that all bind the same port with SO_REUSEPORT,
+    so the kernel spreads queries across them, and restarts any that die
+    """
+
+    def __init__(self, sentry, workers):
+        self.sentry = sentry
+        self.size = workers
+        self.workers = {}
+        self.stopping = False
+
+        # the metrics server and SIGUSR1 may both ask for stats
+        self.collect_lock = threading.Lock()
+
+    def fork_locks(self):
+        """
+        locks our other threads (metrics, config watch and reloads) take that
+        workers use too, in the order they are taken in
+        """
+        locks = [self.sentry.reload_lock, stats._lock, domain_stats._lock]
+        locks += [handler.lock for handler in logging.getLogger().handlers if handler.lock is not None]
+        return locks
+
+    def fork(self):
+        """
+        os.fork() holding fork_locks(), so the worker doesn't start out with
+        one of them held by a thread it doesn't have. both sides let go.
+        """
+        locks = self.fork_locks()
+        for lock in locks:
+            lock.acquire()
+
+        try:
+            return os.fork()
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def spawn(self, slot):
+        ours, theirs = socket.socketpair()
+        pid = self.fork()
+
+        if pid == 0:
+            # worker: serve until told otherwise, never return into the supervisor's code
+            status = 0
+            try:
+                ours.close()
+                for _, channel, _ in self.workers.values():
+                    channel.close()
+
+                if self.sentry.metrics is not None:
+                    self.sentry.metrics.close()
+
+                # the supervisor's own counts stay with the supervisor
+                stats.reset()
+                domain_stats.reset()
+
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.signal(signal.SIGUSR1, self.sentry.usr1_signal_handler)
+                signal.signal(signal.SIGUSR2, self.sentry.usr2_signal_handler)
+                signal.signal(signal.SIGHUP, self.sentry.hup_signal_handler)
+
+                t = threading.Thread(None, stats_responder, name='stats-responder', args=(theirs,))
+                t.setDaemon(True)
+                t.start()
+
+                self.sentry.serve(reuse_port=True)
+
+            except Exception as e:
+                log.exception(e)
+                status = 1
+
+            finally:
+                os._exit(status)
+
+        theirs.close()
+        self.workers[pid] = (slot, StatsChannel(ours), time.time())
+        log.info('started worker %d with pid %d' % (slot, pid))
+
+    def start(self, ready=None):
+        """
+        forks the workers and looks after them until they are stopped. ready
+        is called once they are all up, threads of our own start from there.
+        """
+        signal.signal(signal.SIGUSR1, self.usr1_signal_handler)
+        signal.signal(signal.SIGUSR2, self.usr2_signal_handler)
+        signal.signal(signal.SIGHUP, self.hup_signal_handler)
+        signal.signal(signal.SIGTERM, self.term_signal_handler)
+
+        for slot in range(self.size):
+            self.spawn(slot)
+
+        if ready is not None:
+            ready()
+
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            except KeyboardInterrupt:
+                log.info('stopping')
+                self.stop()
+                continue
+
+            if pid not in self.workers:
+                continue
+
+            slot, channel, started = self.workers.pop(pid)
+            channel.close()
+
+            if self.stopping:
+                continue
+
+            log.error('worker %d (pid %d) died with status %d, restarting it' % (slot, pid, status))
+            stats.add('workers.restarts', 1)
+
+            if time.time() - started < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY)
+
+            self.spawn(slot)
+
+    def signal_workers(self, num):
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, num)
+            except OSError:
+                pass
+
+    def stop(self):
+        self.stopping = True
+        self.signal_workers(signal.SIGTERM)
+
+    def usr2_signal_handler(self, num, frame):
+        # workers do the profiling, each one toggles its own
+        self.signal_workers(signal.SIGUSR2)
+
+    def reload(self):
+        """
+        reloads our own rules, so restarted workers come up with them, and
+        has every worker reload theirs
+        """
+        if self.sentry.reload():
+            self.signal_workers(signal.SIGHUP)
+
+    def hup_signal_handler(self, num, frame):
+        t = threading.Thread(None, self.reload, name='config-reload')
+        t.setDaemon(True)
+        t.start()
+
+    def term_signal_handler(self, num, frame):
+        log.info('got SIGTERM, stopping workers')
+        self.stop()
+
+    def collect(self):
+        """
+        returns (stats, domain_stats) counters summed over every worker
+        """
+        with self.collect_lock:
+            return self._collect()
+
+    def _collect(self):
+        total, domains = counter.Counter(), topk.TopK(domain_stats.size, decay_interval=0)
+        total.merge(stats.snapshot())
+
+        for pid, (slot, channel, started) in self.workers.items():
+            try:
+                reply = channel.request(STATS_TIMEOUT)
+            except (socket.error, socket.timeout) as e:
+                log.error('could not get stats from worker %d (pid %d): %s' % (slot, pid, e))
+                continue
+
+            # whatever a worker sends, a bad reply must not take the supervisor down
+            try:
+                worker_stats, worker_domains = pickle.loads(reply)
+            except Exception as e:
+                log.error('bad stats from worker %d (pid %d): %s' % (slot, pid, e))
+                channel.reset()
+                continue
+
+            total.merge(worker_stats)
+            domains.merge(worker_domains)
+
+        return total, domains
+
+    def dump_stats(self):
+        total, domains = self.collect()
+        self.sentry.dump_stats(total, domains)
+
+    def usr1_signal_handler(self, num, frame):
+        # the main thread forks workers, it must never wait on the locks fork() holds
+        t = threading.Thread(None, self.dump_stats, name='stats-dump')
+        t.setDaemon(True)
+        t.start()
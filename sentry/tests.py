@@ -1,12 +1,29 @@
-import unittest, logging, sys
+import unittest, logging, sys, socket, threading, struct, time, os, signal, json, urllib2, tempfile, shutil, mmap, itertools, gzip, zipfile, collections
+import cPickle as pickle
 
 import dns
 import dns.rrset
 import dns.query
 import dns.name
+import dns.flags
 
 from sentry.core import Sentry
-from sentry import LOG_FORMAT
+from sentry.network import Server, AsyncServer, frame
+from sentry import network
+from sentry.index import RuleIndex
+from sentry.cache import ResponseCache
+from sentry import cache
+from sentry.counter import Counter
+from sentry.topk import TopK, registered_domain
+from sentry.metrics import MetricsServer, prometheus
+from sentry.supervisor import Supervisor, StatsChannel, SIZE
+from sentry import supervisor as supervisor_module
+from sentry.batchio import DatagramBatch
+from sentry.loop import EventLoop
+from sentry.upstream import Upstream
+from sentry.stub import StubServer, spawn
+from sentry.benchmark import SentryBenchmark, OpenLoop, load_profile, query_packet, report
+from sentry import parser, rules, stats, errors, wire, profile, querylog, blocklist, workload, microbench, LOG_FORMAT
 
 log = logging.getLogger('sentry')
 logging.basicConfig(format=LOG_FORMAT, level=logging.DEBUG)
@@ -17,6 +34,14 @@ class SentryTests(unittest.TestCase):
         'client' : '%s:%s' % ('1.1.1.1',5300),
         'server' : '%s:%s' % ('2.2.2.2', 1000)
      }
+
+    @classmethod
+    def setUpClass(cls):
+        cls.stub = StubServer().start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.stop()
     
     def test_block_rule(self):
         sentry = Sentry({
@@ -33,7 +58,7 @@ class SentryTests(unittest.TestCase):
         sentry = Sentry({
             'rules' : [ 
                 'block ^(.*).xxx',
-                'resolve ^(.*) using 8.8.4.4, 8.8.8.8'
+                'resolve ^(.*) using %s' % self.stub.address
              ]
         })
         message = dns.message.make_query('foo.com', 'A')
@@ -75,7 +100,7 @@ class SentryTests(unittest.TestCase):
     def test_resolve(self):
         sentry = Sentry({
             'rules' : [ 
-                'resolve ^(.*) using 8.8.4.4, 8.8.8.8'
+                'resolve ^(.*) using %s' % self.stub.address
              ]
             })
 
@@ -92,7 +117,7 @@ class SentryTests(unittest.TestCase):
                 'block ^(.*).xxx',
                 'block ^(.*).edu if type is MX and class is ANY',   
                 'block ^(.*).biz if class is ANY',  
-                'resolve ^(.*) using 8.8.4.4, 8.8.8.8'          
+                'resolve ^(.*) using %s' % self.stub.address          
              ]
             })
 
@@ -158,6 +183,1541 @@ class SentryTests(unittest.TestCase):
         self.assertEqual(response.answer[0].to_text(),'nytimes.com. 300 IN CNAME google.com.')
 
 
+class RuleIndexTests(unittest.TestCase):
+
+    RULES = [
+        'block ^(.*)youtube.com if type is MX',
+        'block ^(.*).xxx',
+        'log ^(.*)google.com',
+        'rewrite ^www.google.com to google.com',
+        'redirect ^(.*)nytimes.com$ to google.com',
+        'block ^(.*)porn|sex(.*).(.*)',
+        'log ^ads\\.',
+        'block doubleclick',
+        'log ^(.*)disney(.*).com',
+        'resolve ^(.*)facebook.com using 10.10.1.2',
+        'resolve ^(.*) using 8.8.4.4, 8.8.8.8',
+    ]
+
+    NAMES = [
+        'foo.xxx.', 'youtube.com.', 'www.youtube.com.', 'www.google.com.',
+        'google.com.', 'nytimes.com.', 'nytimes.com.evil.', 'sexy.org.',
+        'ads.example.com.', 'adsXexample.com.', 'ad.doubleclick.net.',
+        'disneyland.co.com.', 'facebookXcom.', 'example.org.', '.',
+    ]
+
+    def test_matches_linear_scan(self):
+        ruleset = parser.parse({'rules': self.RULES})
+        index = RuleIndex(ruleset)
+
+        for name in self.NAMES:
+            start = 0
+            while True:
+                expected = None
+                for position in range(start, len(ruleset)):
+                    if ruleset[position].RE.search(name) is not None:
+                        expected = position
+                        break
+
+                position, rule = index.match(name, start)
+                self.assertEqual(position, expected, name)
+
+                if expected is None:
+                    break
+                start = expected + 1
+
+    def test_large_ruleset(self):
+        rules = ['block ^(.*)domain%d.com' % i for i in range(5000)]
+        rules.append('resolve ^(.*) using 8.8.8.8')
+        index = RuleIndex(parser.parse({'rules': rules}))
+
+        position, rule = index.match('www.domain4999.com.')
+        self.assertEqual(position, 4999)
+
+        position, rule = index.match('example.com.')
+        self.assertEqual(position, 5000)
+
+    def test_inline_flags_stay_out_of_the_prefilter(self):
+        # (?x) in one pattern must not turn the others verbose
+        ruleset = parser.parse({'rules': ['block (?x) ^ads \\.', 'log ^(a|b) c\\.$']})
+        index = RuleIndex(ruleset)
+
+        self.assertEqual(index.match('adsXexample.com.')[0], None)
+        self.assertEqual(index.match('ads.example.com.')[0], 0)
+        self.assertEqual(index.match('a c.')[0], 1)
+
+
+def make_query(name, rdtype='A', **kwargs):
+    return wire.parse(dns.message.make_query(name, rdtype, **kwargs).to_wire())
+
+
+class WireTests(unittest.TestCase):
+
+    def test_question_matches_dnspython(self):
+        for name in ['example.com', 'WWW.Example.com', 'a-b_c.example.com', 'we\\ird\\(name\\).com', '\\001x.com']:
+            message = dns.message.make_query(name, 'MX', rdclass=dns.rdataclass.ANY)
+            query = wire.parse(message.to_wire())
+
+            self.assertEqual(query.qname, str(message.question[0].name))
+            self.assertEqual(query.qtype, dns.rdatatype.MX)
+            self.assertEqual(query.qclass, dns.rdataclass.ANY)
+            self.assertEqual(query.id, message.id)
+
+    def test_empty_response_matches_dnspython(self):
+        for message in [dns.message.make_query('example.com', 'A'), dns.message.make_query('example.com', 'A', use_edns=0)]:
+            query = wire.parse(message.to_wire())
+            self.assertEqual(wire.empty_response(query), dns.message.make_response(message).to_wire())
+
+    def test_redirect_template(self):
+        sentry = Sentry({'rules' : ['redirect ^(.*)nytimes.com to google.com']})
+
+        for message in [dns.message.make_query('www.nytimes.com', 'A'), dns.message.make_query('nytimes.com', 'AAAA', use_edns=0)]:
+            response = dns.message.from_wire(sentry.process(message.to_wire(), {}))
+
+            self.assertTrue(message.is_response(response))
+            self.assertEqual(response.edns, message.edns)
+            self.assertEqual(response.answer[0].to_text(), '%s 300 IN CNAME google.com.' % message.question[0].name)
+
+    def test_malformed(self):
+        packet = dns.message.make_query('example.com', 'A').to_wire()
+        self.assertRaises(wire.FormError, wire.parse, packet[:8])
+        self.assertRaises(wire.FormError, wire.parse, packet[:20])
+
+    def test_rename(self):
+        query = make_query('www.google.com', 'A', use_edns=0)
+        query.rename('google.com')
+
+        self.assertEqual(query.qname, 'google.com.')
+        self.assertEqual(str(query.message.question[0].name), 'google.com.')
+        self.assertEqual(query.payload(), query.message.payload)
+
+    def test_truncate(self):
+        message = dns.message.make_query('example.com', 'TXT')
+        response = dns.message.make_response(message)
+        response.answer.append(dns.rrset.from_text('example.com.', 60, 'IN', 'TXT', *['"%s"' % (c * 200) for c in 'abcde']))
+        packet = response.to_wire()
+
+        # too big for plain udp, the client is told to come back over tcp
+        truncated = dns.message.from_wire(wire.truncate(packet, wire.parse(message.to_wire())))
+        self.assertTrue(truncated.flags & dns.flags.TC)
+        self.assertTrue(message.is_response(truncated))
+        self.assertEqual(truncated.answer, [])
+
+        # fits in what an EDNS client takes
+        message.use_edns(0, payload=4096)
+        self.assertEqual(wire.truncate(packet, wire.parse(message.to_wire())), packet)
+
+
+class ResponseCacheTests(unittest.TestCase):
+
+    def answer(self, query, ttl=60):
+        response = dns.message.make_response(query.message)
+        response.answer.append(
+            dns.rrset.from_text(query.qname, ttl, 'IN', 'A', '10.0.0.1')
+        )
+        return response.to_wire()
+
+    def test_hit_rewrites_id_and_ttl(self):
+        cache = ResponseCache(10)
+        now = [1000.0]
+        cache.clock = lambda: now[0]
+
+        message = make_query('example.com', 'A')
+        cache.put(message, self.answer(message))
+
+        now[0] += 20
+        query = make_query('EXAMPLE.com', 'A')
+        response = dns.message.from_wire(cache.get(query))
+
+        self.assertEqual(response.id, query.id)
+        self.assertEqual(str(response.question[0].name), 'EXAMPLE.com.')
+        self.assertEqual(response.answer[0].ttl, 40)
+
+        now[0] += 41
+        self.assertEqual(cache.get(query), None)
+
+    def test_edns_answers_stay_with_edns_clients(self):
+        cache = ResponseCache(10)
+
+        edns = make_query('example.com', 'A', use_edns=0)
+        cache.put(edns, self.answer(edns))
+
+        # the answer carries an OPT record plain clients never asked for
+        plain = make_query('example.com', 'A')
+        self.assertEqual(cache.get(plain), None)
+
+        # nor does it have the DNSSEC records a DO query wants
+        dnssec = make_query('example.com', 'A', want_dnssec=True)
+        self.assertTrue(dnssec.edns()[1] & wire.DO)
+        self.assertEqual(cache.get(dnssec), None)
+
+        response = dns.message.from_wire(cache.get(make_query('example.com', 'A', use_edns=0)))
+        self.assertEqual(response.edns, 0)
+
+    def test_negative_answers(self):
+        cache = ResponseCache(10)
+        message = make_query('nope.example.com', 'A')
+
+        response = dns.message.make_response(message.message)
+        response.set_rcode(dns.rcode.NXDOMAIN)
+        cache.put(message, response.to_wire())
+        self.assertEqual(cache.get(message), None)
+
+        response.authority.append(dns.rrset.from_text('example.com.', 3600, 'IN', 'SOA',
+            'ns.example.com. admin.example.com. 1 7200 3600 1209600 300'))
+        cache.put(message, response.to_wire())
+
+        cached = dns.message.from_wire(cache.get(message))
+        self.assertEqual(cached.rcode(), dns.rcode.NXDOMAIN)
+        self.assertEqual(cached.authority[0].ttl, 300)
+
+    def test_prefetch_and_stale(self):
+        responses = ResponseCache(10, max_stale=600, stale_window=60)
+        now = [1000.0]
+        responses.clock = lambda: now[0]
+
+        query = make_query('example.com', 'A')
+        responses.put(query, self.answer(query, ttl=100))
+
+        self.assertEqual(responses.lookup(query)[1], cache.FRESH)
+
+        # popular and about to expire, refresh it but only once
+        now[0] += 95
+        self.assertEqual(responses.lookup(query)[1], cache.PREFETCH)
+        self.assertEqual(responses.lookup(query)[1], cache.FRESH)
+
+        now[0] += 10
+        response, state = responses.lookup(query)
+        self.assertEqual(state, cache.STALE)
+        self.assertEqual(dns.message.from_wire(response).answer[0].ttl, cache.STALE_TTL)
+        self.assertEqual(responses.get(query), None)
+
+        now[0] += 60
+        self.assertEqual(responses.lookup(query)[1], cache.EXPIRED)
+
+        now[0] += 600
+        self.assertEqual(responses.lookup(query), (None, cache.MISS))
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(2)
+        evictions = dict((m['name'], m['value']) for m in stats.get_metrics()).get('cache.evictions', 0)
+
+        queries = [make_query('host%d.com' % i, 'A') for i in range(3)]
+        cache.put(queries[0], self.answer(queries[0]))
+        cache.put(queries[1], self.answer(queries[1]))
+        cache.get(queries[0])
+        cache.put(queries[2], self.answer(queries[2]))
+
+        self.assertEqual(len(cache), 2)
+        self.assertNotEqual(cache.get(queries[0]), None)
+        self.assertEqual(cache.get(queries[1]), None)
+        self.assertEqual(dict((m['name'], m['value']) for m in stats.get_metrics())['cache.evictions'], evictions + 1)
+
+
+class FakeUpstream(object):
+    """
+    answers every query it gets with an A record, over udp and with tcp on
+    the same port as well. truncate sends TC=1 and no answer over udp.
+    """
+
+    def __init__(self, address='10.0.0.1', delay=0, tcp=False, truncate=False):
+        self.address = address
+        self.delay = delay
+        self.truncate = truncate
+        self.tcp_connections = 0
+
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(('127.0.0.1', 0))
+        self.port = self.udp.getsockname()[1]
+        self.serve(self.serve_udp)
+
+        self.tcp = None
+        if tcp:
+            self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.tcp.bind(('127.0.0.1', self.port))
+            self.tcp.listen(5)
+            self.serve(self.serve_tcp)
+
+    def serve(self, target, *args):
+        t = threading.Thread(target=target, args=args)
+        t.setDaemon(True)
+        t.start()
+
+    def answer(self, data, truncate=False):
+        time.sleep(self.delay)
+        query = dns.message.from_wire(data)
+        response = dns.message.make_response(query)
+        if truncate:
+            response.flags |= dns.flags.TC
+        else:
+            response.answer.append(dns.rrset.from_text(query.question[0].name, 60, 'IN', 'A', self.address))
+        return response.to_wire()
+
+    def serve_udp(self):
+        while True:
+            try:
+                data, addr = self.udp.recvfrom(1024)
+            except socket.error:
+                return
+            self.udp.sendto(self.answer(data, self.truncate), addr)
+
+    def serve_tcp(self):
+        while True:
+            try:
+                conn, _ = self.tcp.accept()
+            except socket.error:
+                return
+            self.tcp_connections += 1
+            self.serve(self.serve_connection, conn)
+
+    def serve_connection(self, conn):
+        try:
+            while True:
+                header = conn.recv(2)
+                if len(header) < 2:
+                    return
+                size = struct.unpack('!H', header)[0]
+                data = ''
+                while len(data) < size:
+                    data += conn.recv(size - len(data))
+                conn.sendall(frame(self.answer(data)))
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def close(self):
+        self.udp.close()
+        if self.tcp is not None:
+            # accept() doesn't notice a close from another thread
+            try:
+                self.tcp.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self.tcp.close()
+
+
+def fake_upstream(address='10.0.0.1', delay=0, tcp=False, truncate=False):
+    """
+    starts a FakeUpstream, returns (host:port, upstream)
+    """
+    upstream = FakeUpstream(address, delay, tcp, truncate)
+    return '127.0.0.1:%d' % upstream.port, upstream
+
+
+class ServerTests(object):
+    """
+    runs the same network tests against every engine
+    """
+
+    def make_server(self, process):
+        raise NotImplementedError()
+
+    def setUp(self):
+        self.upstream, self.upstream_socket = fake_upstream(tcp=True)
+
+        sentry = Sentry({
+            'cache_size' : 0,
+            'rules' : [
+                'block ^(.*).xxx',
+                'resolve ^(.*) using %s' % self.upstream
+             ]
+        })
+
+        self.server = self.make_server(sentry.process)
+        self.port = self.server.port
+
+        self.thread = threading.Thread(target=self.server.start)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.upstream_socket.close()
+
+    def connect(self):
+        for _ in range(50):
+            try:
+                return socket.create_connection(('127.0.0.1', self.port), 2)
+            except socket.error:
+                time.sleep(0.05)
+        self.fail('server never started listening on tcp')
+
+    def read_exactly(self, sock, size):
+        data = ''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            self.assertNotEqual(chunk, '')
+            data += chunk
+        return data
+
+    def read_response(self, sock):
+        size = struct.unpack('!H', self.read_exactly(sock, 2))[0]
+        return dns.message.from_wire(self.read_exactly(sock, size))
+
+    def test_block_and_resolve(self):
+        message = dns.message.make_query('foo.xxx', 'A')
+        response = dns.query.udp(message, '127.0.0.1', port=self.port, timeout=2)
+        assert len(response.answer) is 0
+
+        for i in range(10):
+            message = dns.message.make_query('host%d.example.com' % i, 'A')
+            response = dns.query.udp(message, '127.0.0.1', port=self.port, timeout=2)
+            self.assertEqual(response.id, message.id)
+            self.assertEqual(response.answer[0][0].address, '10.0.0.1')
+
+    def test_tcp_pipelining(self):
+        sock = self.connect()
+
+        queries = [dns.message.make_query('foo.xxx', 'A')]
+        queries += [dns.message.make_query('host%d.example.com' % i, 'A') for i in range(5)]
+        sock.sendall(''.join(frame(q.to_wire()) for q in queries))
+
+        responses = dict((r.id, r) for r in [self.read_response(sock) for q in queries])
+
+        self.assertEqual(len(responses[queries[0].id].answer), 0)
+        for query in queries[1:]:
+            self.assertEqual(responses[query.id].answer[0][0].address, '10.0.0.1')
+
+        sock.close()
+
+    def test_tcp_idle_timeout(self):
+        sock = self.connect()
+        sock.settimeout(5)
+        self.assertEqual(sock.recv(1), '')
+
+
+class ThreadedServerTests(ServerTests, unittest.TestCase):
+
+    def make_server(self, process):
+        return Server('127.0.0.1', 0, process, 2, tcp_timeout=0.2)
+
+
+class AsyncServerTests(ServerTests, unittest.TestCase):
+
+    def make_server(self, process):
+        return AsyncServer('127.0.0.1', 0, process, tcp_timeout=0.2)
+
+    def test_tcp_pipeline_is_throttled(self):
+        sock = self.connect()
+        sock.settimeout(5)
+
+        throttled = dict((m['name'], m['value']) for m in stats.get_metrics()).get('net.tcp.throttled', 0)
+
+        # far more than we take at once, all in one go
+        queries = []
+        for i in range(network.MAX_TCP_PIPELINE * 3):
+            query = dns.message.make_query('host%d.example.com' % i, 'A')
+            query.id = i
+            queries.append(query)
+        sock.sendall(''.join(frame(q.to_wire()) for q in queries))
+
+        responses = dict((r.id, r) for r in [self.read_response(sock) for q in queries])
+        self.assertEqual(sorted(responses), range(len(queries)))
+        self.assertTrue(dict((m['name'], m['value']) for m in stats.get_metrics())['net.tcp.throttled'] > throttled)
+
+        sock.close()
+
+class OpenLoopTests(unittest.TestCase):
+
+    def test_load_profile(self):
+        self.assertEqual(load_profile(rate=100, duration=5), [(100.0, 100.0, 5)])
+        self.assertEqual(load_profile(step='100:300:100', duration=2), [(100.0, 100.0, 2), (200.0, 200.0, 2), (300.0, 300.0, 2)])
+
+        stages = load_profile(ramp='0:1000', duration=20)
+        self.assertEqual(len(stages), 10)
+        self.assertEqual(stages[0], (0.0, 100.0, 2.0))
+        self.assertEqual(stages[-1][1], 1000.0)
+
+        self.assertEqual(load_profile(), None)
+
+    def test_answered_and_timed_out(self):
+        sentry = Sentry({'rules' : ['block ^(.*).xxx']})
+        server = AsyncServer('127.0.0.1', 0, sentry.process)
+        thread = threading.Thread(target=server.start)
+        thread.setDaemon(True)
+        thread.start()
+
+        # nothing matches example.com, those go unanswered
+        packets = itertools.cycle([query_packet('foo.xxx'), query_packet('foo.xxx'), query_packet('example.com')])
+
+        try:
+            results = OpenLoop('127.0.0.1', server.port, packets, [(300, 300, 0.5)], timeout=0.2).run()
+        finally:
+            server.stop()
+
+        stage, stats, elapsed = results[0]
+        metrics = dict((m['name'], m['value']) for m in stats.get_metrics())
+
+        self.assertTrue(140 <= metrics['scheduled'] <= 160, metrics['scheduled'])
+        self.assertEqual(metrics['answered'] + metrics['timeouts'], metrics['sent'])
+        self.assertTrue(metrics['timeouts'] >= metrics['sent'] // 3)
+        self.assertTrue(metrics['latency_msec_p999'] >= metrics['latency_msec_p50'] > 0)
+
+        table, saturated = report(results)
+        self.assertEqual(saturated, 300)
+
+    def test_report_ramp_offers_its_mean_rate(self):
+        stats = Counter()
+        stats.add('scheduled', 200)
+        stats.add('sent', 200)
+        stats.add('answered', 200)
+
+        table, saturated = report([((100.0, 300.0, 1.0), stats, 1.0)])
+        row = table.splitlines()[3].split('|')
+
+        self.assertEqual([row[1].strip(), row[2].strip()], ['200', '200'])
+        self.assertEqual(saturated, None)
+
+
+class WorkloadTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_corpus_formats(self):
+        text = '1,google.com\n2,facebook.com\n\n3,youtube.com\n'
+
+        plain = os.path.join(self.dir, 'top.csv')
+        with open(plain, 'w') as f:
+            f.write(text)
+
+        packed = os.path.join(self.dir, 'top.csv.gz')
+        with gzip.open(packed, 'w') as f:
+            f.write(text)
+
+        archive = os.path.join(self.dir, 'top.zip')
+        with zipfile.ZipFile(archive, 'w') as z:
+            z.writestr('top-1m.csv', text)
+
+        for path in (plain, packed, archive):
+            self.assertEqual(list(workload.read_names(path)), ['google.com', 'facebook.com', 'youtube.com'])
+
+        self.assertEqual(list(workload.corpus(plain, limit=2)), [('google.com', 'A'), ('facebook.com', 'A')])
+
+        repeated = workload.corpus(plain, 'MX', limit=2, repeat=True)
+        self.assertEqual([name for name, rdtype in itertools.islice(repeated, 5)],
+            ['google.com', 'facebook.com', 'google.com', 'facebook.com', 'google.com'])
+
+    def test_synthetic(self):
+        queries = list(workload.synthetic(5000, names=1000, qtypes='A:80,MX:20', random_subdomains=0.1, seed=7))
+
+        self.assertEqual(len(queries), 5000)
+        self.assertEqual(queries, list(workload.synthetic(5000, names=1000, qtypes='A:80,MX:20', random_subdomains=0.1, seed=7)))
+
+        names = collections.Counter(name for name, rdtype in queries)
+        types = collections.Counter(rdtype for name, rdtype in queries)
+
+        # the most popular site shows up the most, and about 1 in 7.5 times for 1000 names
+        self.assertEqual(names.most_common(1)[0][0], workload.site(0))
+        self.assertTrue(500 < names[workload.site(0)] < 800)
+
+        self.assertEqual(set(types), set(['A', 'MX']))
+        self.assertTrue(800 < types['MX'] < 1200)
+
+        # random labels are 8 hex digits in front of a site
+        flood = len([name for name, rdtype in queries if not name.startswith('site')])
+        self.assertTrue(400 < flood < 600, flood)
+
+    def test_closed_loop(self):
+        sentry = Sentry({'rules' : ['redirect ^(.*) to example.org']})
+        server = AsyncServer('127.0.0.1', 0, sentry.process)
+        thread = threading.Thread(target=server.start)
+        thread.setDaemon(True)
+        thread.start()
+
+        try:
+            b = SentryBenchmark('127.0.0.1:%d' % server.port, 4, workload.synthetic(100, names=10))
+            b.start()
+        finally:
+            server.stop()
+
+        metrics = dict((m['name'], m['value']) for m in b.stats.get_metrics())
+        self.assertEqual(metrics['queries_successful'], 100)
+        self.assertEqual(metrics['response_time_msec_count'], 100)
+
+
+class MicroBenchTests(unittest.TestCase):
+
+    def setUp(self):
+        self.min_time, self.repeat = microbench.MIN_TIME, microbench.REPEAT
+        microbench.MIN_TIME, microbench.REPEAT = 0.001, 1
+
+    def tearDown(self):
+        microbench.MIN_TIME, microbench.REPEAT = self.min_time, self.repeat
+
+    def test_rules(self):
+        lines = microbench.make_rules(100)
+        self.assertEqual(len(lines), 100)
+        self.assertEqual(len(parser.parse({'rules' : lines})), 100)
+
+    def test_report(self):
+        report = json.loads(json.dumps(microbench.run([10, 50])))
+
+        results = dict(((r['name'], r.get('rules'), r.get('rule')), r) for r in report['results'])
+        self.assertTrue(results[('dispatch', None, 'ResolveRule')]['ns_per_op'] > 0)
+        self.assertTrue(results[('process', 50, None)]['ns_per_op'] > 0)
+        self.assertTrue(('parse', 10, None) in results)
+
+        baseline = {'results' : [dict(r, ns_per_op=r['ns_per_op'] * 2) for r in report['results'] if 'ns_per_op' in r]}
+        self.assertTrue('-50.0%' in microbench.table(report, baseline))
+
+
+class StubServerTests(unittest.TestCase):
+
+    ZONE = """
+; records the stub answers with
+example.com.       60 IN A     192.0.2.1
+example.com.       60 IN A     192.0.2.2
+www.example.com.   IN CNAME    example.com.
+example.com.       MX          10 mail.example.com.
+"""
+
+    def setUp(self):
+        fd, self.zone = tempfile.mkstemp()
+        os.write(fd, self.ZONE)
+        os.close(fd)
+        self.stubs = []
+
+    def tearDown(self):
+        for stub in self.stubs:
+            stub.stop()
+        os.unlink(self.zone)
+
+    def start(self, **options):
+        stub = StubServer(**options).start()
+        self.stubs.append(stub)
+        return stub
+
+    def ask(self, stub, name, rdtype='A', timeout=2):
+        return dns.query.udp(dns.message.make_query(name, rdtype), stub.host, port=stub.port, timeout=timeout)
+
+    def test_stats_are_its_own(self):
+        def received(counter):
+            return dict((m['name'], m['value']) for m in counter.get_metrics()).get('net.packets_received', 0)
+
+        stub = self.start()
+        before = received(stats)
+
+        self.ask(stub, 'example.com')
+
+        self.assertEqual(received(stats), before)
+        self.assertEqual(received(stub.stats), 1)
+
+    def test_zone(self):
+        stub = self.start(zone=self.zone, synthesize=False)
+
+        response = self.ask(stub, 'example.com')
+        self.assertEqual(sorted(r.address for r in response.answer[0]), ['192.0.2.1', '192.0.2.2'])
+        self.assertEqual(response.answer[0].ttl, 60)
+
+        self.assertEqual(self.ask(stub, 'www.example.com').answer[0][0].target.to_text(), 'example.com.')
+        self.assertEqual(self.ask(stub, 'EXAMPLE.com', 'MX').answer[0][0].preference, 10)
+
+        # known name, unknown type
+        response = self.ask(stub, 'example.com', 'TXT')
+        self.assertEqual((response.rcode(), len(response.answer)), (dns.rcode.NOERROR, 0))
+
+        self.assertEqual(self.ask(stub, 'nowhere.example.org').rcode(), dns.rcode.NXDOMAIN)
+
+    def test_synthesized(self):
+        stub = self.start(ttl=30)
+
+        first = self.ask(stub, 'anything.example.net').answer[0]
+        self.assertEqual(first.ttl, 30)
+        self.assertTrue(first[0].address.startswith('10.'))
+        self.assertEqual(self.ask(stub, 'anything.example.net').answer[0][0].address, first[0].address)
+
+        for rdtype in ('AAAA', 'MX', 'NS', 'TXT'):
+            self.assertEqual(len(self.ask(stub, 'anything.example.net', rdtype).answer), 1, rdtype)
+
+    def test_misbehaving(self):
+        stub = self.start(servfail=1.0)
+        self.assertEqual(self.ask(stub, 'example.com').rcode(), dns.rcode.SERVFAIL)
+
+        stub = self.start(loss=1.0)
+        self.assertRaises(dns.exception.Timeout, self.ask, stub, 'example.com', timeout=0.2)
+        self.assertEqual((stub.queries, stub.dropped), (1, 1))
+
+        stub = self.start(latency=0.2, jitter=0.05)
+        started = time.time()
+        self.ask(stub, 'example.com')
+        self.assertTrue(0.14 < time.time() - started < 1)
+
+    def test_resolve_through_stub(self):
+        stub = self.start(latency=0.05)
+        sentry = Sentry({'rules' : ['resolve ^(.*) using %s' % stub.address], 'resolution_timeout' : 0.02, 'cache_size' : 0})
+
+        # slower than the resolution timeout
+        self.assertRaises(errors.NetworkError, sentry.process, dns.message.make_query('example.com', 'A').to_wire(), {})
+
+        stub.latency = 0
+        response = dns.message.from_wire(sentry.process(dns.message.make_query('example.com', 'A').to_wire(), {}))
+        self.assertEqual(len(response.answer), 1)
+
+    def test_subprocess(self):
+        process, address = spawn(zone=self.zone, synthesize=False)
+        try:
+            host, port = address.split(':')
+            response = dns.query.udp(dns.message.make_query('example.com', 'A'), host, port=int(port), timeout=2)
+            self.assertEqual(len(response.answer[0]), 2)
+        finally:
+            process.terminate()
+            process.wait()
+
+
+class UpstreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = EventLoop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.stop()
+        self.thread.join()
+
+    def query_all(self, upstream, names):
+        results = {}
+        done = threading.Event()
+
+        def start():
+            for name in names:
+                future = upstream.query(make_query(name, 'A'), 1.0)
+                future.add_done_callback(lambda f, name=name: finished(name, f))
+
+        def finished(name, future):
+            results[name] = dns.message.from_wire(future.result())
+            if len(results) == len(names):
+                done.set()
+
+        self.loop.call_soon_threadsafe(start)
+        done.wait(5)
+        return results
+
+    def test_udp_sockets_are_shared(self):
+        address, sock = fake_upstream()
+        host, port = address.split(':')
+        upstream = Upstream(host, int(port), self.loop, sockets=2)
+
+        names = ['host%d.example.com.' % i for i in range(20)]
+        results = self.query_all(upstream, names)
+
+        self.assertEqual(len(results), 20)
+        for name, response in results.items():
+            self.assertEqual(str(response.answer[0].name), name)
+        self.assertEqual(upstream.pending, {})
+
+        self.loop.call_soon_threadsafe(upstream.close)
+        sock.close()
+
+    def test_ipv6_resolvers(self):
+        ruleset = parser.parse({'rules' : ['resolve ^(.*) using 2001:4860:4860::8888, [::1]:5353, 10.0.0.1:5300']})
+        self.assertEqual(ruleset[0].upstreams, [('2001:4860:4860::8888', 53), ('::1', 5353), ('10.0.0.1', 5300)])
+
+        try:
+            sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            sock.bind(('::1', 0))
+        except socket.error:
+            raise unittest.SkipTest('no ipv6 loopback')
+
+        def serve():
+            data, addr = sock.recvfrom(1024)
+            response = dns.message.make_response(dns.message.from_wire(data))
+            sock.sendto(response.to_wire(), addr)
+
+        t = threading.Thread(target=serve)
+        t.setDaemon(True)
+        t.start()
+
+        upstream = Upstream('::1', sock.getsockname()[1], self.loop, sockets=1)
+        self.assertEqual(len(self.query_all(upstream, ['v6.example.com.'])), 1)
+
+        self.loop.call_soon_threadsafe(upstream.close)
+        sock.close()
+
+    def test_tcp_pipelining(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        accepted = []
+
+        def serve():
+            conn, _ = listener.accept()
+            accepted.append(conn)
+            while True:
+                header = conn.recv(2)
+                if len(header) < 2:
+                    return
+                size = struct.unpack('!H', header)[0]
+                data = ''
+                while len(data) < size:
+                    data += conn.recv(size - len(data))
+                query = dns.message.from_wire(data)
+                response = dns.message.make_response(query)
+                response.answer.append(dns.rrset.from_text(query.question[0].name, 60, 'IN', 'A', '10.0.0.2'))
+                conn.sendall(frame(response.to_wire()))
+
+        t = threading.Thread(target=serve)
+        t.setDaemon(True)
+        t.start()
+
+        upstream = Upstream('127.0.0.1', listener.getsockname()[1], self.loop, tcp=True, tcp_connections=1)
+
+        names = ['host%d.example.com.' % i for i in range(10)]
+        results = self.query_all(upstream, names)
+
+        self.assertEqual(len(results), 10)
+        self.assertEqual(len(accepted), 1)
+
+        self.loop.call_soon_threadsafe(upstream.close)
+        listener.close()
+
+class UpstreamSelectionTests(unittest.TestCase):
+
+    def metric(self, name):
+        return dict((m['name'], m['value']) for m in stats.get_metrics()).get(name, 0)
+
+    def resolve(self, sentry, name, context={}):
+        packet = dns.message.make_query(name, 'A').to_wire()
+        return dns.message.from_wire(sentry.process(packet, context))
+
+    def test_truncated_answers_are_fetched_over_tcp(self):
+        address, upstream = fake_upstream(tcp=True, truncate=True)
+        sentry = Sentry({'rules' : ['resolve ^(.*) using %s' % address], 'cache_size' : 0})
+
+        # tcp clients have the question asked over tcp right away
+        response = self.resolve(sentry, 'tcp.example.com', {'transport' : 'tcp'})
+        self.assertFalse(response.flags & dns.flags.TC)
+        self.assertEqual(response.answer[0][0].address, '10.0.0.1')
+        self.assertEqual(upstream.tcp_connections, 1)
+
+        # udp clients get it over tcp once the udp answer comes back truncated
+        truncated = self.metric('upstream.truncated')
+        response = self.resolve(sentry, 'udp.example.com', {'transport' : 'udp'})
+        self.assertEqual(response.answer[0][0].address, '10.0.0.1')
+        self.assertEqual(self.metric('upstream.truncated'), truncated + 1)
+
+        upstream.close()
+
+    def test_waits_for_the_tcp_retry(self):
+        # each try takes most of the timeout, together they take longer than it
+        address, upstream = fake_upstream(delay=1.7, tcp=True, truncate=True)
+        sentry = Sentry({'rules' : ['resolve ^(.*) using %s' % address], 'cache_size' : 0, 'resolution_timeout' : 2})
+
+        response = self.resolve(sentry, 'slow.example.com', {'transport' : 'udp'})
+        self.assertEqual(response.answer[0][0].address, '10.0.0.1')
+
+        upstream.close()
+
+    def test_falls_back_when_an_upstream_fails(self):
+        closed = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        closed.bind(('127.0.0.1', 0))
+        dead = '127.0.0.1:%d' % closed.getsockname()[1]
+        closed.close()
+
+        good, sock = fake_upstream()
+        sentry = Sentry({'rules' : ['resolve ^(.*) using %s, %s' % (dead, good)], 'cache_size' : 0})
+
+        fallbacks = self.metric('upstream.fallbacks')
+        response = self.resolve(sentry, 'fallback.example.com')
+
+        self.assertEqual(response.answer[0].to_text(), 'fallback.example.com. 60 IN A 10.0.0.1')
+        self.assertEqual(self.metric('upstream.fallbacks'), fallbacks + 1)
+        sock.close()
+
+    def test_hedges_around_a_slow_upstream(self):
+        silent = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        silent.bind(('127.0.0.1', 0))
+        slow = '127.0.0.1:%d' % silent.getsockname()[1]
+
+        good, sock = fake_upstream()
+        sentry = Sentry({'rules' : ['resolve ^(.*) using %s, %s' % (slow, good)], 'cache_size' : 0})
+
+        started = time.time()
+        for i in range(5):
+            response = self.resolve(sentry, 'hedge%d.example.com' % i)
+            self.assertEqual(len(response.answer), 1)
+
+        # one hedge to learn the slow one is slow, then it's skipped
+        self.assertTrue(time.time() - started < 0.5)
+        self.assertEqual(self.metric('upstream.%s.queries' % slow), 1)
+        self.assertEqual(self.metric('upstream.%s.queries' % good), 5)
+
+        silent.close()
+        sock.close()
+
+    def test_serves_stale_when_upstreams_fail(self):
+        good, sock = fake_upstream()
+        sentry = Sentry({'rules' : ['resolve ^(.*) using %s' % good]})
+        rule = sentry.ruleset[0]
+
+        self.assertEqual(len(self.resolve(sentry, 'stale.example.com').answer), 1)
+
+        # past the point of serving it right away, upstream is gone
+        now = time.time() + 60 + 120
+        rule.cache.clock = lambda: now
+        sock.close()
+
+        stale = self.metric('cache.stale_served')
+        response = self.resolve(sentry, 'stale.example.com')
+
+        self.assertEqual(response.answer[0].to_text(), 'stale.example.com. 30 IN A 10.0.0.1')
+        self.assertEqual(self.metric('cache.stale_served'), stale + 1)
+
+    def test_prefetches_popular_answers(self):
+        good, sock = fake_upstream()
+        sentry = Sentry({'rules' : ['resolve ^(.*) using %s' % good]})
+        rule = sentry.ruleset[0]
+
+        self.resolve(sentry, 'prefetch.example.com')
+        self.resolve(sentry, 'prefetch.example.com')
+        self.assertEqual(self.metric('upstream.%s.queries' % good), 1)
+
+        # 55 of the answer's 60 seconds are gone
+        rule.cache.clock = lambda: time.time() + 55
+        self.assertEqual(len(self.resolve(sentry, 'prefetch.example.com').answer), 1)
+
+        for _ in range(50):
+            if self.metric('upstream.%s.queries' % good) == 2:
+                break
+            time.sleep(0.01)
+
+        self.assertEqual(self.metric('upstream.%s.queries' % good), 2)
+        sock.close()
+
+    def test_identical_queries_are_coalesced(self):
+        good, sock = fake_upstream(delay=0.2)
+        sentry = Sentry({'rules' : ['resolve ^(.*) using %s' % good], 'cache_size' : 0})
+
+        queries = [dns.message.make_query('popular.example.com' if i % 2 else 'POPULAR.example.com', 'A') for i in range(10)]
+        responses = {}
+
+        def ask(message):
+            responses[message.id] = dns.message.from_wire(sentry.process(message.to_wire(), {}))
+
+        threads = [threading.Thread(target=ask, args=(message,)) for message in queries]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(self.metric('upstream.%s.queries' % good), 1)
+        for message in queries:
+            self.assertTrue(message.is_response(responses[message.id]))
+            self.assertEqual(responses[message.id].question[0].name.to_text(), message.question[0].name.to_text())
+
+        sock.close()
+
+class DatagramBatchTests(unittest.TestCase):
+
+    def roundtrip(self, batch):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        client.bind(('127.0.0.1', 0))
+        client.settimeout(2)
+
+        self.assertEqual(batch.recv(server), [])
+
+        for i in range(6):
+            client.sendto('query %d' % i, server.getsockname())
+
+        received = batch.recv(server) + batch.recv(server)
+        self.assertEqual([data for data, addr in received], ['query %d' % i for i in range(6)])
+        self.assertEqual(received[0][1], client.getsockname())
+
+        sent = batch.send(server, [('answer %d' % i, addr) for i, (data, addr) in enumerate(received)])
+        self.assertEqual(sent, sum(len('answer %d' % i) for i in range(6)))
+        self.assertEqual([client.recv(100) for i in range(6)], ['answer %d' % i for i in range(6)])
+
+        server.close()
+        client.close()
+
+    def test_native(self):
+        self.roundtrip(DatagramBatch(4))
+
+    def test_fallback(self):
+        self.roundtrip(DatagramBatch(4, native=False))
+
+
+class CounterTests(unittest.TestCase):
+
+    def test_snapshot_merge(self):
+        a, b = Counter(), Counter()
+
+        a.add('queries', 2)
+        a.add_avg('response_time_msec', 4.0)
+        a.inc_ops('requests')
+        b.add('queries', 3)
+        b.add_avg('response_time_msec', 1.0)
+        b.add_avg('response_time_msec', 10.0)
+        b.inc_ops('requests')
+        b.dec_ops('requests')
+
+        total = Counter()
+        total.merge(a.snapshot())
+        total.merge(b.snapshot())
+        metrics = dict((m['name'], m['value']) for m in total.get_metrics())
+
+        self.assertEqual(metrics['queries'], 5)
+        self.assertEqual(metrics['response_time_msec_avg'], 5.0)
+        self.assertEqual(metrics['response_time_msec_min'], 1.0)
+        self.assertEqual(metrics['response_time_msec_max'], 10.0)
+        self.assertEqual(metrics['requests_total'], 2)
+        self.assertEqual(metrics['requests_pending'], 1)
+
+    def test_histogram_percentiles(self):
+        a, b = Counter(), Counter()
+
+        for i in xrange(1, 1001):
+            (a if i % 2 else b).add_histogram('latency', float(i))
+
+        total = Counter()
+        total.merge(a.snapshot())
+        total.merge(b.snapshot())
+        metrics = dict((m['name'], m['value']) for m in total.get_metrics())
+
+        self.assertEqual(metrics['latency_count'], 1000)
+        for suffix, expected in (('p50', 500), ('p90', 900), ('p99', 990), ('p999', 999)):
+            self.assertAlmostEqual(metrics['latency_' + suffix], expected, delta=expected * 0.035)
+
+    def test_concurrent_writers(self):
+        counter = Counter()
+
+        def work():
+            for i in xrange(10000):
+                counter.add('queries')
+                counter.add_avg('size', float(i))
+                counter.inc_ops('requests')
+
+        def finish():
+            for i in xrange(10000):
+                counter.dec_ops('requests')
+
+        threads = [threading.Thread(target=work) for _ in range(8)] + [threading.Thread(target=finish) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        # every writer thread is gone, their shards get retired on read
+        metrics = dict((m['name'], m['value']) for m in counter.get_metrics())
+        self.assertEqual(counter._shards, [])
+
+        self.assertEqual(metrics['queries'], 80000)
+        self.assertEqual(metrics['size_avg'], 4999.5)
+        self.assertEqual(metrics['size_max'], 9999)
+        self.assertEqual(metrics['requests_total'], 80000)
+        self.assertEqual(metrics['requests_pending'], 0)
+
+
+class TopKTests(unittest.TestCase):
+
+    def test_heavy_hitters_survive_churn(self):
+        top = TopK(50)
+
+        for i in xrange(5000):
+            top.add('random%d.example.com.' % i)
+            if i % 10 == 0:
+                top.add('busy.com.')
+            if i % 20 == 0:
+                top.add('less-busy.com.')
+
+        self.assertEqual(len(top), 50)
+
+        entries = top.top(2)
+        self.assertEqual([key for key, count, error in entries], ['busy.com.', 'less-busy.com.'])
+
+        # counts are upper bounds, the error says by how much at most
+        key, count, error = entries[0]
+        self.assertTrue(count - error <= 500 <= count)
+
+    def test_merge_rollup_and_decay(self):
+        now = [1000.0]
+        top = TopK(10, rollup=True, decay_interval=60)
+        top.clock = lambda: now[0]
+        top.reset()
+
+        for name in ['www.bbc.co.uk.', 'news.bbc.co.uk.', 'www.google.com.']:
+            top.add(name)
+
+        other = TopK(10)
+        other.merge(top.snapshot())
+        self.assertEqual(dict((m['name'], m['value']) for m in other.get_metrics()), {'bbc.co.uk.': 2, 'google.com.': 1})
+
+        # the clock is looked at every 1024 adds: 1 + 1021 halved, then 3 more
+        now[0] += 61
+        for _ in xrange(1024):
+            top.add('www.google.com.')
+        self.assertEqual(dict((m['name'], m['value']) for m in top.get_metrics())['google.com.'], 511 + 3)
+
+        self.assertEqual(registered_domain('a.b.example.org.'), 'example.org.')
+
+
+class MetricsTests(unittest.TestCase):
+
+    def test_per_sec(self):
+        counter = Counter()
+        counter.set_per_sec('queries')
+
+        counter.add('queries', 10)
+        counter.per_sec()
+        counter.add('queries', 100)
+        time.sleep(0.1)
+        counter.per_sec()
+
+        rate = dict((m['name'], m['value']) for m in counter.get_metrics())['queries_per_sec']
+        self.assertTrue(200 < rate <= 1000, rate)
+
+    def test_http_export(self):
+        counter, domains = Counter(), TopK(10)
+        counter.add('cache.hits', 3)
+        counter.add_histogram('response_time_msec', 2.0)
+        counter.add(rules.BlockRule, 1)
+        domains.add('google.com.', 2)
+
+        server = MetricsServer('127.0.0.1', 0, lambda: (counter, domains))
+        server.start()
+
+        try:
+            url = 'http://127.0.0.1:%d' % server.port
+
+            text = urllib2.urlopen(url + '/metrics').read()
+            self.assertTrue('sentry_cache_hits 3\n' in text)
+            self.assertTrue('sentry_response_time_msec_p99 ' in text)
+            self.assertTrue('sentry_class_sentry_rules_BlockRule 1\n' in text)
+            self.assertTrue('sentry_domain_queries{domain="google.com."} 2\n' in text)
+
+            payload = json.loads(urllib2.urlopen(url + '/stats.json').read())
+            self.assertEqual(payload['state'], 'ok')
+            self.assertEqual(dict((m['name'], m['value']) for m in payload['metrics'])['cache.hits'], 3)
+            self.assertEqual(payload['domains'][0]['name'], 'google.com.')
+
+            self.assertRaises(urllib2.HTTPError, urllib2.urlopen, url + '/nope')
+        finally:
+            server.stop()
+
+    def test_prometheus_format(self):
+        counter, domains = Counter(), TopK(10)
+        counter.add('requests_total', 3L)
+        counter.add_avg('upstream.latency', 1.5, type='float')
+
+        lines = prometheus(counter, domains).splitlines()
+        self.assertTrue('sentry_requests_total 3' in lines, lines)
+        self.assertTrue('# TYPE sentry_requests_total counter' in lines, lines)
+        self.assertTrue('sentry_upstream_latency_avg 1.5' in lines, lines)
+        self.assertTrue('# TYPE sentry_upstream_latency_avg gauge' in lines, lines)
+        self.assertTrue('# TYPE sentry_uptime gauge' in lines, lines)
+
+        for line in lines:
+            if not line.startswith('#'):
+                float(line.rsplit(' ', 1)[1])
+
+
+class ProfileTests(unittest.TestCase):
+
+    def tearDown(self):
+        profile.disable()
+
+    def test_sampling(self):
+        sentry = Sentry({'rules' : ['block ^(.*)']})
+        packet = dns.message.make_query('example.com', 'A').to_wire()
+        name = 'profile.sentry.rules.BlockRule.dispatch_msec_count'
+
+        def sampled():
+            return dict((m['name'], m['value']) for m in stats.get_metrics()).get(name, 0)
+
+        before = sampled()
+        for _ in range(10):
+            sentry.process(packet, {})
+        self.assertEqual(sampled(), before)
+
+        profile.enable(5)
+        for _ in range(10):
+            sentry.process(packet, {})
+        self.assertEqual(sampled(), before + 2)
+
+        profile.toggle()
+        for _ in range(10):
+            sentry.process(packet, {})
+        self.assertEqual(sampled(), before + 2)
+
+
+class QueryLogTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        querylog.configure(None)
+        os.unlink(self.path)
+
+    def test_json_lines(self):
+        sentry = Sentry({'rules' : ['log ^(.*)', 'block ^(.*).xxx'], 'query_log' : self.path})
+
+        for name in ['foo.xxx', 'bar.xxx']:
+            sentry.process(dns.message.make_query(name, 'MX').to_wire(), {'client' : '1.1.1.1:53', 'transport' : 'udp'})
+
+        querylog.configure(None)
+
+        records = [json.loads(line) for line in open(self.path)]
+        self.assertEqual([(r['action'], r['name']) for r in records],
+            [('log', 'foo.xxx.'), ('block', 'foo.xxx.'), ('log', 'bar.xxx.'), ('block', 'bar.xxx.')])
+        self.assertEqual(records[1]['type'], dns.rdatatype.MX)
+        self.assertEqual(records[1]['client'], '1.1.1.1:53')
+        self.assertEqual(records[1]['rule'], '^(.*).xxx')
+
+    def test_drops_instead_of_blocking(self):
+        # a writer that stopped writing, with its one slot taken
+        log = querylog.QueryLog(self.path, queue_size=1)
+        log.close()
+        log.queue.put(None)
+
+        dropped = dict((m['name'], m['value']) for m in stats.get_metrics()).get('querylog.dropped', 0)
+        log.record('block', make_query('example.com'), rules.BlockRule({}, '^(.*)', {}), {})
+        self.assertEqual(dict((m['name'], m['value']) for m in stats.get_metrics())['querylog.dropped'], dropped + 1)
+
+
+class ReloadTests(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def write(self, settings):
+        with open(self.path, 'w') as f:
+            json.dump(settings, f)
+
+    def test_swaps_rules_and_keeps_unchanged_ones(self):
+        settings = {'rules' : ['block ^(.*).xxx', 'resolve ^(.*) using 10.0.0.1']}
+        self.write(settings)
+        sentry = Sentry(settings, path=self.path)
+        resolver = sentry.ruleset[1]
+
+        self.write({'rules' : ['block ^(.*).yyy', 'resolve ^(.*) using 10.0.0.1']})
+        self.assertTrue(sentry.reload())
+
+        self.assertEqual(sentry.ruleset[0].domain, '^(.*).yyy')
+        self.assertTrue(sentry.ruleset[1] is resolver)
+
+        response = dns.message.from_wire(sentry.process(dns.message.make_query('example.yyy', 'A').to_wire(), {}))
+        self.assertEqual(len(response.answer), 0)
+
+        # other settings can change what rules get built from the same line
+        self.write({'rules' : ['block ^(.*).yyy', 'resolve ^(.*) using 10.0.0.1'], 'cache_size' : 0})
+        self.assertTrue(sentry.reload())
+        self.assertFalse(sentry.ruleset[1] is resolver)
+        self.assertTrue(sentry.ruleset[1].cache is None)
+
+    def test_bad_config_keeps_current_rules(self):
+        self.write({'rules' : ['block ^(.*).xxx']})
+        sentry = Sentry({'rules' : ['block ^(.*).xxx']}, path=self.path)
+        ruleset = sentry.ruleset
+
+        with open(self.path, 'w') as f:
+            f.write('{"rules" : [')
+
+        self.assertFalse(sentry.reload())
+        self.assertTrue(sentry.ruleset is ruleset)
+
+    def test_reparse_reuses_rules_without_comparing_them(self):
+        compared = [0]
+
+        class CountingRule(rules.BlockRule):
+            def __eq__(self, other):
+                compared[0] += 1
+                return self is other
+
+            __hash__ = object.__hash__
+
+        settings = {'rules' : ['block ^(.*)domain%d.com' % i for i in xrange(1000)]}
+
+        # regexes compile lazily, so building the previous rules directly is cheap
+        previous = {}
+        for line in settings['rules']:
+            rule = previous[line] = CountingRule(settings, line.split(' ', 1)[1], {})
+            rule.line = line
+
+        compiled = [0]
+        compile_line = parser.compile_line
+
+        def counting_compile_line(*args):
+            compiled[0] += 1
+            return compile_line(*args)
+
+        parser.compile_line = counting_compile_line
+        try:
+            ruleset = parser.parse(settings, previous)
+        finally:
+            parser.compile_line = compile_line
+
+        self.assertEqual(compiled[0], 0)
+        self.assertTrue(all(rule is previous[rule.line] for rule in ruleset))
+
+        # telling kept rules from new ones by comparing them with each other is quadratic
+        self.assertEqual(compared[0], 0)
+
+
+class RulesetCacheTests(unittest.TestCase):
+
+    RULES = ['block ^(.*).xxx', 'block ^(.*).xxx if type is MX', 'redirect ^(.*).yyy to example.org',
+             'resolve ^(.*).zzz using 10.0.0.1', 'resolve ^(.*) using 10.0.0.1', 'bogus line']
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.settings = {'rules' : self.RULES, 'ruleset_cache_dir' : self.dir}
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_parse_shares_state(self):
+        ruleset = parser.parse({'rules' : self.RULES})
+
+        self.assertEqual([rule.__class__ for rule in ruleset],
+                         [rules.BlockRule, rules.ConditionalBlockRule, rules.RedirectRule, rules.ResolveRule, rules.ResolveRule])
+        self.assertEqual(ruleset[1].args['type'], 'MX')
+
+        # same domain, same compiled pattern; same resolvers, same cache
+        self.assertTrue(ruleset[0].RE is ruleset[1].RE)
+        self.assertTrue(ruleset[3].cache is ruleset[4].cache)
+
+    def test_second_start_loads_the_cache(self):
+        first = Sentry(self.settings)
+        self.assertEqual(len(os.listdir(self.dir)), 1)
+
+        second = Sentry(self.settings)
+        self.assertEqual([rule.line for rule in second.ruleset], [rule.line for rule in first.ruleset])
+
+        # nothing compiled until a query needs it
+        self.assertFalse(any('RE' in vars(rule) for rule in second.ruleset))
+
+        for name in ('www.example.xxx.', 'a.yyy.', 'b.zzz.', 'example.com.'):
+            self.assertEqual(second.ruleset.match(name)[0], first.ruleset.match(name)[0])
+
+        self.assertTrue(second.ruleset[3].cache is second.ruleset[4].cache)
+
+    def test_cache_others_can_write_is_ignored(self):
+        Sentry(self.settings)
+        path = os.path.join(self.dir, os.listdir(self.dir)[0])
+
+        # a rule slipped into the cache by someone else
+        with open(path) as f:
+            cached = json.load(f)
+        cached['rules'][-1][1] = '^(.*).evil'
+        with open(path, 'w') as f:
+            json.dump(cached, f)
+
+        # ours alone, so it's trusted
+        self.assertEqual(Sentry(self.settings).ruleset[-1].domain, '^(.*).evil')
+
+        os.chmod(path, 0o666)
+        self.assertEqual(Sentry(self.settings).ruleset[-1].domain, '^(.*)')
+
+        os.chmod(path, 0o600)
+        os.chmod(self.dir, 0o777)
+        self.assertEqual(Sentry(self.settings).ruleset[-1].domain, '^(.*)')
+
+    def test_broken_cache_is_rebuilt(self):
+        Sentry(self.settings)
+        path = os.path.join(self.dir, os.listdir(self.dir)[0])
+        with open(path, 'w') as f:
+            f.write('garbage')
+
+        sentry = Sentry(self.settings)
+        self.assertEqual(len(sentry.ruleset), 5)
+
+
+class BlockListTests(unittest.TestCase):
+
+    HOSTS = """
+# ad servers
+127.0.0.1 localhost
+0.0.0.0 ads.example.com
+0.0.0.0 Tracker.example.net. metrics.example.org # trailing comment
+doubleclick.net
+"""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'hosts.txt')
+        with open(self.path, 'w') as f:
+            f.write(self.HOSTS)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_names_and_suffixes(self):
+        names = blocklist.load(self.path)
+        self.assertEqual(len(names), 4)
+
+        self.assertEqual(names.search('ads.example.com.'), 'com.example.ads.')
+        self.assertEqual(names.search('www.ADS.example.com.'), 'com.example.ads.')
+        self.assertEqual(names.search('tracker.example.net.'), 'net.example.tracker.')
+        self.assertEqual(names.search('ad.doubleclick.net.'), 'net.doubleclick.')
+        self.assertEqual(names.search('example.com.'), None)
+        self.assertEqual(names.search('notads.example.com.'), None)
+        self.assertEqual(names.search('localhost.'), None)
+
+    def test_prebuilt_index(self):
+        built = blocklist.load(self.path, self.dir)
+        mapped = blocklist.load(self.path, self.dir)
+
+        self.assertTrue(isinstance(mapped.data, mmap.mmap))
+        self.assertEqual(len(mapped), len(built))
+        self.assertEqual(mapped.search('x.metrics.example.org.'), 'org.example.metrics.')
+
+        # a changed list makes the index stale
+        with open(self.path, 'a') as f:
+            f.write('0.0.0.0 new.example.com\n')
+        self.assertEqual(blocklist.load(self.path, self.dir).search('new.example.com.'), 'com.example.new.')
+
+    def test_rule(self):
+        sentry = Sentry({'rules' : ['block list %s' % self.path, 'redirect ^(.*) to example.org']})
+        self.assertEqual(len(sentry.ruleset), 2)
+
+        response = dns.message.from_wire(sentry.process(dns.message.make_query('ads.example.com', 'A').to_wire(), {}))
+        self.assertEqual(len(response.answer), 0)
+
+        response = dns.message.from_wire(sentry.process(dns.message.make_query('example.com', 'A').to_wire(), {}))
+        self.assertEqual(response.answer[0].rdtype, dns.rdatatype.CNAME)
+
+
+class SupervisorTests(unittest.TestCase):
+
+    def test_workers_share_port_and_stats(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        sentry = Sentry({
+            'host' : '127.0.0.1',
+            'port' : port,
+            'engine' : 'async',
+            'rules' : [ 'block ^(.*)' ]
+        })
+
+        # the supervisor's own counts get added in too
+        before = dict((m['name'], m['value']) for m in stats.get_metrics()).get('requests_total', 0)
+
+        supervisor = Supervisor(sentry, 2)
+        supervisor.spawn(0)
+        supervisor.spawn(1)
+
+        try:
+            for i in range(20):
+                message = dns.message.make_query('host%d.example.com' % i, 'A')
+                for _ in range(50):
+                    try:
+                        dns.query.udp(message, '127.0.0.1', port=port, timeout=0.2)
+                        break
+                    except Exception:
+                        time.sleep(0.05)
+
+            total, domains = supervisor.collect()
+            metrics = dict((m['name'], m['value']) for m in total.get_metrics())
+            self.assertEqual(metrics['requests_total'], before + 20)
+            self.assertEqual(len(domains.get_metrics(include_uptime=False)), 20)
+
+        finally:
+            supervisor.stop()
+            for pid in list(supervisor.workers):
+                os.waitpid(pid, 0)
+
+    def test_respawn_waits_for_locks(self):
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        sentry = Sentry({'host' : '127.0.0.1', 'port' : port, 'engine' : 'async', 'rules' : ['block ^(.*)']})
+        supervisor = Supervisor(sentry, 1)
+
+        # a metrics scrape in the middle of reading stats while a worker gets forked
+        held = threading.Event()
+
+        def scrape():
+            with stats._lock:
+                held.set()
+                time.sleep(0.2)
+
+        t = threading.Thread(target=scrape)
+        t.start()
+        held.wait()
+
+        supervisor.spawn(0)
+        t.join()
+
+        try:
+            # a worker forked with the lock held would hang in stats.reset() and never answer
+            slot, channel, started = supervisor.workers.values()[0]
+            self.assertTrue(pickle.loads(channel.request(5)))
+        finally:
+            supervisor.stop()
+            for pid in list(supervisor.workers):
+                os.waitpid(pid, 0)
+
+    def test_collect_survives_slow_and_bad_workers(self):
+        ours, theirs = socket.socketpair()
+
+        supervisor = Supervisor(Sentry({'rules' : []}), 1)
+        supervisor.workers[0] = (0, StatsChannel(ours), time.time())
+
+        def reply(value):
+            worker_stats = Counter()
+            worker_stats.add('worker.value', value)
+            payload = pickle.dumps((worker_stats.snapshot(), {'entries' : {}}))
+            return SIZE.pack(len(payload)) + payload
+
+        def worker():
+            # too slow, and cut in two
+            theirs.recv(1)
+            time.sleep(0.3)
+            first = reply(1)
+            theirs.sendall(first[:10])
+            time.sleep(0.1)
+            theirs.sendall(first[10:])
+
+            theirs.recv(1)
+            theirs.sendall(reply(2))
+
+            # not a pickle
+            theirs.recv(1)
+            theirs.sendall(SIZE.pack(5) + 'junk!')
+
+            theirs.recv(1)
+            theirs.sendall(reply(3))
+
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+
+        def value():
+            metrics = dict((m['name'], m['value']) for m in supervisor.collect()[0].get_metrics())
+            return metrics.get('worker.value')
+
+        timeout, supervisor_module.STATS_TIMEOUT = supervisor_module.STATS_TIMEOUT, 0.2
+        try:
+            self.assertEqual(value(), None)
+            self.assertEqual(value(), 2)
+            self.assertEqual(value(), None)
+            self.assertEqual(value(), 3)
+        finally:
+            supervisor_module.STATS_TIMEOUT = timeout
+            ours.close()
+            theirs.close()
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,150 @@
+import logging, threading, time, heapq
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SIZE = 1000
+
+# counts are halved every DEFAULT_DECAY_INTERVAL seconds, 0 never decays
+DEFAULT_DECAY_INTERVAL = 3600
+DECAY_FACTOR = 0.5
+
+# how many adds go by between looking at the clock for decay
+DECAY_CHECK_EVERY = 1024
+
+# second level labels under which country code tlds hand out names, close
+# enough to the public suffix list for rolling up stats
+_SECOND_LEVEL = set(['co', 'com', 'net', 'org', 'gov', 'edu', 'ac', 'ne', 'or', 'go'])
+
+
+def registered_domain(name):
+    """
+    the registered part of a name, www.bbc.co.uk. -> bbc.co.uk.
+    """
+    labels = name.rstrip('.').split('.')
+
+    keep = 2
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in _SECOND_LEVEL:
+        keep = 3
+
+    return '.'.join(labels[-keep:]) + '.'
+
+
+class TopK(object):
+    """
+    Space-Saving heavy hitters: tracks at most `size` keys, a new key takes
+    over the slot of the smallest one and inherits its count as the error
+    bound. memory stays fixed however many distinct keys show up, and any key
+    seen more than total/size times is guaranteed to be in there.
+
+    speaks enough of Counter's api (add, get_metrics, snapshot, merge, reset)
+    to stand in for it as domain_stats.
+    """
+
+    def __init__(self, size=DEFAULT_SIZE, rollup=False, decay_interval=DEFAULT_DECAY_INTERVAL):
+        self._lock = threading.Lock()
+        self.clock = time.time
+        self.configure(size, rollup, decay_interval)
+
+    def configure(self, size=DEFAULT_SIZE, rollup=False, decay_interval=DEFAULT_DECAY_INTERVAL):
+        self.size = size
+        self.rollup = rollup
+        self.decay_interval = decay_interval
+        self.reset()
+
+    def reset(self):
+        """
+        drops every value collected so far
+        """
+        with self._lock:
+            # key -> [count, error]
+            self._entries = {}
+
+            # (count, key) with one entry per key, counts may lag behind
+            self._heap = []
+
+            self._adds = 0
+            self._decayed = self.clock()
+
+    def add(self, key, value=1):
+        if self.rollup:
+            key = registered_domain(key)
+
+        with self._lock:
+            self._add(key, value, 0)
+
+            self._adds += 1
+            if self.decay_interval and self._adds % DECAY_CHECK_EVERY == 0:
+                self._maybe_decay()
+
+    def _add(self, key, value, error):
+        if self.size <= 0:
+            return
+
+        entry = self._entries.get(key)
+
+        if entry is not None:
+            entry[0] += value
+            entry[1] += error
+            return
+
+        if len(self._entries) < self.size:
+            self._entries[key] = [value, error]
+            heapq.heappush(self._heap, (value, key))
+            return
+
+        # the smallest entry makes room, its heap entry may be stale
+        while True:
+            count, smallest = self._heap[0]
+            current = self._entries[smallest][0]
+            if count == current:
+                break
+            heapq.heapreplace(self._heap, (current, smallest))
+
+        del self._entries[smallest]
+        self._entries[key] = [count + value, count + error]
+        heapq.heapreplace(self._heap, (count + value, key))
+
+    def _maybe_decay(self):
+        now = self.clock()
+        if now - self._decayed < self.decay_interval:
+            return
+
+        self._decayed = now
+
+        for entry in self._entries.values():
+            entry[0] = int(entry[0] * DECAY_FACTOR)
+            entry[1] = int(entry[1] * DECAY_FACTOR)
+
+        self._heap = [(entry[0], key) for key, entry in self._entries.iteritems()]
+        heapq.heapify(self._heap)
+
+    def top(self, n=None):
+        """
+        [(key, count, error)] biggest first
+        """
+        with self._lock:
+            entries = [(key, count, error) for key, (count, error) in self._entries.iteritems()]
+
+        entries.sort(key=lambda e: e[1], reverse=True)
+        return entries[:n] if n else entries
+
+    def get_metrics(self, include_uptime=False):
+        return [{'type': 'int', 'name': key, 'value': count} for key, count, error in self.top()]
+
+    def snapshot(self):
+        """
+        raw copy of the entries, can be handed to merge() on another TopK
+        """
+        with self._lock:
+            return {'entries': dict((key, tuple(entry)) for key, entry in self._entries.iteritems())}
+
+    def merge(self, snapshot):
+        """
+        folds a snapshot taken from another TopK into this one
+        """
+        with self._lock:
+            for key, (count, error) in snapshot['entries'].iteritems():
+                self._add(key, count, error)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,509 @@
+import logging, socket, struct, errno, random, threading, time, weakref, os
+
+import futures
+import dns.inet
+
+from sentry import stats, errors, wire
+from sentry.loop import EventLoop
+
+log = logging.getLogger(__name__)
+
+DNS_PORT = 53
+
+# long lived udp sockets per upstream, each one gets its own source port
+DEFAULT_SOCKETS = 4
+
+# persistent tcp connections per upstream when tcp is turned on
+DEFAULT_TCP_CONNECTIONS = 2
+
+# how many times we look for a free query id before giving up
+ID_ATTEMPTS = 16
+
+# how upstreams are picked: "hedged" asks the fastest healthy one first and
+# the next one only if it's slow to answer, "parallel" asks all of them at once
+STRATEGIES = ['hedged', 'parallel']
+DEFAULT_STRATEGY = 'hedged'
+
+# what we assume about upstreams we haven't heard back from yet
+DEFAULT_RTT = 0.05
+
+# hedges go out after srtt + 4 * rttvar (roughly the p95 rtt) within these
+MIN_HEDGE_DELAY = 0.005
+MAX_HEDGE_DELAY = 0.5
+
+# upstreams failing this many queries in a row sit out for a while,
+# doubling every time up to MAX_BACKOFF
+FAILURE_THRESHOLD = 3
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 30.0
+
+
+def _would_block(e):
+    return e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+def parse_address(text):
+    """
+    (host, port) for a resolver given as host, host:port, an ipv6 address
+    or [ipv6 address]:port
+    """
+    text = text.strip()
+
+    if text.startswith('['):
+        host, _, port = text[1:].partition(']')
+        port = port[1:] if port.startswith(':') else port
+    elif text.count(':') > 1:
+        host, port = text, ''
+    else:
+        host, _, port = text.partition(':')
+
+    try:
+        return host, int(port or DNS_PORT)
+    except ValueError:
+        raise errors.Error('bad resolver address %s' % text)
+
+
+def family(host):
+    """ the socket family for talking to host """
+    try:
+        return dns.inet.af_for_address(host)
+    except ValueError:
+        return socket.AF_INET
+
+
+class _UDPChannel(object):
+    """
+    one connected udp socket to an upstream
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.sock = socket.socket(upstream.family, socket.SOCK_DGRAM)
+        self.sock.setblocking(0)
+
+        # connected sockets only ever hear back from the upstream itself
+        self.sock.connect(upstream.address)
+        upstream.loop.add_reader(self.sock.fileno(), self.readable)
+
+    def send(self, wire):
+        self.sock.send(wire)
+
+    def readable(self):
+        while True:
+            try:
+                data = self.sock.recv(65535)
+            except socket.error as e:
+                # nothing listening upstream, no point waiting for answers
+                if e.args[0] == errno.ECONNREFUSED:
+                    self.upstream.channel_failed(self, e)
+                elif not _would_block(e):
+                    log.error('error reading from %s: %s' % (self.upstream, e))
+                return
+
+            self.upstream.answered(self, data)
+
+
+class _TCPChannel(object):
+    """
+    a persistent tcp connection to an upstream, queries are pipelined and
+    answers matched back by id. reconnects on the next query once it drops.
+    """
+
+    def __init__(self, upstream):
+        self.upstream = upstream
+        self.loop = upstream.loop
+        self.sock = None
+        self.connected = False
+        self.inbuf = ''
+        self.outbuf = ''
+
+    def _connect(self):
+        self.sock = socket.socket(self.upstream.family, socket.SOCK_STREAM)
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()
+        self.connected = False
+
+        err = self.sock.connect_ex(self.upstream.address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            self._close(socket.error(err, 'could not connect'))
+            return
+
+        self.loop.add_writer(self.fd, self._flush)
+        self.loop.add_reader(self.fd, self._readable)
+
+    def send(self, wire):
+        if self.sock is None:
+            self._connect()
+
+        self.outbuf += struct.pack('!H', len(wire)) + wire
+
+        if self.connected:
+            self._flush()
+
+    def _flush(self):
+        if self.sock is None:
+            return
+
+        if not self.connected:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._close(socket.error(err, 'could not connect'))
+                return
+            self.connected = True
+
+        if self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except socket.error as e:
+                if not _would_block(e):
+                    self._close(e)
+                return
+            self.outbuf = self.outbuf[sent:]
+
+        if self.outbuf:
+            self.loop.add_writer(self.fd, self._flush)
+        else:
+            self.loop.remove_writer(self.fd)
+
+    def _readable(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if not _would_block(e):
+                self._close(e)
+            return
+
+        if not data:
+            self._close(socket.error('connection closed by upstream'))
+            return
+
+        self.inbuf += data
+
+        while len(self.inbuf) >= 2:
+            size = struct.unpack('!H', self.inbuf[:2])[0]
+            if len(self.inbuf) < size + 2:
+                break
+
+            message, self.inbuf = self.inbuf[2:size + 2], self.inbuf[size + 2:]
+            self.upstream.answered(self, message)
+
+    def _close(self, error):
+        if self.sock is not None:
+            self.loop.remove_reader(self.fd)
+            self.loop.remove_writer(self.fd)
+            self.sock.close()
+
+        self.sock = None
+        self.connected = False
+        self.inbuf = ''
+        self.outbuf = ''
+
+        self.upstream.channel_failed(self, error)
+
+
+class Upstream(object):
+    """
+    a resolver we forward queries to, reached through a pool of long lived
+    sockets owned by one event loop. every query gets a fresh id, answers are
+    matched back to it by (socket, id) so sockets can be shared by any number
+    of queries in flight.
+
+    only ever touch an Upstream from its loop's thread.
+    """
+
+    def __init__(self, host, port, loop, sockets=DEFAULT_SOCKETS, tcp=False, tcp_connections=DEFAULT_TCP_CONNECTIONS):
+        self.host = host
+        self.port = port
+        self.address = (host, port)
+        self.family = family(host)
+        self.loop = loop
+        self.tcp = tcp
+
+        if tcp:
+            self.channels = [_TCPChannel(self) for _ in xrange(tcp_connections)]
+        else:
+            self.channels = [_UDPChannel(self) for _ in xrange(sockets)]
+
+        self.pending = {}
+        self._next = 0
+
+        # smoothed rtt and its variance, the way tcp keeps them (RFC 6298)
+        self.srtt = None
+        self.rttvar = None
+
+        self.failures = 0
+        self.down_until = 0
+
+    def __str__(self):
+        if self.family == socket.AF_INET6:
+            return '[%s]:%s' % self.address
+        return '%s:%s' % self.address
+
+    def observe(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        self.failures = 0
+        self.down_until = 0
+
+    def failed(self):
+        self.failures += 1
+
+        if self.failures >= FAILURE_THRESHOLD:
+            backoff = min(BASE_BACKOFF * 2 ** (self.failures - FAILURE_THRESHOLD), MAX_BACKOFF)
+            self.down_until = self.loop.time() + backoff
+
+    def healthy(self):
+        return self.down_until <= self.loop.time()
+
+    def score(self):
+        """ lower is better: healthy first, then fastest """
+        return (not self.healthy(), self.srtt if self.srtt is not None else DEFAULT_RTT)
+
+    def hedge_delay(self):
+        """ how long to wait on this upstream before asking another one """
+        if self.srtt is None:
+            return DEFAULT_RTT
+        return min(max(self.srtt + 4 * self.rttvar, MIN_HEDGE_DELAY), MAX_HEDGE_DELAY)
+
+    def query(self, query, timeout):
+        """
+        sends a wire.Query upstream and returns a future of the wire format
+        answer, carrying the query's own id
+        """
+        future = futures.Future()
+
+        channel = self.channels[self._next]
+        self._next = (self._next + 1) % len(self.channels)
+
+        for _ in xrange(ID_ATTEMPTS):
+            qid = random.getrandbits(16)
+            if (channel, qid) not in self.pending:
+                break
+        else:
+            future.set_exception(errors.NetworkError('no free query ids left for %s' % self))
+            return future
+
+        key = (channel, qid)
+        timer = self.loop.call_later(timeout, self._expire, key)
+        self.pending[key] = (future, query, timer, time.time())
+
+        stats.add('upstream.%s.queries' % self, 1)
+
+        try:
+            channel.send(struct.pack('!H', qid) + query.packet[2:])
+        except socket.error as e:
+            self._fail(key, e)
+
+        return future
+
+    def answered(self, channel, data):
+        if len(data) < 12:
+            return
+
+        key = (channel, struct.unpack('!H', data[:2])[0])
+        entry = self.pending.get(key)
+
+        # late answers to queries we gave up on land here too
+        if entry is None:
+            stats.add('upstream.%s.unmatched' % self, 1)
+            return
+
+        future, query, timer, started = entry
+
+        try:
+            response = wire.parse(data)
+        except errors.Error as e:
+            self._fail(key, e)
+            return
+
+        # the id alone is easy to guess, the question has to match too
+        if not response.flags & wire.QR or response.qname.lower() != query.qname.lower() \
+                or response.qtype != query.qtype or response.qclass != query.qclass:
+            stats.add('upstream.%s.unmatched' % self, 1)
+            return
+
+        del self.pending[key]
+        timer.cancel()
+
+        rtt = time.time() - started
+        self.observe(rtt)
+        stats.add_histogram('upstream.%s.rtt_msec' % self, rtt * 1000)
+        future.set_result(query.packet[:2] + data[2:])
+
+    def _expire(self, key):
+        stats.add('upstream.%s.timeouts' % self, 1)
+        stats.add('upstream.timeouts', 1)
+        self._fail(key, errors.NetworkError('timed out waiting on %s' % self))
+
+    def _fail(self, key, error):
+        entry = self.pending.pop(key, None)
+        if entry is None:
+            return
+
+        future, query, timer, started = entry
+        timer.cancel()
+
+        self.failed()
+
+        if not isinstance(error, errors.NetworkError):
+            stats.add('upstream.%s.errors' % self, 1)
+            stats.add('upstream.errors', 1)
+            error = errors.NetworkError('%s failed: %s' % (self, error))
+
+        future.set_exception(error)
+
+    def channel_failed(self, channel, error):
+        log.error('lost connection to %s: %s' % (self, error))
+        for key in [k for k in self.pending if k[0] is channel]:
+            self._fail(key, error)
+
+    def close(self):
+        for key in self.pending.keys():
+            self._fail(key, errors.NetworkError('%s closed' % self))
+
+        for channel in self.channels:
+            if channel.sock is not None:
+                self.loop.remove_reader(channel.sock.fileno())
+                self.loop.remove_writer(channel.sock.fileno())
+                channel.sock.close()
+
+
+def parallel(upstreams, query, timeout):
+    """
+    asks every upstream at once, returns a future of the first answer. only
+    fails once all of them did.
+    """
+    result = futures.Future()
+    failures = []
+
+    def _done(f):
+        if result.done():
+            return
+
+        if f.exception() is not None:
+            failures.append(f.exception())
+            if len(failures) == len(pending):
+                result.set_exception(f.exception())
+            return
+
+        result.set_result(f.result())
+
+    pending = [u.query(query, timeout) for u in upstreams]
+
+    for f in pending:
+        f.add_done_callback(_done)
+
+    return result
+
+
+def hedged(upstreams, query, timeout):
+    """
+    asks the best upstream first. the next best one gets asked too when the
+    first fails, or hasn't answered within its hedge delay. returns a future
+    of the first answer, failing once every upstream did or timeout runs out.
+    """
+    loop = upstreams[0].loop
+    candidates = sorted(upstreams, key=lambda u: u.score())
+    deadline = loop.time() + timeout
+
+    result = futures.Future()
+    state = {'next': 0, 'outstanding': 0, 'timer': None}
+    failures = []
+
+    def _launch():
+        if state['timer'] is not None:
+            state['timer'].cancel()
+            state['timer'] = None
+
+        upstream = candidates[state['next']]
+        state['next'] += 1
+        state['outstanding'] += 1
+        launched = state['next']
+
+        upstream.query(query, max(deadline - loop.time(), 0)).add_done_callback(_done)
+
+        # a query failing right away has already moved on to the next upstream
+        if launched == state['next'] < len(candidates) and not result.done():
+            state['timer'] = loop.call_later(upstream.hedge_delay(), _hedge)
+
+    def _hedge():
+        state['timer'] = None
+        if not result.done():
+            stats.add('upstream.hedged', 1)
+            _launch()
+
+    def _done(f):
+        state['outstanding'] -= 1
+
+        if result.done():
+            return
+
+        if f.exception() is None:
+            if state['timer'] is not None:
+                state['timer'].cancel()
+            result.set_result(f.result())
+            return
+
+        failures.append(f.exception())
+
+        if state['next'] < len(candidates) and loop.time() < deadline:
+            stats.add('upstream.fallbacks', 1)
+            _launch()
+        elif not state['outstanding']:
+            if state['timer'] is not None:
+                state['timer'].cancel()
+            result.set_exception(failures[-1])
+
+    _launch()
+    return result
+
+
+# upstreams are shared by every rule using the same loop
+_upstreams = weakref.WeakKeyDictionary()
+
+
+def get(host, port, loop, settings, tcp=False):
+    """
+    returns the Upstream for host:port on loop, creating it the first time.
+    it talks tcp when asked to or when upstream_tcp is set.
+    """
+    tcp = tcp or settings.get('upstream_tcp', False)
+
+    pool = _upstreams.setdefault(loop, {})
+    key = (host, port, tcp)
+
+    if key not in pool:
+        pool[key] = Upstream(host, port, loop,
+            sockets=settings.get('upstream_sockets', DEFAULT_SOCKETS),
+            tcp=tcp,
+            tcp_connections=settings.get('upstream_tcp_connections', DEFAULT_TCP_CONNECTIONS))
+
+    return pool[key]
+
+
+_background = None
+_background_pid = None
+_background_lock = threading.Lock()
+
+
+def background_loop():
+    """
+    event loop thread that talks to upstreams for engines without a loop of
+    their own
+    """
+    global _background, _background_pid
+
+    with _background_lock:
+        # a forked worker doesn't get the thread, only the object
+        if _background is None or _background_pid != os.getpid():
+            _background = EventLoop()
+            _background_pid = os.getpid()
+            t = threading.Thread(None, _background.run_forever, name='upstream-loop')
+            t.setDaemon(True)
+            t.start()
+
+    return _background
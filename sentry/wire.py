@@ -0,0 +1,296 @@
+import logging, struct
+
+import dns.message
+import dns.name
+
+from sentry import errors
+
+log = logging.getLogger(__name__)
+
+HEADER = struct.Struct('!HHHHHH')
+RR = struct.Struct('!HHIH')
+TYPE_CLASS = struct.Struct('!HH')
+TTL = struct.Struct('!I')
+
+# header flags
+QR = 0x8000
+TC = 0x0200
+RD = 0x0100
+CD = 0x0010
+OPCODE = 0x7800
+RCODE = 0x000f
+
+# EDNS flags, the low 16 bits of the OPT record's ttl
+DO = 0x8000
+
+# record types we have to know about
+OPT = 41
+SOA = 6
+CNAME = 5
+
+IN = 1
+
+# pointer to the question's name, always right after the header
+QNAME_POINTER = '\xc0\x0c'
+
+# sections records are yielded for
+ANSWER, AUTHORITY, ADDITIONAL = 0, 1, 2
+
+# payload we advertise when answering EDNS queries ourselves, same as dnspython
+OUR_PAYLOAD = 8192
+
+# what any client takes over udp, EDNS or not (RFC 1035)
+MIN_PAYLOAD = 512
+
+_ESCAPED = '"().;\\@$'
+
+
+class FormError(errors.Error):
+    pass
+
+
+def _escape(label):
+    """ same label escaping dnspython uses for text names """
+    text = ''
+    for c in label:
+        if c in _ESCAPED:
+            text += '\\' + c
+        elif 0x20 < ord(c) < 0x7F:
+            text += c
+        else:
+            text += '\\%03d' % ord(c)
+    return text
+
+
+def read_name(packet, offset):
+    """
+    returns (text, end) for the name at offset, text looks exactly like
+    str() of the dnspython name (absolute, escaped)
+    """
+    labels = []
+    end = None
+    jumps = 0
+
+    while True:
+        try:
+            size = ord(packet[offset])
+        except IndexError:
+            raise FormError('name runs past the end of the packet')
+
+        if size == 0:
+            offset += 1
+            break
+
+        if size & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 63:
+                raise FormError('compression loop in name')
+            offset = struct.unpack('!H', packet[offset:offset + 2])[0] & 0x3FFF
+            continue
+
+        if size & 0xC0:
+            raise FormError('unknown label type')
+
+        label = packet[offset + 1:offset + 1 + size]
+        if len(label) < size:
+            raise FormError('name runs past the end of the packet')
+
+        labels.append(label if label.isalnum() else _escape(label))
+        offset += size + 1
+
+    if end is None:
+        end = offset
+
+    return '.'.join(labels) + '.', end
+
+
+def skip_name(packet, offset):
+    """ returns the offset right after the name at offset """
+    while True:
+        try:
+            size = ord(packet[offset])
+        except IndexError:
+            raise FormError('name runs past the end of the packet')
+
+        if size == 0:
+            return offset + 1
+        if size & 0xC0 == 0xC0:
+            return offset + 2
+        offset += size + 1
+
+
+def records(packet, offset=None):
+    """
+    walks the answer, authority and additional sections and yields
+    (section, rdtype, ttl_offset, rdata_offset, rdlength) for every record
+    """
+    id, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(packet)
+
+    if offset is None:
+        offset = HEADER.size
+        for _ in xrange(qdcount):
+            offset = skip_name(packet, offset) + TYPE_CLASS.size
+
+    for section, count in ((ANSWER, ancount), (AUTHORITY, nscount), (ADDITIONAL, arcount)):
+        for _ in xrange(count):
+            offset = skip_name(packet, offset)
+            if offset + RR.size > len(packet):
+                raise FormError('record runs past the end of the packet')
+
+            rdtype, rdclass, ttl, rdlength = RR.unpack_from(packet, offset)
+            if offset + RR.size + rdlength > len(packet):
+                raise FormError('record runs past the end of the packet')
+
+            yield section, rdtype, offset + 4, offset + RR.size, rdlength
+            offset += RR.size + rdlength
+
+
+class Query(object):
+    """
+    a query read straight off the wire: header, first question and nothing
+    else. the full dnspython message is only built when someone asks for it.
+    """
+
+    def __init__(self, packet):
+        if len(packet) < HEADER.size:
+            raise FormError('packet too short for a dns header')
+
+        self.id, self.flags, qdcount, _, _, _ = HEADER.unpack_from(packet)
+
+        if qdcount != 1:
+            raise FormError('expected exactly one question, got %d' % qdcount)
+
+        self.packet = packet
+        self.qname, offset = read_name(packet, HEADER.size)
+
+        if offset + TYPE_CLASS.size > len(packet):
+            raise FormError('question runs past the end of the packet')
+
+        self.qtype, self.qclass = TYPE_CLASS.unpack_from(packet, offset)
+
+        # end of the question section
+        self.end = offset + TYPE_CLASS.size
+
+        self._message = None
+
+    @property
+    def question(self):
+        """ wire format of the question section """
+        return self.packet[HEADER.size:self.end]
+
+    @property
+    def message(self):
+        """ the full dns.message, parsed on first use """
+        if self._message is None:
+            self._message = dns.message.from_wire(self.packet)
+        return self._message
+
+    def rename(self, name):
+        """
+        swaps the question's name for name, keeping everything else
+        """
+        question = dns.name.from_text(name).to_wire() + TYPE_CLASS.pack(self.qtype, self.qclass)
+        self.__init__(self.packet[:HEADER.size] + question + self.packet[self.end:])
+
+    def edns(self):
+        """
+        (udp payload size, EDNS flags) from the query's OPT record, None
+        without EDNS
+        """
+        if len(self.packet) == self.end:
+            return None
+
+        try:
+            for section, rdtype, ttl_offset, rdata_offset, rdlength in records(self.packet, self.end):
+                if rdtype == OPT:
+                    payload = TYPE_CLASS.unpack_from(self.packet, ttl_offset - 4)[1]
+                    return payload, TTL.unpack_from(self.packet, ttl_offset)[0] & 0xffff
+        except (FormError, struct.error):
+            pass
+        return None
+
+    def payload(self):
+        """
+        the udp payload size from the query's OPT record, None without EDNS
+        """
+        edns = self.edns()
+        return None if edns is None else edns[0]
+
+    def __str__(self):
+        return 'Q{ id: %s, flags: %s question: %s %s %s }' % (self.id, self.flags, self.qname, self.qclass, self.qtype)
+
+
+def parse(packet):
+    return Query(packet)
+
+
+def readdress(response, query):
+    """
+    a wire format response to the same question, handed to query: its id
+    and its spelling of the question
+    """
+    return query.packet[:2] + response[2:HEADER.size] + query.question + response[query.end:]
+
+
+class ResponseTemplate(object):
+    """
+    a canned response built once, only the id, flags and question are filled
+    in per query. answers are wire format records, ideally naming the question
+    with QNAME_POINTER so they fit any query.
+    """
+
+    def __init__(self, answers=(), rcode=0):
+        self.answers = ''.join(answers)
+        self.ancount = len(answers)
+        self.rcode = rcode
+
+        # same OPT record dns.message.make_response adds for EDNS queries
+        self.opt = '\0' + RR.pack(OPT, OUR_PAYLOAD, 0, 0)
+
+    def render(self, query):
+        if query.flags & QR:
+            raise FormError('specified query message is not a query')
+
+        flags = QR | (query.flags & (RD | OPCODE)) | self.rcode
+
+        if query.payload() is None:
+            return HEADER.pack(query.id, flags, 1, self.ancount, 0, 0) + query.question + self.answers
+
+        return HEADER.pack(query.id, flags, 1, self.ancount, 0, 1) + query.question + self.answers + self.opt
+
+
+def record(rdtype, ttl, rdata, name=QNAME_POINTER, rdclass=IN):
+    """ a wire format resource record """
+    return name + RR.pack(rdtype, rdclass, ttl, len(rdata)) + rdata
+
+
+EMPTY = ResponseTemplate()
+
+
+def empty_response(query):
+    """
+    an answerless response to query, the same thing
+    dns.message.make_response(query).to_wire() would give us
+    """
+    return EMPTY.render(query)
+
+
+def truncate(response, query):
+    """
+    response if it fits in what query's client takes over udp, otherwise an
+    answerless copy with TC set so the client asks again over tcp
+    """
+    if len(response) <= MIN_PAYLOAD:
+        return response
+
+    payload = query.payload()
+    if len(response) <= (payload or 0):
+        return response
+
+    flags = HEADER.unpack_from(response)[1] | TC
+
+    if payload is None:
+        return HEADER.pack(query.id, flags, 1, 0, 0, 0) + query.question
+    return HEADER.pack(query.id, flags, 1, 0, 0, 1) + query.question + EMPTY.opt
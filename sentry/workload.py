@@ -0,0 +1,128 @@
+import logging, random, bisect, gzip, zipfile, itertools
+
+from array import array
+
+log = logging.getLogger(__name__)
+
+# distinct names a synthetic workload draws from
+DEFAULT_NAMES = 10000
+
+# zipf exponent, around 1 is what dns popularity tends to look like
+DEFAULT_SKEW = 1.0
+
+DEFAULT_QTYPES = 'A:70,AAAA:25,MX:5'
+
+# synthetic names end in these, a few two level ones so rollups get exercised
+TLDS = ['com', 'net', 'org', 'io', 'de', 'co.uk']
+
+
+def read_names(path):
+    """
+    streams the names in path: one per line, or the last column of a csv
+    such as a top sites list (rank,name). plain, gzip and zip files all work,
+    from a zip we read the first file in it.
+    """
+    if path.endswith('.gz'):
+        f = gzip.open(path)
+    elif zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        f = archive.open(archive.namelist()[0])
+    else:
+        f = open(path)
+
+    try:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            yield line.rsplit(',', 1)[-1].strip()
+    finally:
+        f.close()
+
+
+def corpus(path, rdtype='A', limit=0, repeat=False):
+    """
+    (name, rdtype) for the first limit names in path (all of them with 0),
+    starting over at the top forever with repeat
+    """
+    while True:
+        count = 0
+        for name in itertools.islice(read_names(path), limit or None):
+            count += 1
+            yield name, rdtype
+
+        if not repeat or count == 0:
+            return
+
+
+def parse_qtypes(text):
+    """
+    'A:70,AAAA:25,MX:5' -> [('A', 70.0), ('AAAA', 25.0), ('MX', 5.0)]
+    """
+    mix = []
+    for item in text.split(','):
+        rdtype, _, weight = item.strip().partition(':')
+        mix.append((rdtype.upper(), float(weight or 1)))
+    return mix
+
+
+class Zipf(object):
+    """
+    draws ranks 0..size-1, rank r with probability proportional to 1/(r+1)**skew
+    """
+
+    def __init__(self, size, skew=DEFAULT_SKEW, rand=random):
+        self.rand = rand
+        self.cdf = array('d')
+
+        total = 0.0
+        for rank in xrange(1, size + 1):
+            total += 1.0 / rank ** skew
+            self.cdf.append(total)
+
+        self.total = total
+
+    def sample(self):
+        return bisect.bisect_left(self.cdf, self.rand.random() * self.total)
+
+
+def site(rank):
+    """ the synthetic name at a popularity rank """
+    return 'site%d.%s' % (rank, TLDS[rank % len(TLDS)])
+
+
+def synthetic(count=None, names=DEFAULT_NAMES, skew=DEFAULT_SKEW, qtypes=DEFAULT_QTYPES,
+              random_subdomains=0.0, seed=0):
+    """
+    count (name, rdtype) pairs, forever without a count. names are drawn from
+    `names` sites by zipf popularity, rdtypes from the qtypes mix and a
+    random_subdomains share gets a random label in front, so it misses every
+    cache like a random subdomain flood would. the same seed gives the same
+    queries every time.
+    """
+    rand = random.Random(seed)
+    popularity = Zipf(names, skew, rand)
+
+    mix = parse_qtypes(qtypes)
+    cumulative = _accumulate([weight for _, weight in mix])
+    rdtypes = [rdtype for rdtype, _ in mix]
+
+    produced = 0
+    while count is None or produced < count:
+        name = site(popularity.sample())
+
+        if random_subdomains and rand.random() < random_subdomains:
+            name = '%08x.%s' % (rand.getrandbits(32), name)
+
+        rdtype = rdtypes[bisect.bisect_right(cumulative, rand.random() * cumulative[-1])]
+
+        produced += 1
+        yield name, rdtype
+
+
+def _accumulate(values):
+    total, sums = 0.0, []
+    for value in values:
+        total += value
+        sums.append(total)
+    return sums